@@ -47,6 +47,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'gui.routers.ReadYourWritesMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -64,6 +65,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'gui.context_processors.unread_notifications',
             ],
         },
     },
@@ -75,10 +77,54 @@ WSGI_APPLICATION = 'Watchdog.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# DB_PROFILE=production turns on the tuning of the SQLite connections for a server: the pragmas in SQLITE_PRAGMAS
+# (see gui/db.py) and transactions started with BEGIN IMMEDIATE (gui/sqlite_backend). It is off by default,
+# because journal_mode=WAL is stored in the database file and leaves db.sqlite3-wal and db.sqlite3-shm files next
+# to it. DB_CONN_MAX_AGE keeps a connection open for that many seconds between requests (0 closes it after every
+# request), set it in production.
+# With BEGIN IMMEDIATE a transaction takes the write lock when it starts, so two transactions that read and then
+# write wait for each other (busy_timeout) instead of one failing with "database is locked"
+DB_PROFILE = os.environ.get('DB_PROFILE', 'development')
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'gui.sqlite_backend' if DB_PROFILE == 'production' else 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '0')),
+        'CONN_HEALTH_CHECKS': True,
+    }
+}
+
+# A read replica of the database (see gui/routers.py), e.g. for local testing a copy of db.sqlite3 made with
+# 'python manage.py sync_replica'. The listing and detail views read from it, except for the REPLICA_PIN_SECONDS
+# after a user's own write, when the user's requests read from the primary
+DATABASE_REPLICAS = []
+if os.environ.get('DB_REPLICA_NAME'):
+    DATABASES['replica'] = {**DATABASES['default'], 'NAME': os.environ['DB_REPLICA_NAME'],
+                            'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append('replica')
+DATABASE_ROUTERS = ['gui.routers.PrimaryReplicaRouter']
+REPLICA_PIN_SECONDS = 5
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    # 256 MiB
+    'mmap_size': 256 * 1024 * 1024,
+    # Negative: in KiB, i.e. 64 MiB
+    'cache_size': -64 * 1024,
+    # Milliseconds
+    'busy_timeout': 5000,
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# The local-memory cache is per process; use a shared backend (e.g. Redis or Memcached)
+# when running several workers, so that invalidations reach all of them
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
@@ -137,8 +183,100 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 
+# Uploaded files are stored by content hash, so identical photos are stored once (see gui/storage.py)
+STORAGES = {
+    'default': {
+        'BACKEND': 'gui.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
     'guardian.backends.ObjectPermissionBackend',
 ]
 
+# Number of posts shown on one page of the index and the archive
+LISTING_PAGE_SIZE = 24
+
+# Search radius in km around the user's location when the search form doesn't give one (e.g. when sorting
+# by distance), so only the entries inside its bounding box are compared
+DEFAULT_SEARCH_RADIUS_KM = 20
+
+# Full-text search: how many results the JSON search endpoint returns
+SEARCH_JSON_LIMIT = 20
+
+# The largest number of shelters returned by the "near me" endpoint
+NEARBY_SHELTERS_LIMIT = 50
+
+# The class that renders the maps on the shelter pages. 'gui.maps.leaflet.LeafletRenderer' is a lighter
+# alternative without Python dependencies that draws the map in the browser
+MAP_RENDERER = 'gui.maps.folium_renderer.FoliumRenderer'
+
+# The city-wide shelter map splits every tile into CLUSTER_GRID x CLUSTER_GRID cells
+# and merges the shelters in the same cell into one marker
+CLUSTER_GRID = 8
+
+# Widths (in pixels) of the square thumbnails generated for the photos of the posts.
+# The cards are 200px wide, the larger size is for high density screens
+IMAGE_VARIANT_WIDTHS = (200, 400)
+
+# Notification job queue (see gui/notifications.py): the number of notifications written with one INSERT,
+# after how many seconds a job claimed by a worker that hasn't finished it is given to another worker
+# and how many times a job is tried before it's marked as failed
+NOTIFICATION_BATCH_SIZE = 500
+NOTIFICATION_JOB_TIMEOUT = 600
+NOTIFICATION_JOB_MAX_ATTEMPTS = 5
+
+# Number of notifications shown on one page of the inbox
+NOTIFICATIONS_PAGE_SIZE = 50
+
+# 'purge_notifications' deletes read notifications older than NOTIFICATION_RETENTION_DAYS,
+# NOTIFICATION_PURGE_BATCH_SIZE rows per transaction
+NOTIFICATION_RETENTION_DAYS = 90
+NOTIFICATION_PURGE_BATCH_SIZE = 1000
+
+# Server-Sent Events stream of new notifications: how often every process with open streams looks for new
+# notifications (written by the job worker, which runs in another process), how often an idle stream checks the
+# database itself and sends a heartbeat, after how many seconds a stream is closed (the browser reconnects by
+# itself) and how long the browser waits before reconnecting
+SSE_WAKEUP_INTERVAL = 1
+SSE_POLL_INTERVAL = 15
+SSE_MAX_DURATION = 300
+SSE_RETRY_MS = 3000
+
+# How the header learns about new notifications. 'sse' keeps the stream above open, which only works when the
+# site is served by an ASGI server (Watchdog.asgi): under WSGI Django consumes the whole stream before sending
+# it, so every page would hold a worker for SSE_MAX_DURATION seconds and get nothing. With 'poll' (the default)
+# the page asks for new notifications every NOTIFICATION_POLL_INTERVAL seconds instead
+NOTIFICATION_TRANSPORT = os.environ.get('NOTIFICATION_TRANSPORT', 'poll')
+NOTIFICATION_POLL_INTERVAL = 30
+
+# Email digests of unread notifications (see gui/digests.py): a user gets at most one email per
+# NOTIFICATION_DIGEST_WINDOW seconds, the digests are sent NOTIFICATION_DIGEST_BATCH_SIZE at a time over one
+# connection, a failed digest is retried after NOTIFICATION_DIGEST_RETRY_DELAY seconds, doubled after every
+# failure up to NOTIFICATION_DIGEST_MAX_RETRY_DELAY, and an email lists at most NOTIFICATION_DIGEST_MAX_ITEMS
+NOTIFICATION_DIGEST_WINDOW = 60 * 60
+NOTIFICATION_DIGEST_BATCH_SIZE = 100
+NOTIFICATION_DIGEST_RETRY_DELAY = 60
+NOTIFICATION_DIGEST_MAX_RETRY_DELAY = 24 * 60 * 60
+NOTIFICATION_DIGEST_MAX_ITEMS = 20
+
+# Print the emails to the console during development. Set EMAIL_BACKEND to
+# 'django.core.mail.backends.smtp.EmailBackend' (and EMAIL_HOST, ...) to send them
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'watchdog@localhost')
+
+# The address of the site, used for the links in the emails
+SITE_URL = os.environ.get('SITE_URL', 'http://localhost:8000')
+
+# Serving of the uploaded files (see gui/media.py). Only the files in MEDIA_PUBLIC_DIRS are served, to anyone.
+# MEDIA_ACCEL hands the sending of the file over to the front proxy: 'nginx' responds with an X-Accel-Redirect
+# to MEDIA_ACCEL_PREFIX + the percent-encoded name of the file (an 'internal' location with 'alias' pointing to
+# MEDIA_ROOT), 'sendfile' with X-Sendfile (Apache mod_xsendfile, lighttpd), except for non-ASCII paths, which a
+# header can't carry. When it's empty, Django sends the file itself
+MEDIA_PUBLIC_DIRS = ('dogs', 'thumbs')
+MEDIA_ACCEL = os.environ.get('MEDIA_ACCEL', '')
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media/')
@@ -0,0 +1,149 @@
+"""
+SQLite concurrency benchmark: read and write throughput under a mixed load with the default SQLite setup
+(rollback journal, a new connection for every request) compared to the production profile (the pragmas in
+SQLITE_PRAGMAS, persistent connections).
+
+Reader threads run the queries of a listing page (a page of visible posts and the facet counts), writer threads
+add comments and change the stage of posts, each in its own BEGIN IMMEDIATE transaction, like Django does with
+transaction_mode='IMMEDIATE'. Every profile runs on a fresh copy of the same database in a temporary directory.
+Usage:
+
+    python benchmarks/sqlite_concurrency.py [--readers N] [--writers N] [--duration SECONDS] [--posts N]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Watchdog.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+
+from gui.db import apply_pragmas  # noqa: E402
+
+SCHEMA = """
+CREATE TABLE post (
+    id INTEGER PRIMARY KEY, name TEXT, breed TEXT, size TEXT, gender TEXT, shelter_id INTEGER,
+    adoption_stage TEXT, description TEXT
+);
+CREATE INDEX post_stage_idx ON post (adoption_stage, id);
+CREATE INDEX post_facets_idx ON post (adoption_stage, shelter_id, size, gender, breed);
+CREATE TABLE comment (id INTEGER PRIMARY KEY, post_id INTEGER, author_id INTEGER, content TEXT, created TEXT);
+CREATE INDEX comment_post_idx ON comment (post_id);
+"""
+
+PAGE_QUERY = ("SELECT id, name, breed, size, gender, description FROM post "
+              "WHERE adoption_stage IN ('active', 'in_process') AND id > ? ORDER BY id LIMIT 20")
+FACETS_QUERY = ("SELECT shelter_id, size, gender, breed, COUNT(*) FROM post "
+                "WHERE adoption_stage IN ('active', 'in_process') GROUP BY 1, 2, 3, 4")
+
+PROFILES = {
+    # Django's defaults: the connection is closed after every request (CONN_MAX_AGE = 0)
+    'default': {'pragmas': {}, 'persistent': False},
+    'production': {'pragmas': settings.SQLITE_PRAGMAS, 'persistent': True},
+}
+
+
+def create_database(path, posts):
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    stages, sizes = ['active', 'in_process', 'completed'], ['XS', 'S', 'M', 'L', 'XL']
+    connection.executemany(
+        'INSERT INTO post (name, breed, size, gender, shelter_id, adoption_stage, description) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(f'dog{i}', f'breed{i % 40}', sizes[i % 5], ['male', 'female'][i % 2], i % 25, stages[i % 3], 'x' * 200)
+         for i in range(posts)],
+    )
+    connection.commit()
+    connection.close()
+
+
+class Worker(threading.Thread):
+    def __init__(self, path, profile, deadline, operation):
+        super().__init__()
+        self.path, self.profile, self.deadline, self.operation = path, profile, deadline, operation
+        self.done = self.errors = 0
+
+    def connect(self):
+        # isolation_level=None: the transactions are started explicitly, like Django's autocommit mode
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        apply_pragmas(connection.cursor(), self.profile['pragmas'])
+        return connection
+
+    def run(self):
+        connection = self.connect() if self.profile['persistent'] else None
+        while time.perf_counter() < self.deadline:
+            current = connection or self.connect()
+            try:
+                self.operation(current)
+                self.done += 1
+            except sqlite3.OperationalError:
+                # "database is locked" after the busy timeout
+                self.errors += 1
+                if current.in_transaction:
+                    current.execute('ROLLBACK')
+            finally:
+                if connection is None:
+                    current.close()
+        if connection is not None:
+            connection.close()
+
+
+def read(connection):
+    connection.execute(PAGE_QUERY, [random.randint(0, 1000)]).fetchall()
+    connection.execute(FACETS_QUERY).fetchall()
+
+
+def write(connection):
+    connection.execute('BEGIN IMMEDIATE')
+    post_id = connection.execute('SELECT id FROM post ORDER BY random() LIMIT 1').fetchone()[0]
+    connection.execute("INSERT INTO comment (post_id, author_id, content, created) "
+                       "VALUES (?, 1, 'Is he good with cats?', datetime('now'))", [post_id])
+    connection.execute('UPDATE post SET adoption_stage = ? WHERE id = ?',
+                       [random.choice(['active', 'in_process']), post_id])
+    connection.execute('COMMIT')
+
+
+def run_profile(profile, args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.sqlite3')
+        create_database(path, args.posts)
+        deadline = time.perf_counter() + args.duration
+        readers = [Worker(path, profile, deadline, read) for _ in range(args.readers)]
+        writers = [Worker(path, profile, deadline, write) for _ in range(args.writers)]
+        for worker in readers + writers:
+            worker.start()
+        for worker in readers + writers:
+            worker.join()
+    return (sum(worker.done for worker in readers) / args.duration,
+            sum(worker.done for worker in writers) / args.duration,
+            sum(worker.errors for worker in readers + writers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readers', type=int, default=8, help='number of reader threads')
+    parser.add_argument('--writers', type=int, default=2, help='number of writer threads')
+    parser.add_argument('--duration', type=float, default=5, help='seconds per profile')
+    parser.add_argument('--posts', type=int, default=5000, help='number of posts in the database')
+    args = parser.parse_args()
+
+    print(f"{'profile':<12} {'reads/s':>10} {'writes/s':>10} {'locked errors':>14}")
+    for name, profile in PROFILES.items():
+        reads, writes, errors = run_profile(profile, args)
+        print(f"{name:<12} {reads:>10.0f} {writes:>10.0f} {errors:>14}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Startup benchmark: how long a WSGI worker and a management command take to start when the map renderer
+(Folium, together with jinja2 and branca) is imported lazily, compared to importing it eagerly at startup
+like gui/views.py used to.
+
+Every measurement runs in a fresh interpreter. Usage:
+
+    python benchmarks/startup.py [--runs N]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Loading the URLconf imports all the views, as the first request to a worker does
+WSGI_BOOT = (
+    "from Watchdog.wsgi import application\n"
+    "import Watchdog.urls\n"
+)
+
+MANAGE_PY_CHECK = (
+    "import runpy, sys\n"
+    "sys.argv = ['manage.py', 'check']\n"
+    "runpy.run_path('manage.py', run_name='__main__')\n"
+)
+
+SCENARIOS = {
+    'WSGI worker boot': WSGI_BOOT,
+    'manage.py check': MANAGE_PY_CHECK,
+}
+
+
+def measure(code, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=BASE_DIR, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='number of runs per measurement (the median is shown)')
+    args = parser.parse_args()
+
+    print(f"{'scenario':<20} {'eager folium':>14} {'lazy (current)':>16} {'saving':>10}")
+    for name, code in SCENARIOS.items():
+        eager = measure('import folium\n' + code, args.runs)
+        lazy = measure(code, args.runs)
+        print(f"{name:<20} {eager * 1000:>11.1f} ms {lazy * 1000:>13.1f} ms {(eager - lazy) * 1000:>7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
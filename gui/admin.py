@@ -1,8 +1,11 @@
-from django.contrib import admin
-from .models import CustomUser, Comment, PostSubscription, Notification
+from django.contrib import admin, messages
+from django.http import HttpResponseRedirect
+from .models import AdoptionStageConflict, CustomUser, Comment, PostSubscription, Notification, NotificationJob
+from .models import NotificationDigest
 from .models import RegistrationCode
 from .models import Shelter
 from .models import DogAdoptionPost
+from .forms import DogAdoptionPostForm
 
 
 class CustomUserAdmin(admin.ModelAdmin):
@@ -23,11 +26,43 @@ class ShelterAdmin(admin.ModelAdmin):
     search_fields = ('name', 'working_hours', 'phone', 'user')
 
 
+class DogAdoptionPostAdminForm(DogAdoptionPostForm):
+    # All the fields, with the stage the change form was shown with (see DogAdoptionPostForm)
+    class Meta(DogAdoptionPostForm.Meta):
+        fields = '__all__'
+
+
 class DogAdoptionPostAdmin(admin.ModelAdmin):
+    form = DogAdoptionPostAdminForm
     ordering = ('name',)
     list_display = ('name', 'age', 'gender', 'shelter', 'adoption_stage')
     search_fields = ('code', 'username')
 
+    def save_model(self, request, obj, form, change):
+        # A changed stage is saved with a compare-and-set update (see DogAdoptionPost.transition_stage),
+        # so an edit based on an outdated stage is rejected instead of silently overwriting it
+        try:
+            super().save_model(request, obj, form, change)
+        except AdoptionStageConflict:
+            obj.stage_conflict = True
+            self.message_user(request, f'The adoption stage of "{obj}" was changed by someone else. '
+                                       f'Nothing was saved, please review the post and try again.', messages.ERROR)
+
+    def save_related(self, request, form, formsets, change):
+        if not getattr(form.instance, 'stage_conflict', False):
+            super().save_related(request, form, formsets, change)
+
+    def log_change(self, request, obj, message):
+        # Nothing was saved, so there is no change to record in the history of the post
+        if not getattr(obj, 'stage_conflict', False):
+            return super().log_change(request, obj, message)
+
+    def response_change(self, request, obj):
+        if getattr(obj, 'stage_conflict', False):
+            # Reload the change form with the current data instead of reporting success
+            return HttpResponseRedirect(request.path)
+        return super().response_change(request, obj)
+
 
 class CommentAdmin(admin.ModelAdmin):
     list_display = ('display_author', 'display_post', 'content',)
@@ -60,8 +95,19 @@ class PostSubscriptionAdmin(admin.ModelAdmin):
 
 
 class NotificationAdmin(admin.ModelAdmin):
-    list_display = ('recipient', 'message', 'is_read', 'related_post')
-    list_filter = ('is_read', 'recipient')
+    list_display = ('recipient', 'message', 'kind', 'repeat_count', 'is_read', 'related_post', 'created')
+    list_filter = ('kind', 'recipient')
+    list_select_related = ('recipient', 'related_post')
+
+
+class NotificationJobAdmin(admin.ModelAdmin):
+    list_display = ('post', 'message', 'status', 'attempts', 'claimed_at')
+    list_filter = ('status',)
+
+
+class NotificationDigestAdmin(admin.ModelAdmin):
+    list_display = ('user', 'emailed_up_to_id', 'last_sent_at', 'attempts', 'next_attempt_at')
+    list_select_related = ('user',)
 
 
 admin.site.register(CustomUser, CustomUserAdmin)
@@ -71,3 +117,5 @@ admin.site.register(DogAdoptionPost, DogAdoptionPostAdmin)
 admin.site.register(Comment, CommentAdmin)
 admin.site.register(PostSubscription, PostSubscriptionAdmin)
 admin.site.register(Notification, NotificationAdmin)
+admin.site.register(NotificationJob, NotificationJobAdmin)
+admin.site.register(NotificationDigest, NotificationDigestAdmin)
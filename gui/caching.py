@@ -0,0 +1,48 @@
+"""
+Versioned cache namespaces.
+
+Every namespace has a version number stored in the cache and every key in the namespace includes it. Instead of
+finding and deleting all the keys of a namespace when the underlying data changes, the version is bumped, so
+the old entries are simply never read again (and eventually get evicted).
+"""
+import time
+
+from django.core.cache import cache
+
+from .routers import primary_reads
+
+
+def _version_key(namespace):
+    return f'gui:{namespace}:version'
+
+
+def get_version(namespace):
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        # The version starts from the current time, so a namespace whose version was evicted
+        # from the cache can't go back to a number that old (stale) entries still use
+        cache.add(_version_key(namespace), time.time_ns(), timeout=None)
+        version = cache.get(_version_key(namespace))
+    return version
+
+
+def bump_version(namespace):
+    try:
+        cache.incr(_version_key(namespace))
+    except ValueError:
+        # The version isn't in the cache, so there is nothing to invalidate
+        cache.add(_version_key(namespace), time.time_ns(), timeout=None)
+
+
+def versioned_key(namespace, *parts):
+    return ':'.join(['gui', namespace, str(get_version(namespace))] + [str(part) for part in parts])
+
+
+def get_or_set(namespace, name, build, timeout=None):
+    """Return the cached value of 'name' in 'namespace', calling 'build' to compute it on a cache miss.
+    'build' reads from the primary: the value is shared and kept until the version is bumped, so one built
+    from a replica that hasn't caught up with the write behind the bump would stay outdated"""
+    def build_from_primary():
+        with primary_reads():
+            return build()
+    return cache.get_or_set(versioned_key(namespace, name), build_from_primary, timeout=timeout)
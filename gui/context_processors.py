@@ -0,0 +1,14 @@
+from django.conf import settings
+
+
+def unread_notifications(request):
+    """The number of unread notifications for the badge in the header. It's a column of the user's row, which
+    the authentication middleware loads anyway, so the badge costs no query"""
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {}
+    return {
+        'unread_notification_count': user.unread_notification_count,
+        'notification_transport': settings.NOTIFICATION_TRANSPORT,
+        'notification_poll_interval_ms': settings.NOTIFICATION_POLL_INTERVAL * 1000,
+    }
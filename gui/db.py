@@ -0,0 +1,36 @@
+"""
+Tuning of the SQLite connections (see the SQLITE_PRAGMAS setting). With DB_PROFILE=production the pragmas are set
+on every new connection by a connection_created receiver (signals.py):
+
+- journal_mode=WAL: readers don't block the writer and the writer doesn't block readers. The setting is stored
+  in the database file, the other pragmas only last as long as the connection.
+- synchronous=NORMAL: with WAL the database can't be corrupted by a crash, only the last transactions can be lost
+  on a power failure. Commits don't wait for an fsync.
+- mmap_size, cache_size: read the database through a memory map and keep more pages in the page cache.
+- busy_timeout: wait for a lock instead of failing with "database is locked" at once.
+
+The setup cost of a connection (opening the file, these pragmas, an empty cache) is paid once per connection,
+so they are kept between requests with CONN_MAX_AGE.
+"""
+import re
+
+from django.conf import settings
+
+PRAGMA_NAME_RE = re.compile(r'^[a-z_]+$')
+
+
+def pragma_statements(pragmas):
+    statements = []
+    for name, value in pragmas.items():
+        if not PRAGMA_NAME_RE.match(name):
+            raise ValueError(f'Invalid pragma name: {name!r}')
+        if not isinstance(value, int) and not PRAGMA_NAME_RE.match(str(value)):
+            raise ValueError(f'Invalid value of pragma {name}: {value!r}')
+        statements.append(f'PRAGMA {name} = {value}')
+    return statements
+
+
+def apply_pragmas(cursor, pragmas=None):
+    """Set 'pragmas' (SQLITE_PRAGMAS by default) with the DB-API 'cursor' of a SQLite connection"""
+    for statement in pragma_statements(settings.SQLITE_PRAGMAS if pragmas is None else pragmas):
+        cursor.execute(statement)
@@ -0,0 +1,132 @@
+"""
+Email digests of unread notifications.
+
+Instead of one email per notification, every user gets at most one email per NOTIFICATION_DIGEST_WINDOW with all
+the notifications they haven't read or been emailed yet. A user is due when the oldest of those notifications
+is older than the window, so the notifications of a busy period end up in the same email. The digests are sent
+in batches of NOTIFICATION_DIGEST_BATCH_SIZE users over one connection to the mail server per batch.
+
+The state of every user is a NotificationDigest row: the id of the newest notification that was emailed and,
+after a failed delivery, the number of attempts and the time of the next one (exponential backoff).
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Count, Exists, F, OuterRef, Q, Window
+from django.db.models.functions import Coalesce, Greatest, RowNumber
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Notification, NotificationDigest
+
+
+def due_users(now=None):
+    """The users with an email address that have a digest to send at 'now'"""
+    now = now or timezone.now()
+    window_start = now - timedelta(seconds=settings.NOTIFICATION_DIGEST_WINDOW)
+    # Notifications above both the read watermark and the last emailed one are pending
+    pending = Notification.objects.filter(recipient=OuterRef('pk'), pk__gt=OuterRef('digest_after_id'))
+    return (get_user_model().objects.exclude(email='')
+            .annotate(digest_after_id=Greatest('last_read_notification_id',
+                                               Coalesce('notification_digest__emailed_up_to_id', 0)))
+            .filter(Exists(pending.filter(created__lte=window_start)))
+            .filter(Q(notification_digest__next_attempt_at__isnull=True)
+                    | Q(notification_digest__next_attempt_at__lte=now))
+            .select_related('notification_digest')
+            .order_by('pk'))
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the 'attempts'-th failed delivery: doubled after every failure, up to a limit"""
+    return min(settings.NOTIFICATION_DIGEST_RETRY_DELAY * 2 ** (attempts - 1),
+               settings.NOTIFICATION_DIGEST_MAX_RETRY_DELAY)
+
+
+def pending_notifications(users):
+    """The newest NOTIFICATION_DIGEST_MAX_ITEMS pending notifications of each of 'users' (from due_users(), newest
+    first), each annotated with the number of all the pending notifications of its recipient as 'pending_count'.
+    The rows are numbered per user with a window function, so a user with a long backlog costs no more than
+    the limit"""
+    pending = Q()
+    for user in users:
+        pending |= Q(recipient_id=user.pk, pk__gt=user.digest_after_id)
+    return (Notification.objects.filter(pending)
+            # Read in the meantime
+            .filter(pk__gt=F('recipient__last_read_notification_id'))
+            .annotate(position=Window(RowNumber(), partition_by=F('recipient_id'), order_by=F('pk').desc()),
+                      pending_count=Window(Count('pk'), partition_by=F('recipient_id')))
+            .filter(position__lte=settings.NOTIFICATION_DIGEST_MAX_ITEMS)
+            .order_by('recipient_id', '-pk'))
+
+
+def build_message(user, newest, pending_count, connection):
+    body = render_to_string('notification_digest_email.txt', {
+        'user': user,
+        'notifications': newest,
+        'not_shown': pending_count - len(newest),
+        'notifications_url': settings.SITE_URL + reverse('notifications'),
+    })
+    subject = f'You have {pending_count} new notification{"s" if pending_count != 1 else ""} on Watchdog'
+    return EmailMessage(subject, body, to=[user.email], connection=connection)
+
+
+def send_batch(users, now):
+    """Send the digests of 'users' over one connection and store the outcome of every one of them"""
+    newest = {user.pk: [] for user in users}
+    for notification in pending_notifications(users):
+        newest[notification.recipient_id].append(notification)
+
+    sent, failed = [], []
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+        connection_error = None
+    except Exception as e:
+        connection_error = e
+
+    try:
+        for user in users:
+            if not newest[user.pk]:
+                continue
+            try:
+                if connection_error is not None:
+                    raise connection_error
+                build_message(user, newest[user.pk], newest[user.pk][0].pending_count, connection).send()
+            except Exception as e:
+                previous = getattr(user, 'notification_digest', None)
+                attempts = (previous.attempts if previous else 0) + 1
+                failed.append(NotificationDigest(user=user, attempts=attempts, last_error=repr(e),
+                                                 next_attempt_at=now + timedelta(seconds=retry_delay(attempts))))
+            else:
+                sent.append(NotificationDigest(user=user, emailed_up_to_id=newest[user.pk][0].pk,
+                                               last_sent_at=now))
+    finally:
+        connection.close()
+
+    # The state of the whole batch is written with (at most) two INSERT ... ON CONFLICT DO UPDATE statements
+    NotificationDigest.objects.bulk_create(
+        sent, update_conflicts=True, unique_fields=['user'],
+        update_fields=['emailed_up_to_id', 'last_sent_at', 'attempts', 'next_attempt_at', 'last_error'],
+    )
+    NotificationDigest.objects.bulk_create(
+        failed, update_conflicts=True, unique_fields=['user'],
+        update_fields=['attempts', 'next_attempt_at', 'last_error'],
+    )
+    return len(sent)
+
+
+def send_digests(batch_size=None, now=None):
+    """Send all the due digests. Return the number of sent emails"""
+    batch_size = batch_size or settings.NOTIFICATION_DIGEST_BATCH_SIZE
+    now = now or timezone.now()
+    sent = 0
+    last_user_id = 0
+    while True:
+        users = list(due_users(now).filter(pk__gt=last_user_id)[:batch_size])
+        if not users:
+            return sent
+        sent += send_batch(users, now)
+        last_user_id = users[-1].pk
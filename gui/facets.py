@@ -0,0 +1,73 @@
+"""
+Per-option counts for the filter sidebar of the index page ("Large (42)", "Female (117)", ...).
+
+The count of every option reflects the other active filters, but not the filter of its own facet, so that
+choosing a size still shows how many dogs there are of the other sizes. All the counts are computed from one
+grouped aggregate query over the combinations of (shelter, size, gender, breed).
+"""
+from collections import Counter
+
+from django.db.models import Count
+
+from .forms import breed_choices, shelter_choices
+from .models import DogAdoptionPost
+
+# Facet name (the name of the SortFilterForm field) -> the column it's grouped by
+FACETS = {
+    'shelter': 'shelter_id',
+    'size': 'size',
+    'gender': 'gender',
+    'breed': 'breed',
+}
+
+
+def facet_counts(queryset, active_filters):
+    """
+    Return {facet: Counter(value -> number of posts)} for 'queryset', which must not be filtered by any
+    of the facets yet. 'active_filters' maps facet names to the selected values (empty values are ignored).
+    """
+    active = {facet: value for facet, value in active_filters.items() if facet in FACETS and value not in (None, '')}
+    groups = queryset.order_by().values(*FACETS.values()).annotate(count=Count('pk'))
+
+    counts = {facet: Counter() for facet in FACETS}
+    for group in groups:
+        # The facets whose active filter doesn't match this group
+        mismatched = {facet for facet, value in active.items() if group[FACETS[facet]] != value}
+        for facet, column in FACETS.items():
+            # A group counts for a facet if it matches all the other active filters
+            if not mismatched - {facet}:
+                counts[facet][group[column]] += group['count']
+    return counts
+
+
+def build_facets(request, queryset, active_filters):
+    """Describe the sidebar for the template: every facet with its options, their counts and the URL
+    that selects the option (or clears it, if it's already selected), keeping the other GET parameters"""
+    counts = facet_counts(queryset, active_filters)
+    options = {
+        'shelter': ('Shelter', shelter_choices()),
+        'size': ('Size', DogAdoptionPost.SIZE_CHOICES),
+        'gender': ('Gender', DogAdoptionPost.GENDER_CHOICES),
+        'breed': ('Breed', [(breed, breed) for breed in breed_choices()]),
+    }
+
+    facets = []
+    for facet, (facet_label, choices) in options.items():
+        selected_value = active_filters.get(facet)
+        facet_options = []
+        for value, label in choices:
+            count = counts[facet][value]
+            selected = value == selected_value
+            if not count and not selected:
+                continue
+            query = request.GET.copy()
+            # Choosing a new filter starts over from the first page
+            query.pop('cursor', None)
+            if selected:
+                query.pop(facet, None)
+            else:
+                query[facet] = value
+            facet_options.append({'label': label, 'count': count, 'selected': selected,
+                                  'url': '?' + query.urlencode()})
+        facets.append({'name': facet, 'label': facet_label, 'options': facet_options})
+    return facets
@@ -1,5 +1,8 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django import forms
+
+from . import caching
 from .models import RegistrationCode, DogAdoptionPost, Shelter, Comment
 
 
@@ -36,10 +39,26 @@ class UserRegistrationForm(forms.ModelForm):
 
 
 class DogAdoptionPostForm(forms.ModelForm):
+    # The stage the post had when the form was shown. The stage is changed with a compare-and-set against it
+    # (see DogAdoptionPost.transition_stage), so a change made by someone else while the form was open is
+    # neither undone nor overwritten. Forms posted without it compare against the stage read with the POST
+    shown_adoption_stage = forms.ChoiceField(choices=DogAdoptionPost.ADOPTION_STAGE_CHOICES, required=False,
+                                             widget=forms.HiddenInput())
+
     class Meta:
         model = DogAdoptionPost
         fields = ['name', 'age', 'gender', 'breed', 'description', 'image', 'size', 'adoption_stage']
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.fields['shown_adoption_stage'].initial = self.instance.adoption_stage
+
+    def save(self, commit=True):
+        if self.instance.pk and self.cleaned_data.get('shown_adoption_stage'):
+            self.instance._loaded_adoption_stage = self.cleaned_data['shown_adoption_stage']
+        return super().save(commit=commit)
+
 
 class ShelterForm(forms.ModelForm):
     class Meta:
@@ -53,19 +72,63 @@ class ShelterForm(forms.ModelForm):
         }
 
 
+# Cache namespace of the option lists of SortFilterForm. The handlers in signals.py
+# bump its version whenever a post or a shelter is saved or deleted
+FILTER_CHOICES_NAMESPACE = 'filter-choices'
+
+
+def breed_choices():
+    # Get the unique breeds from dog adoption posts (flat=True is used so the data is not returned as
+    # tuples of only one element like so: [('breed1',)...('breedN',)])
+    return caching.get_or_set(FILTER_CHOICES_NAMESPACE, 'breeds', lambda: [
+        breed for breed in DogAdoptionPost.objects.values_list('breed', flat=True).distinct().order_by('breed')
+        if breed
+    ])
+
+
+def shelter_choices():
+    return caching.get_or_set(FILTER_CHOICES_NAMESPACE, 'shelters', lambda: list(
+        Shelter.objects.order_by('name', 'pk').values_list('pk', 'name')
+    ))
+
+
 class SortFilterForm(forms.Form):
-    shelter = forms.ModelChoiceField(queryset=Shelter.objects.all(), required=False, empty_label="All Shelters")
+    # Full-text search over the name, breed and description of the posts
+    q = forms.CharField(required=False, label='Search', max_length=200)
+    # The shelter is chosen by id (the choices are initialized in __init__ from the cache),
+    # so building the form doesn't load all the shelters from the database
+    shelter = forms.TypedChoiceField(choices=[], coerce=int, empty_value=None, required=False)
     size = forms.ChoiceField(choices=[('', 'All')] + DogAdoptionPost.SIZE_CHOICES, required=False)
     breed = forms.ChoiceField(choices=[], required=False)  # The choices for this field will be initialized in __init__
     gender = forms.ChoiceField(choices=[('', 'All'), ('male', 'Male'), ('female', 'Female')], required=False)
-    sort_by = forms.ChoiceField(choices=[('name', 'Name'), ('age', 'Age'), ('size', 'Size')], required=False)
+    sort_by = forms.ChoiceField(choices=[('name', 'Name'), ('age', 'Age'), ('size', 'Size'), ('distance', 'Distance')],
+                                required=False)
+    # The location of the user (filled in by the browser) and how far from it the shelters can be
+    latitude = forms.FloatField(required=False, min_value=-90, max_value=90, widget=forms.HiddenInput())
+    longitude = forms.FloatField(required=False, min_value=-180, max_value=180, widget=forms.HiddenInput())
+    radius_km = forms.FloatField(required=False, min_value=0, label='Within (km)')
 
     def __init__(self, *args, **kwargs):
         super(SortFilterForm, self).__init__(*args, **kwargs)
-        # Get the unique breeds from dog adoption posts (flat=True is used so the data is not returned as
-        # tuples of only one element like so: [('breed1',)...('breedN',)])
-        unique_breeds = DogAdoptionPost.objects.values_list('breed', flat=True).distinct()
-        self.fields['breed'].choices = [('', 'All')] + [(breed, breed) for breed in unique_breeds if breed]
+        self.fields['shelter'].choices = [('', 'All Shelters')] + shelter_choices()
+        self.fields['breed'].choices = [('', 'All')] + [(breed, breed) for breed in breed_choices()]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        # Shown above the listing when the distance options had to be ignored
+        self.location_notice = None
+        has_location = cleaned_data.get('latitude') is not None and cleaned_data.get('longitude') is not None
+        if not has_location:
+            # Only the distance options are dropped (the default order is used), an error would make the page
+            # ignore the other filters and the search too
+            if cleaned_data.get('sort_by') == 'distance' or cleaned_data.get('radius_km') is not None:
+                self.location_notice = "Share your location to sort and search by distance."
+            if cleaned_data.get('sort_by') == 'distance':
+                cleaned_data['sort_by'] = ''
+            cleaned_data['radius_km'] = None
+        elif cleaned_data.get('radius_km') is None:
+            cleaned_data['radius_km'] = settings.DEFAULT_SEARCH_RADIUS_KM
+        return cleaned_data
 
 
 class CommentForm(forms.ModelForm):
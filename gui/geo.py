@@ -0,0 +1,97 @@
+"""
+Distance lookups over shelters and over the listing entries of the posts (which carry the coordinates of their
+shelter).
+
+Every query first narrows the rows down with a bounding box around the point (a range condition on the indexed
+latitude/longitude columns of Shelter and ListingEntry) and then computes the exact great-circle (haversine)
+distance in the database only for the rows inside the box.
+"""
+import math
+
+from django.db.models import F, Value
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+
+from .models import Shelter
+
+# Mean radius of the Earth
+EARTH_RADIUS_KM = 6371.0088
+
+# The largest possible distance between two points on Earth, used to stop the k-nearest search
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in kilometres between two points given in degrees"""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = (math.sin(dlat / 2) ** 2
+         + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def bounding_box(lat, lon, radius_km):
+    """
+    Return (min_lat, max_lat, min_lon, max_lon) of a box that contains every point within 'radius_km' of
+    (lat, lon). The longitude range is None when the box reaches a pole or crosses the 180th meridian,
+    in which case only the latitude can be used to narrow down the rows.
+    """
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat, max_lat = lat - dlat, lat + dlat
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90.0), min(max_lat, 90.0), None, None
+
+    dlon = math.degrees(radius_km / (EARTH_RADIUS_KM * math.cos(math.radians(lat))))
+    min_lon, max_lon = lon - dlon, lon + dlon
+    if min_lon < -180 or max_lon > 180:
+        return min_lat, max_lat, None, None
+    return min_lat, max_lat, min_lon, max_lon
+
+
+def distance_expression(lat, lon):
+    """Haversine distance (in km) from (lat, lon) to the 'latitude' and 'longitude' columns as an ORM expression"""
+    latitude, longitude = F('latitude'), F('longitude')
+    a = (Power(Sin(Radians(latitude - lat) / 2), 2)
+         + Cos(Radians(Value(lat))) * Cos(Radians(latitude)) * Power(Sin(Radians(longitude - lon) / 2), 2))
+    return Value(2 * EARTH_RADIUS_KM) * ASin(Sqrt(a))
+
+
+def _box_filter(lat, lon, radius_km):
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+    conditions = {'latitude__range': (min_lat, max_lat)}
+    if min_lon is not None:
+        conditions['longitude__range'] = (min_lon, max_lon)
+    return conditions
+
+
+def within(queryset, lat, lon, radius_km):
+    """Filter 'queryset' down to the rows within 'radius_km' of (lat, lon), annotated with 'distance_km'"""
+    return (queryset.filter(**_box_filter(lat, lon, radius_km))
+            .annotate(distance_km=distance_expression(lat, lon))
+            .filter(distance_km__lte=radius_km))
+
+
+def nearest(queryset, lat, lon, k, start_radius_km=5.0):
+    """
+    Return the 'k' rows closest to (lat, lon), closest first. The search radius starts small and is doubled
+    until 'k' rows are found, so only the rows around the point are ever compared.
+    """
+    radius_km = start_radius_km
+    while True:
+        candidates = within(queryset, lat, lon, radius_km)
+        if radius_km >= MAX_DISTANCE_KM or candidates.count() >= k:
+            return list(candidates.order_by('distance_km', 'pk')[:k])
+        radius_km *= 2
+
+
+def shelters_within(lat, lon, radius_km):
+    return within(Shelter.objects.all(), lat, lon, radius_km).order_by('distance_km', 'pk')
+
+
+def nearest_shelters(lat, lon, k):
+    return nearest(Shelter.objects.all(), lat, lon, k)
+
+
+def listings_within(queryset, lat, lon, radius_km):
+    """Listing entries (see listings.py) whose shelter is within 'radius_km' of (lat, lon). The entries
+    carry the coordinates of their shelter"""
+    return within(queryset, lat, lon, radius_km)
@@ -0,0 +1,131 @@
+"""
+Resized variants of the photos of dog adoption posts.
+
+The cards on the listing pages show the photo as a 200x200 square, so for every uploaded photo square thumbnails
+are generated in WebP and JPEG at every width in IMAGE_VARIANT_WIDTHS (1x and 2x for high density screens).
+Their names are stored in DogAdoptionPost.image_variants as {format: {width: name}}.
+"""
+import hashlib
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import router, transaction
+from django.db.models import Q
+
+from PIL import Image, ImageOps
+
+from . import listings
+from .models import DogAdoptionPost, StoredFile
+
+# Variant format -> (Pillow format, file extension, save options)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def variant_name(image_name, width, extension, digest):
+    """'dogs/rex.png' -> 'thumbs/dogs/rex-200-<digest>.webp', where 'digest' is the hash of the variant's content.
+    The name of the photo makes the variant belong to it (see storage.py), the digest changes when the variant is
+    built differently (e.g. with other quality settings), so the name can be cached forever"""
+    stem, _ = os.path.splitext(image_name)
+    return f'thumbs/{stem}-{width}-{digest}.{extension}'
+
+
+def save_variant(storage, name, content):
+    save_derived = getattr(storage, 'save_derived', None)
+    if save_derived is not None:
+        return save_derived(name, content)
+    return storage.save(name, content)
+
+
+def build_variants(image):
+    """Generate and store the variants of 'image' (a FieldFile) and return their names"""
+    storage = image.storage
+    with image.open('rb') as file:
+        picture = Image.open(file)
+        # Apply the rotation from the EXIF data, since the metadata isn't kept in the variants
+        picture = ImageOps.exif_transpose(picture).convert('RGB')
+
+    variants = {}
+    for variant_format, (pillow_format, extension, options) in VARIANT_FORMATS.items():
+        variants[variant_format] = {}
+        for width in settings.IMAGE_VARIANT_WIDTHS:
+            thumbnail = ImageOps.fit(picture, (width, width), Image.Resampling.LANCZOS)
+            buffer = BytesIO()
+            thumbnail.save(buffer, pillow_format, **options)
+            content = buffer.getvalue()
+
+            name = variant_name(image.name, width, extension, hashlib.sha256(content).hexdigest())
+            variants[variant_format][str(width)] = save_variant(storage, name, ContentFile(content))
+    return variants
+
+
+def delete_variants(storage, variants):
+    for names in variants.values():
+        for name in names.values():
+            storage.delete(name)
+
+
+def release(storage, image_name, variants, delete_image=True):
+    """
+    Delete the photo 'image_name' that a post no longer uses (the post is being deleted or has another photo),
+    together with 'variants' built from it, unless another post still uses the same photo. Identical photos are
+    stored once (see storage.py), and so are their variants, whose names are derived from the name of the photo.
+    With delete_image=False the post keeps the photo and only the variants are deleted, unless another post has
+    the photo too.
+
+    Nothing is deleted before the transaction that changed the post commits: if it's rolled back, the post still
+    has its photo.
+    """
+    using = router.db_for_write(StoredFile)
+    transaction.on_commit(lambda: _release(storage, image_name, variants, delete_image, using), using=using)
+
+
+def _release(storage, image_name, variants, delete_image, using):
+    if not image_name:
+        delete_variants(storage, variants)
+        return
+    with transaction.atomic(using=using):
+        # A post being saved with the same photo holds the lock until it's committed (see StoredFile), so it's
+        # either counted here or stores the photo again after it has been deleted
+        StoredFile.lock(image_name, using=using)
+        if DogAdoptionPost.objects.using(using).filter(image=image_name).count() > (0 if delete_image else 1):
+            return
+        delete_variants(storage, variants)
+        if delete_image:
+            storage.delete(image_name)
+            # Saving the photo again creates a new row
+            StoredFile.objects.using(using).filter(name=image_name).delete()
+
+
+def refresh_variants(post, old_variants, old_image_name=None):
+    """Replace the variants of 'post' after its photo has changed (or has been removed). 'old_image_name'
+    is the previous photo, which is deleted if no other post uses it"""
+    storage = post.image.storage
+    post.image_variants = build_variants(post.image) if post.image else {}
+    # update() is used so that saving the variant names doesn't send the model signals a second time. The names
+    # are only stored while the post still has the photo they were built from (it may have been edited again)
+    posts = type(post).objects.filter(pk=post.pk)
+    posts = posts.filter(image=post.image.name) if post.image else posts.filter(Q(image='') | Q(image__isnull=True))
+    if posts.update(image_variants=post.image_variants):
+        listings.set_image_variants(post.pk, post.image_variants)
+
+    if old_image_name and old_image_name != post.image.name:
+        release(storage, old_image_name, old_variants)
+    else:
+        # The same photo: only the variants that weren't built again (e.g. of a removed width) are stale
+        current = {name for names in post.image_variants.values() for name in names.values()}
+        stale = {variant_format: {width: name for width, name in names.items() if name not in current}
+                 for variant_format, names in old_variants.items()}
+        release(storage, post.image.name, stale, delete_image=False)
+
+
+def srcset(post, variant_format):
+    """The value of the 'srcset' attribute of a post's photo in the given format ('' if there are no variants)"""
+    names = post.image_variants.get(variant_format, {}) if post.image_variants else {}
+    storage = post.image.storage
+    widths = sorted(names, key=int)
+    return ', '.join(f'{storage.url(names[width])} {width}w' for width in widths)
@@ -0,0 +1,100 @@
+"""
+Maintenance of the listing read model (ListingEntry).
+
+Every change that affects a card on the listing pages is copied to the entries incrementally, with one statement:
+a saved post rewrites its own entry, a change of the adoption stage or of the photo variants (both written with
+update(), without post_save) updates the column, a saved shelter updates the entries of all its posts, and
+subscribing or unsubscribing changes the subscriber count. The calls come from the model signals (signals.py),
+from subscriptions.py and from images.py.
+
+Changes made around the signals (e.g. QuerySet.update() on the posts, raw SQL, restored backups) are not seen,
+'rebuild_listings' regenerates the whole table after them.
+"""
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import Greatest
+
+from .models import DogAdoptionPost, DogAdoptionPostQuerySet, ListingEntry
+
+# The columns copied from the post and its shelter (everything except the key and the subscriber count)
+ENTRY_FIELDS = ['name', 'age', 'gender', 'breed', 'size', 'size_rank', 'adoption_stage', 'image', 'image_variants',
+                'shelter_id', 'shelter_name', 'owner_id', 'latitude', 'longitude']
+
+
+def shelter_values(shelter):
+    if shelter is None:
+        return {'shelter_id': None, 'shelter_name': '', 'owner_id': None, 'latitude': None, 'longitude': None}
+    return {
+        'shelter_id': shelter.pk,
+        'shelter_name': shelter.name,
+        'owner_id': shelter.user_id,
+        'latitude': shelter.latitude,
+        'longitude': shelter.longitude,
+    }
+
+
+def build_entry(post, subscriber_count=0):
+    return ListingEntry(
+        post_id=post.pk,
+        name=post.name,
+        age=post.age,
+        gender=post.gender,
+        breed=post.breed,
+        size=post.size,
+        size_rank=DogAdoptionPostQuerySet.SIZE_ORDER.get(post.size, 0),
+        adoption_stage=post.adoption_stage,
+        image=post.image.name if post.image else '',
+        image_variants=post.image_variants or {},
+        subscriber_count=subscriber_count,
+        **shelter_values(post.shelter),
+    )
+
+
+def refresh_post(post, using=None):
+    """Write the entry of a saved post (INSERT ... ON CONFLICT DO UPDATE). The subscriber count is kept, and
+    so is the stage of an existing entry: the instance may hold an outdated stage, the current one is copied
+    by set_stage() after every transition"""
+    ListingEntry.objects.using(using).bulk_create(
+        [build_entry(post)], update_conflicts=True, unique_fields=['post'],
+        update_fields=[name for name in ENTRY_FIELDS if name != 'adoption_stage'],
+    )
+
+
+def set_stage(post_pk, adoption_stage, using=None):
+    ListingEntry.objects.using(using).filter(post=post_pk).update(adoption_stage=adoption_stage)
+
+
+def set_image_variants(post_pk, image_variants, using=None):
+    ListingEntry.objects.using(using).filter(post=post_pk).update(image_variants=image_variants)
+
+
+def refresh_shelter(shelter, using=None):
+    """Copy the name, the user and the coordinates of a saved shelter to the entries of its posts"""
+    values = shelter_values(shelter)
+    del values['shelter_id']
+    ListingEntry.objects.using(using).filter(shelter_id=shelter.pk).update(**values)
+
+
+def add_subscribers(post_pk, count, using=None):
+    """Change the subscriber count of a post by 'count' (negative when subscriptions were removed)"""
+    ListingEntry.objects.using(using).filter(post=post_pk).update(
+        subscriber_count=Greatest(F('subscriber_count') + count, 0))
+
+
+def rebuild(batch_size=1000):
+    """Regenerate all the entries from the posts. Return their number"""
+    posts = (DogAdoptionPost.objects.select_related('shelter').annotate(subscriber_total=Count('subscribers'))
+             .order_by('pk'))
+    created = 0
+    with transaction.atomic():
+        ListingEntry.objects.all().delete()
+        batch = []
+        for post in posts.iterator(chunk_size=batch_size):
+            batch.append(build_entry(post, post.subscriber_total))
+            if len(batch) == batch_size:
+                ListingEntry.objects.bulk_create(batch)
+                created += len(batch)
+                batch = []
+        ListingEntry.objects.bulk_create(batch)
+        created += len(batch)
+    return created
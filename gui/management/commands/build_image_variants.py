@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from gui import images
+from gui.models import DogAdoptionPost
+
+
+class Command(BaseCommand):
+    help = "Generate the resized variants of the photos of posts that don't have them yet (or of all posts)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="rebuild the variants of every post with a photo")
+
+    def handle(self, *args, **options):
+        posts = DogAdoptionPost.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['all']:
+            posts = posts.filter(image_variants={})
+
+        built = 0
+        for post in posts.only('pk', 'image', 'image_variants').iterator():
+            try:
+                images.refresh_variants(post, post.image_variants)
+            except (OSError, ValueError) as error:
+                # A missing or broken photo shouldn't stop the other posts from being processed
+                self.stderr.write(f"Post {post.pk}: {error}")
+                continue
+            built += 1
+        self.stdout.write(self.style.SUCCESS(f"Built the variants of {built} photo(s)."))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gui import notifications
+
+
+class Command(BaseCommand):
+    help = "Send the notifications waiting in the notification job queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help="keep running and check for new jobs every --interval seconds")
+        parser.add_argument('--interval', type=float, default=2.0)
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="number of notifications written with one INSERT")
+
+    def handle(self, *args, **options):
+        while True:
+            processed = notifications.process_pending_jobs(batch_size=options['batch_size'])
+            if processed:
+                self.stdout.write(f"Processed {processed} notification job(s).")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from gui import notifications
+
+
+class Command(BaseCommand):
+    help = "Delete read notifications older than --days days in small batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.NOTIFICATION_RETENTION_DAYS)
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="number of notifications deleted in one transaction")
+        parser.add_argument('--pause', type=float, default=0,
+                            help="seconds to wait between the batches")
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(days=options['days'])
+        deleted = notifications.purge_read(older_than, batch_size=options['batch_size'], pause=options['pause'])
+        self.stdout.write(f"Deleted {deleted} read notification(s) older than {options['days']} day(s).")
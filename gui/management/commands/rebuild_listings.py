@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from gui import listings
+
+
+class Command(BaseCommand):
+    help = "Regenerate the listing read model (ListingEntry) from the posts, their shelters and subscriptions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="number of entries per INSERT")
+
+    def handle(self, *args, **options):
+        created = listings.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(f"Rebuilt {created} listing entr{'y' if created == 1 else 'ies'}.")
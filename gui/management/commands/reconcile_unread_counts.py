@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from gui import notifications
+
+
+class Command(BaseCommand):
+    help = "Recount the unread notifications of every user and fix the stored counters that have drifted."
+
+    def handle(self, *args, **options):
+        corrected = notifications.reconcile_unread_counts()
+        self.stdout.write(f"Corrected the unread notification count of {corrected} user(s).")
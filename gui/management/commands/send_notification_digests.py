@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from gui import digests
+
+
+class Command(BaseCommand):
+    help = "Email every user a digest of the notifications they haven't read yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help="keep running and check for due digests every --interval seconds")
+        parser.add_argument('--interval', type=float, default=60.0)
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="number of digests sent over one connection to the mail server")
+
+    def handle(self, *args, **options):
+        while True:
+            sent = digests.send_digests(batch_size=options['batch_size'])
+            if sent:
+                self.stdout.write(f"Sent {sent} notification digest(s).")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,30 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = ("Copy the SQLite primary database into the SQLite replicas in DATABASE_REPLICAS. "
+            "Stands in for replication when the replicas are tested locally.")
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError("No replica is configured (set DB_REPLICA_NAME).")
+        primary = settings.DATABASES['default']
+        # By vendor, not ENGINE: DB_PROFILE=production uses its own SQLite backend (gui.sqlite_backend)
+        if any(connections[alias].vendor != 'sqlite' for alias in ['default', *settings.DATABASE_REPLICAS]):
+            raise CommandError("Only SQLite databases can be copied, use the replication of the database server.")
+        source = sqlite3.connect(primary['NAME'])
+        try:
+            for alias in settings.DATABASE_REPLICAS:
+                target = sqlite3.connect(settings.DATABASES[alias]['NAME'])
+                try:
+                    # An online backup: the primary can be written to in the meantime
+                    source.backup(target)
+                finally:
+                    target.close()
+                self.stdout.write(f"Copied the primary database to '{alias}'.")
+        finally:
+            source.close()
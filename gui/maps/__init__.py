@@ -0,0 +1,53 @@
+"""
+Map fragments for the shelter pages.
+
+The HTML is produced by a pluggable renderer (see base.MapRenderer) chosen with the MAP_RENDERER setting. The
+renderer's module is imported the first time a map is actually rendered, so importing the views (and therefore
+starting a worker, running a management command or the tests) doesn't pull in Folium and its dependencies.
+
+Building a map is by far the most expensive part of rendering a shelter page, so the resulting HTML is cached.
+The cache key contains everything the map depends on (the renderer and the shelter's pk, coordinates and name),
+so editing any of them makes the page use a new key and the map is rendered again; otherwise it is never rebuilt.
+The map under the previous key is deleted when the shelter is saved or deleted (see signals.py).
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from .base import Marker
+
+# Renderer instances, created on first use
+_renderers = {}
+
+
+def get_renderer(path=None):
+    path = path or settings.MAP_RENDERER
+    if path not in _renderers:
+        _renderers[path] = import_string(path)()
+    return _renderers[path]
+
+
+def shelter_map_key(shelter):
+    # The name is hashed, since it may contain characters that some cache backends don't allow in keys
+    name_hash = hashlib.md5(shelter.name.encode()).hexdigest()
+    return (f'gui:shelter-map:{settings.MAP_RENDERER}:{shelter.pk}:'
+            f'{shelter.latitude!r}:{shelter.longitude!r}:{name_hash}')
+
+
+def render_shelter_map(shelter):
+    return get_renderer().render(
+        latitude=shelter.latitude,
+        longitude=shelter.longitude,
+        zoom=15,
+        markers=[Marker(shelter.latitude, shelter.longitude, shelter.name)],
+    )
+
+
+def shelter_map_html(shelter):
+    return cache.get_or_set(shelter_map_key(shelter), lambda: render_shelter_map(shelter), timeout=None)
+
+
+def forget_shelter_map(shelter):
+    cache.delete(shelter_map_key(shelter))
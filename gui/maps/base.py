@@ -0,0 +1,14 @@
+from collections import namedtuple
+
+Marker = namedtuple('Marker', ['latitude', 'longitude', 'tooltip'])
+
+
+class MapRenderer:
+    """
+    Interface of the map renderers. A renderer turns a map description into an HTML fragment that is
+    inserted into a page as it is. Renderers are created once per process and must not keep per-map state.
+    """
+
+    def render(self, latitude, longitude, zoom, markers):
+        """Return the HTML of a map centered on (latitude, longitude) showing 'markers' (a list of Marker)"""
+        raise NotImplementedError
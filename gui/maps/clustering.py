@@ -0,0 +1,92 @@
+"""
+Server-side clustering of the shelters for the city-wide map.
+
+The map is split into the standard Web Mercator (slippy map) tiles. For every tile the shelters inside it are put
+into a grid of CLUSTER_GRID x CLUSTER_GRID cells and the shelters that share a cell are merged into one cluster, so
+a tile never contains more than CLUSTER_GRID ** 2 markers however many shelters there are.
+"""
+import math
+
+from django.conf import settings
+from django.db.models import Count, Q
+from django.urls import reverse
+
+from .. import caching
+from ..models import Shelter
+
+# Cache namespace of the shelter points and the tiles. The handlers in signals.py bump
+# its version whenever a shelter or a post is saved or deleted
+SHELTER_POINTS_NAMESPACE = 'shelter-points'
+
+MAX_ZOOM = 19
+
+
+class InvalidTile(ValueError):
+    pass
+
+
+def tile_position(latitude, longitude, zoom):
+    """Return the (fractional) tile coordinates of a point at the given zoom level"""
+    # Web Mercator can't show the poles, so the latitude is clamped to the range it covers
+    latitude = max(min(latitude, 85.05112878), -85.05112878)
+    tiles = 2 ** zoom
+    x = (longitude + 180.0) / 360.0 * tiles
+    lat_rad = math.radians(latitude)
+    y = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * tiles
+    # Points on the right or bottom edge of the world belong to the last tile
+    return min(x, tiles - 1e-9), min(y, tiles - 1e-9)
+
+
+def shelter_points():
+    """The location of every shelter together with the number of its active and in process posts,
+    computed with one aggregate query and cached until a shelter or a post changes"""
+    def build():
+        available = Count('dogadoptionpost', filter=Q(dogadoptionpost__adoption_stage__in=['active', 'in_process']))
+        return list(Shelter.objects.annotate(dogs=available).order_by('pk')
+                    .values('pk', 'name', 'latitude', 'longitude', 'dogs'))
+    return caching.get_or_set(SHELTER_POINTS_NAMESPACE, 'points', build)
+
+
+def cluster_tile(points, zoom, x, y, grid=None):
+    """Group the points inside tile (zoom, x, y) into at most grid x grid markers"""
+    grid = grid or settings.CLUSTER_GRID
+    cells = {}
+    for point in points:
+        tile_x, tile_y = tile_position(point['latitude'], point['longitude'], zoom)
+        if int(tile_x) != x or int(tile_y) != y:
+            continue
+        cell = (int((tile_x - x) * grid), int((tile_y - y) * grid))
+        cells.setdefault(cell, []).append(point)
+
+    markers = []
+    for cell in sorted(cells):
+        members = cells[cell]
+        if len(members) == 1:
+            point = members[0]
+            markers.append({
+                'id': point['pk'],
+                'name': point['name'],
+                'lat': point['latitude'],
+                'lon': point['longitude'],
+                'dogs': point['dogs'],
+                'url': reverse('shelter_details', kwargs={'pk': point['pk']}),
+            })
+        else:
+            # A cluster is shown at the average position of its shelters
+            markers.append({
+                'lat': sum(point['latitude'] for point in members) / len(members),
+                'lon': sum(point['longitude'] for point in members) / len(members),
+                'count': len(members),
+                'dogs': sum(point['dogs'] for point in members),
+            })
+    return markers
+
+
+def tile(zoom, x, y):
+    """Return the cached JSON-ready content of a tile"""
+    if not 0 <= zoom <= MAX_ZOOM or not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+        raise InvalidTile((zoom, x, y))
+
+    def build():
+        return {'z': zoom, 'x': x, 'y': y, 'markers': cluster_tile(shelter_points(), zoom, x, y)}
+    return caching.get_or_set(SHELTER_POINTS_NAMESPACE, f'tile:{zoom}:{x}:{y}', build)
@@ -0,0 +1,13 @@
+import folium
+
+from .base import MapRenderer
+
+
+class FoliumRenderer(MapRenderer):
+    """Render the map with Folium. The whole Leaflet document is generated on the server and embedded in an iframe"""
+
+    def render(self, latitude, longitude, zoom, markers):
+        m = folium.Map(location=[latitude, longitude], zoom_start=zoom)
+        for marker in markers:
+            folium.Marker([marker.latitude, marker.longitude], tooltip=marker.tooltip).add_to(m)
+        return m._repr_html_()
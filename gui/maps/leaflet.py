@@ -0,0 +1,36 @@
+import uuid
+
+from django.templatetags.static import static
+from django.utils.html import format_html, json_script
+
+from .base import MapRenderer
+
+LEAFLET_CSS = 'https://unpkg.com/leaflet@1.9.4/dist/leaflet.css'
+LEAFLET_JS = 'https://unpkg.com/leaflet@1.9.4/dist/leaflet.js'
+
+
+class LeafletRenderer(MapRenderer):
+    """
+    Render the map as a small fragment: an empty element, the map description as JSON and the script
+    (static/leaflet_maps.js) that draws it with Leaflet in the browser. It has no Python dependencies.
+    """
+
+    def render(self, latitude, longitude, zoom, markers):
+        element_id = f'map-{uuid.uuid4().hex}'
+        data = {
+            'latitude': latitude,
+            'longitude': longitude,
+            'zoom': zoom,
+            'markers': [{'latitude': marker.latitude, 'longitude': marker.longitude, 'tooltip': marker.tooltip}
+                        for marker in markers],
+        }
+        return format_html(
+            '<link rel="stylesheet" href="{}">'
+            '<script src="{}"></script>'
+            '<script src="{}"></script>'
+            '<div id="{}" class="leaflet-map" style="height: 100%;"></div>'
+            '{}'
+            '<script>renderMarkerMap("{}", "{}-data");</script>',
+            LEAFLET_CSS, LEAFLET_JS, static('leaflet_maps.js'), element_id,
+            json_script(data, f'{element_id}-data'), element_id, element_id,
+        )
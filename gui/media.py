@@ -0,0 +1,159 @@
+"""
+Serving of the uploaded files (MEDIA_URL).
+
+The files stored by ContentAddressedStorage never change, so they are sent with a far-future 'immutable'
+Cache-Control header and their content hash as a strong ETag. A browser that still has a file doesn't ask for it
+again, and one that revalidates anyway gets a 304 without the file being opened.
+
+Django only decides whether a file may be served. With MEDIA_ACCEL set, sending the bytes is left to the front
+proxy: nginx ('nginx', an 'X-Accel-Redirect' to an internal location at MEDIA_ACCEL_PREFIX) or Apache/lighttpd
+('sendfile', 'X-Sendfile' with the path of the file). Otherwise the file is sent with a FileResponse, which WSGI
+servers can pass to sendfile(), with support for conditional and Range requests.
+
+The photos are public on purpose: the dog and shelter detail pages, which show them, don't require a login either.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, quote_etag
+
+from .storage import hashed_name_digest
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Files with names that don't change with their content (uploaded before the content-addressed storage)
+MUTABLE_CACHE_CONTROL = 'public, max-age=3600'
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+def public_path(path):
+    """
+    Return the normalised path if it's in one of the directories the app uploads to, None otherwise. Anything else
+    under MEDIA_ROOT isn't served, also when it's reached through '..' from a public directory.
+    """
+    path = posixpath.normpath(path)
+    if path.startswith('/') or '..' in path.split('/'):
+        return None
+    if path.split('/', 1)[0] not in settings.MEDIA_PUBLIC_DIRS:
+        return None
+    return path
+
+
+def file_etag(path, stat):
+    digest = hashed_name_digest(path)
+    if digest is not None:
+        return quote_etag(digest)
+    return quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+
+
+def parse_range(header, size):
+    """
+    Return the (start, end) byte positions (inclusive) of a 'Range: bytes=...' header, None if the header
+    should be ignored (the whole file is sent then) or False if the range can't be satisfied.
+    Only a single range is supported, a request for several ranges gets the whole file.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # The last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def read_range(file, start, end):
+    with file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def accel_response(path, full_path):
+    """Hand the file over to the front proxy. Return None when the proxy can't be given its path"""
+    response = HttpResponse()
+    if settings.MEDIA_ACCEL == 'nginx':
+        # nginx decodes the URI, which keeps spaces, '%', '?' and non-ASCII names (uploaded before the
+        # content-addressed storage) out of the header, where Django would RFC 2047-encode the latter
+        response['X-Accel-Redirect'] = quote(settings.MEDIA_ACCEL_PREFIX + path)
+    elif full_path.isascii():
+        response['X-Sendfile'] = full_path
+    else:
+        # X-Sendfile is a file system path, which isn't decoded, so Django sends the file itself
+        return None
+    # The proxy sets the type from the file, Django's default 'text/html' must not reach the client
+    del response['Content-Type']
+    return response
+
+
+def file_response(request, full_path, size, etag):
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    # A range is only sent if the file is still the version the client has the rest of
+    if range_header and (not if_range or etag in parse_etags(if_range)):
+        byte_range = parse_range(range_header, size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(read_range(open(full_path, 'rb'), start, end), status=206)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = str(end - start + 1)
+            return response
+    return FileResponse(open(full_path, 'rb'))
+
+
+def serve_media(request, path):
+    path = public_path(path)
+    if path is None:
+        raise Http404('File not found')
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('Invalid path')
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404('File not found')
+    if not os.path.isfile(full_path):
+        raise Http404('File not found')
+
+    etag = file_etag(path, stat)
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        if settings.MEDIA_ACCEL:
+            response = accel_response(path, full_path)
+        if response is None:
+            response = file_response(request, full_path, stat.st_size, etag)
+            content_type, _ = mimetypes.guess_type(full_path)
+            response['Content-Type'] = content_type or 'application/octet-stream'
+        response['Accept-Ranges'] = 'bytes'
+        response['Last-Modified'] = http_date(stat.st_mtime)
+
+    response['ETag'] = etag
+    response['Cache-Control'] = (IMMUTABLE_CACHE_CONTROL if hashed_name_digest(path) is not None
+                                 else MUTABLE_CACHE_CONTROL)
+    return response
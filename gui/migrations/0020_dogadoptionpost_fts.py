@@ -0,0 +1,37 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+FTS_TABLE = 'gui_dogadoptionpost_fts'
+
+
+def create_search_index(apps, schema_editor):
+    """Create the FTS5 shadow table for the posts and fill it with the existing posts. Nothing is done if
+    the database isn't SQLite or if SQLite was built without FTS5 (gui.search then falls back to the ORM)"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            cursor.execute(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                           f"name, breed, description, tokenize='unicode61 remove_diacritics 2')")
+        except OperationalError:
+            return
+        cursor.execute(f'INSERT INTO {FTS_TABLE} (rowid, name, breed, description) '
+                       f'SELECT id, name, breed, description FROM gui_dogadoptionpost')
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0019_notification_related_post'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
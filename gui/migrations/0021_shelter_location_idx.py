@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0020_dogadoptionpost_fts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='shelter',
+            index=models.Index(fields=['latitude', 'longitude'], name='shelter_location_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 12:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0021_shelter_location_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dogadoptionpost',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
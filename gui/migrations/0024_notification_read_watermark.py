@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:12
+
+from django.db import migrations, models
+from django.db.models import F, Max, Min, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def is_read_to_watermark(apps, schema_editor):
+    """
+    Move the watermark of every user to just before their oldest unread notification (or to their newest
+    notification if all of them are read). Read notifications newer than an unread one become unread again,
+    which is the only way to express the old state without losing any unread notification.
+    """
+    CustomUser = apps.get_model('gui', 'CustomUser')
+    Notification = apps.get_model('gui', 'Notification')
+    notifications = Notification.objects.filter(recipient=OuterRef('pk')).order_by().values('recipient')
+    oldest_unread = notifications.filter(is_read=False).annotate(oldest=Min('pk')).values('oldest')
+    newest = notifications.annotate(newest=Max('pk')).values('newest')
+    CustomUser.objects.update(last_read_notification_id=Coalesce(
+        Subquery(oldest_unread) - 1, Subquery(newest), Value(0)))
+
+
+def watermark_to_is_read(apps, schema_editor):
+    Notification = apps.get_model('gui', 'Notification')
+    Notification.objects.update(is_read=False)
+    Notification.objects.filter(pk__lte=F('recipient__last_read_notification_id')).update(is_read=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0023_notificationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='last_read_notification_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(is_read_to_watermark, watermark_to_is_read),
+        migrations.RemoveField(
+            model_name='notification',
+            name='is_read',
+        ),
+    ]
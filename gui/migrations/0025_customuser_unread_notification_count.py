@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:17
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_unread_notifications(apps, schema_editor):
+    CustomUser = apps.get_model('gui', 'CustomUser')
+    Notification = apps.get_model('gui', 'Notification')
+    CustomUser.objects.update(unread_notification_count=Coalesce(Subquery(
+        Notification.objects.filter(recipient=OuterRef('pk'), pk__gt=OuterRef('last_read_notification_id'))
+        .order_by().values('recipient').annotate(count=Count('pk')).values('count')
+    ), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0024_notification_read_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='unread_notification_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread_notifications, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:21
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0025_customuser_unread_notification_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='created',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['recipient', '-created'], name='notification_inbox_idx'),
+        ),
+    ]
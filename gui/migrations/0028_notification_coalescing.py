@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0027_notificationdigest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='kind',
+            field=models.CharField(choices=[('message', 'Message'), ('available', 'Available for adoption')], default='message', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='repeat_count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='notificationjob',
+            name='kind',
+            field=models.CharField(choices=[('message', 'Message'), ('available', 'Available for adoption')], default='message', max_length=20),
+        ),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(fields=('recipient', 'related_post', 'kind'), name='notification_unique_per_post'),
+        ),
+    ]
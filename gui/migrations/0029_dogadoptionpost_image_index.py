@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0028_notification_coalescing'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dogadoptionpost',
+            name='image',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to='dogs/'),
+        ),
+    ]
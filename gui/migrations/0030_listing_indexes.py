@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0029_dogadoptionpost_image_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='notification',
+            name='notification_inbox_idx',
+        ),
+        migrations.AddIndex(
+            model_name='dogadoptionpost',
+            index=models.Index(fields=['adoption_stage', 'id'], name='post_stage_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dogadoptionpost',
+            index=models.Index(fields=['adoption_stage', 'shelter', 'size', 'gender', 'breed'], name='post_facets_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dogadoptionpost',
+            index=models.Index(fields=['adoption_stage', 'size', 'gender'], name='post_size_gender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dogadoptionpost',
+            index=models.Index(fields=['breed'], name='post_breed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['recipient', '-created', '-id'], name='notification_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='postsubscription',
+            index=models.Index(fields=['user', 'post'], name='subscription_user_post_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shelter',
+            index=models.Index(fields=['name'], name='shelter_name_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 13:58
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def delete_duplicate_subscriptions(apps, schema_editor):
+    # Concurrent requests to the old subscribe view could subscribe a user to a post twice. The oldest row is kept
+    PostSubscription = apps.get_model('gui', 'PostSubscription')
+    first_ids = PostSubscription.objects.values('user', 'post').annotate(first_id=Min('pk')).values('first_id')
+    PostSubscription.objects.exclude(pk__in=first_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0030_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_subscriptions, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='postsubscription',
+            name='subscription_user_post_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='postsubscription',
+            constraint=models.UniqueConstraint(fields=('user', 'post'), name='subscription_unique_user_post'),
+        ),
+    ]
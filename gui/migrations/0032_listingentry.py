@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-17 14:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+SIZE_ORDER = {'XS': 1, 'S': 2, 'M': 3, 'L': 4, 'XL': 5}
+
+
+def build_listing_entries(apps, schema_editor):
+    DogAdoptionPost = apps.get_model('gui', 'DogAdoptionPost')
+    ListingEntry = apps.get_model('gui', 'ListingEntry')
+    posts = DogAdoptionPost.objects.select_related('shelter').annotate(subscriber_count=Count('subscribers'))
+    entries = []
+    for post in posts.iterator():
+        shelter = post.shelter
+        entries.append(ListingEntry(
+            post_id=post.pk, name=post.name, age=post.age, gender=post.gender, breed=post.breed, size=post.size,
+            size_rank=SIZE_ORDER.get(post.size, 0), adoption_stage=post.adoption_stage,
+            image=post.image.name if post.image else '', image_variants=post.image_variants or {},
+            shelter_id=shelter.pk if shelter else None, shelter_name=shelter.name if shelter else '',
+            owner_id=shelter.user_id if shelter else None, latitude=shelter.latitude if shelter else None,
+            longitude=shelter.longitude if shelter else None, subscriber_count=post.subscriber_count,
+        ))
+    ListingEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0031_subscription_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListingEntry',
+            fields=[
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='listing_entry', serialize=False, to='gui.dogadoptionpost')),
+                ('name', models.CharField(max_length=255)),
+                ('age', models.PositiveIntegerField()),
+                ('gender', models.CharField(choices=[('male', 'Male'), ('female', 'Female')], max_length=6)),
+                ('breed', models.CharField(max_length=255)),
+                ('size', models.CharField(choices=[('XS', 'Extra Small'), ('S', 'Small'), ('M', 'Medium'), ('L', 'Large'), ('XL', 'Extra Large')], max_length=2)),
+                ('size_rank', models.PositiveSmallIntegerField()),
+                ('adoption_stage', models.CharField(choices=[('active', 'Active'), ('in_process', 'In Process'), ('completed', 'Completed')], max_length=20)),
+                ('image', models.ImageField(blank=True, null=True, upload_to='dogs/')),
+                ('image_variants', models.JSONField(blank=True, default=dict)),
+                ('shelter_id', models.BigIntegerField(null=True)),
+                ('shelter_name', models.CharField(blank=True, max_length=255)),
+                ('owner_id', models.BigIntegerField(null=True)),
+                ('latitude', models.FloatField(null=True)),
+                ('longitude', models.FloatField(null=True)),
+                ('subscriber_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['adoption_stage', 'post'], name='listing_stage_idx'), models.Index(fields=['adoption_stage', 'shelter_id', 'size', 'gender', 'breed'], name='listing_facets_idx'), models.Index(fields=['adoption_stage', 'size_rank'], name='listing_size_rank_idx'), models.Index(fields=['breed'], name='listing_breed_idx'), models.Index(fields=['latitude', 'longitude'], name='listing_location_idx'), models.Index(fields=['shelter_id'], name='listing_shelter_idx')],
+            },
+        ),
+        migrations.RunPython(build_listing_entries, migrations.RunPython.noop),
+    ]
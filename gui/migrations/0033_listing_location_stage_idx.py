@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0032_listingentry'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='listingentry',
+            name='listing_location_idx',
+        ),
+        migrations.AddIndex(
+            model_name='listingentry',
+            index=models.Index(fields=['adoption_stage', 'latitude', 'longitude'], name='listing_location_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 15:21
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0033_listing_location_stage_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='dogadoptionpost',
+            name='post_stage_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='dogadoptionpost',
+            name='post_facets_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='dogadoptionpost',
+            name='post_size_gender_idx',
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-17 16:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0034_drop_unused_post_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostSearchDocument',
+            fields=[
+                ('post', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_document', serialize=False, to='gui.dogadoptionpost')),
+                ('document', models.TextField(db_column='gui_dogadoptionpost_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'gui_dogadoptionpost_fts',
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui', '0036_storedfile'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='listingentry',
+            name='listing_stage_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='listingentry',
+            name='listing_facets_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='listingentry',
+            name='listing_size_rank_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='listingentry',
+            name='listing_location_idx',
+        ),
+        migrations.AddField(
+            model_name='listingentry',
+            name='archived',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(adoption_stage='completed', then=1), default=0), output_field=models.PositiveSmallIntegerField()),
+        ),
+        migrations.AddIndex(
+            model_name='listingentry',
+            index=models.Index(fields=['archived', 'post'], name='listing_stage_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listingentry',
+            index=models.Index(fields=['archived', 'name', 'post'], name='listing_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listingentry',
+            index=models.Index(fields=['archived', 'age', 'post'], name='listing_age_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listingentry',
+            index=models.Index(fields=['archived', 'size_rank', 'post'], name='listing_size_rank_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listingentry',
+            index=models.Index(fields=['archived', 'shelter_id', 'size', 'gender', 'breed'], name='listing_facets_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listingentry',
+            index=models.Index(fields=['archived', 'latitude', 'longitude'], name='listing_location_idx'),
+        ),
+    ]
@@ -1,7 +1,18 @@
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import Case, Exists, OuterRef, When
+from django.dispatch import Signal
 from django.urls import reverse
+from django.utils import timezone
+
+# Sent after the adoption stage of a post has actually changed in the database,
+# with the arguments 'post', 'old_stage' and 'new_stage'
+adoption_stage_changed = Signal()
+
+
+class AdoptionStageConflict(Exception):
+    """The adoption stage of a post was changed by someone else after the post was loaded"""
 
 
 class CustomUser(AbstractUser):
@@ -11,6 +22,12 @@ class CustomUser(AbstractUser):
     )
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default='ordinary')
     registration_code = models.CharField(max_length=100, blank=True, null=True)
+    # The id of the newest notification the user has seen. Every notification with a bigger id is unread, so
+    # marking all of them as read is a write to this single row (see notifications.mark_read)
+    last_read_notification_id = models.PositiveBigIntegerField(default=0)
+    # The number of notifications above the watermark, kept up to date when notifications are written and read,
+    # so the badge in the header doesn't have to count them. 'reconcile_unread_counts' corrects any drift
+    unread_notification_count = models.PositiveIntegerField(default=0)
 
 
 class RegistrationCode(models.Model):
@@ -35,6 +52,14 @@ class Shelter(models.Model):
     latitude = models.FloatField(default=0.0)
     longitude = models.FloatField(default=0.0)
 
+    class Meta:
+        # Distance lookups (see geo.py) narrow the shelters down with a range condition on the coordinates
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='shelter_location_idx'),
+            # The list of shelters in the filter form
+            models.Index(fields=['name'], name='shelter_name_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -42,6 +67,30 @@ class Shelter(models.Model):
         return reverse('details', kwargs={'pk': self.pk})
 
 
+class ListingQuerySetMixin:
+    """Filters of the listing pages, shared by the posts and their listing entries (both are keyed by the id
+    of the post, so the subscriptions match either of them)"""
+
+    def visible(self):
+        """Posts shown on the index page (the dog hasn't been adopted yet)"""
+        return self.filter(adoption_stage__in=['active', 'in_process'])
+
+    def archived(self):
+        """Posts shown on the archive page (the dog has found a home)"""
+        return self.filter(adoption_stage='completed')
+
+    def with_subscription_flag(self, user):
+        # A correlated EXISTS subquery replaces the one query per post that was needed before
+        subscriptions = PostSubscription.objects.filter(user=user.pk, post=OuterRef('pk'))
+        return self.annotate(user_is_subscribed=Exists(subscriptions))
+
+
+class DogAdoptionPostQuerySet(ListingQuerySetMixin, models.QuerySet):
+    # Each size is assigned a number so that posts can be ordered from the smallest to the largest dog
+    # (copied to ListingEntry.size_rank)
+    SIZE_ORDER = {'XS': 1, 'S': 2, 'M': 3, 'L': 4, 'XL': 5}
+
+
 class DogAdoptionPost(models.Model):
     GENDER_CHOICES = [
         ('male', 'Male'),
@@ -68,16 +117,152 @@ class DogAdoptionPost(models.Model):
     breed = models.CharField(max_length=255)
     description = models.TextField(blank=True)
     shelter = models.ForeignKey(Shelter, on_delete=models.CASCADE, null=True)
-    image = models.ImageField(upload_to='dogs/', blank=True, null=True)
+    # Stored by content hash (see storage.py). Indexed, because the file can only be deleted when no other post uses it
+    image = models.ImageField(upload_to='dogs/', blank=True, null=True, db_index=True)
+    # Names of the resized copies of 'image' (see images.py)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     size = models.CharField(max_length=2, choices=SIZE_CHOICES, default='M')
     adoption_stage = models.CharField(max_length=20, choices=ADOPTION_STAGE_CHOICES, default='active')
 
+    objects = DogAdoptionPostQuerySet.as_manager()
+
+    class Meta:
+        # The listing pages read ListingEntry, which has the indexes of their queries. The plans of the
+        # queries are checked by QueryPlanTests
+        indexes = [
+            # The list of breeds of the filter form
+            models.Index(fields=['breed'], name='post_breed_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
     def get_absolute_url(self):
         return reverse('details', kwargs={'pk': self.pk})
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stage the post had when it was loaded (unless the field was deferred),
+        # so that save() knows whether it changed without reading the row again
+        instance._loaded_adoption_stage = instance.__dict__.get('adoption_stage')
+        # The same for the photo, whose variants are rebuilt when it's replaced (see signals.refresh_image_variants)
+        if 'image' in instance.__dict__:
+            instance._loaded_image_name = instance.__dict__['image'] or None
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        # The reloaded values are what the database has now, so save() compares with them
+        if fields is None or 'adoption_stage' in fields:
+            self._loaded_adoption_stage = self.__dict__.get('adoption_stage')
+        if (fields is None or 'image' in fields) and 'image' in self.__dict__:
+            self._loaded_image_name = self.image.name or None
+
+    def transition_stage(self, new_stage, expected=None):
+        """
+        Change the adoption stage with a compare-and-set UPDATE ... WHERE adoption_stage = 'expected' (by default
+        the stage the post had when it was loaded). If the stage in the database is different (another user has
+        changed it in the meantime), nothing is written and AdoptionStageConflict is raised. adoption_stage_changed
+        is sent only when the row was actually updated.
+        """
+        if expected is None:
+            expected = getattr(self, '_loaded_adoption_stage', None) or self.adoption_stage
+        if new_stage == expected:
+            return
+        updated = type(self).objects.filter(pk=self.pk, adoption_stage=expected).update(adoption_stage=new_stage)
+        if not updated:
+            raise AdoptionStageConflict(f'The adoption stage of post {self.pk} is no longer "{expected}".')
+        self.adoption_stage = new_stage
+        self._loaded_adoption_stage = new_stage
+        adoption_stage_changed.send(sender=type(self), post=self, old_stage=expected, new_stage=new_stage)
+
+    def save(self, *args, **kwargs):
+        # A new photo is stored in the same transaction as the post, so the lock of the stored file (see StoredFile)
+        # is held until the post is committed, and a post that used the same photo can't delete it in the meantime
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(type(self), instance=self)):
+            self._save(*args, **kwargs)
+
+    def _save(self, *args, **kwargs):
+        loaded_stage = getattr(self, '_loaded_adoption_stage', None)
+        update_fields = kwargs.get('update_fields')
+        stage_changed = (not self._state.adding and loaded_stage is not None and self.adoption_stage != loaded_stage
+                         and (update_fields is None or 'adoption_stage' in update_fields))
+        if not stage_changed:
+            # Without a loaded stage to compare with, the stage is saved like any other field
+            stage_written = ((self._state.adding or loaded_stage is None)
+                             and (update_fields is None or 'adoption_stage' in update_fields))
+            if not self._state.adding and loaded_stage is not None:
+                # The stage is only ever written by transition_stage(). Writing back the stage this instance was
+                # loaded with would undo a transition made by someone else in the meantime
+                if update_fields is None:
+                    update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key
+                                     and field.attname in self.__dict__]
+                kwargs['update_fields'] = [name for name in update_fields if name != 'adoption_stage']
+            super().save(*args, **kwargs)
+            # A stage that wasn't written must still be compared with the one in the database by the next save
+            if stage_written:
+                self._loaded_adoption_stage = self.adoption_stage
+            return
+
+        # The stage goes through the compare-and-set transition and the other fields are saved normally.
+        # Both happen in one transaction (see save), so on a conflict nothing is saved
+        if update_fields is None:
+            update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+        kwargs['update_fields'] = [name for name in update_fields if name != 'adoption_stage']
+        self.transition_stage(self.adoption_stage, expected=loaded_stage)
+        if kwargs['update_fields']:
+            super().save(*args, **kwargs)
+
+
+class StoredFile(models.Model):
+    """
+    A file stored by ContentAddressedStorage, which keeps identical uploads in one file (see storage.py). Its row
+    is locked by every save of the file and by images.release before it checks whether any post still uses the
+    file, so a file can't be deleted while another post is being saved with it. The row is deleted with the file.
+    """
+    name = models.CharField(max_length=255, primary_key=True)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def lock(cls, name, using=None):
+        """Lock the file 'name' until the end of the current transaction. With SQLite the INSERT takes the lock of
+        the whole database, other databases lock the row with SELECT ... FOR UPDATE"""
+        manager = cls.objects.db_manager(using)
+        manager.bulk_create([cls(name=name)], ignore_conflicts=True)
+        list(manager.select_for_update().filter(name=name))
+
+
+class FullTextMatch(models.Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', [*lhs_params, *rhs_params]
+
+
+class PostSearchDocument(models.Model):
+    """
+    The FTS5 table of the posts (created by migration 0020 where FTS5 is available, see search.py), mapped only
+    so a search can be joined to the posts or the listing entries and ordered by its rank in one query.
+    """
+    post = models.OneToOneField(DogAdoptionPost, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid',
+                                db_constraint=False, related_name='search_document')
+    # MATCH is applied to the hidden column named after the table
+    document = models.TextField(db_column='gui_dogadoptionpost_fts')
+    # BM25, smaller is more relevant
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'gui_dogadoptionpost_fts'
+
+
+PostSearchDocument._meta.get_field('document').register_lookup(FullTextMatch)
+
 
 class Comment(models.Model):
     post = models.ForeignKey(DogAdoptionPost, on_delete=models.CASCADE, related_name='comments')
@@ -99,12 +284,153 @@ class PostSubscription(models.Model):
     post = models.ForeignKey(DogAdoptionPost, on_delete=models.CASCADE, related_name='subscribers')
     is_active = models.BooleanField(default=True)
 
+    class Meta:
+        constraints = [
+            # Subscribing is an INSERT ... ON CONFLICT DO NOTHING on these columns (see subscriptions.py). The index
+            # behind the constraint also answers "is the user subscribed to this post?" on the listings
+            models.UniqueConstraint(fields=['user', 'post'], name='subscription_unique_user_post'),
+        ]
+
+
+class ListingEntryQuerySet(ListingQuerySetMixin, models.QuerySet):
+    # The entries are filtered by 'archived' (a single value per page) instead of the stages, see ListingEntry.Meta
+
+    def visible(self):
+        return self.filter(archived=0)
+
+    def archived(self):
+        return self.filter(archived=1)
+
+
+class ListingEntry(models.Model):
+    """
+    Read model of the listing pages (index and archive): one row per post with everything its card shows,
+    copied from the post, its shelter and the shelter's user, so a page is read from this table alone.
+    The rows are kept up to date by listings.py (called from the model signals) and can be rebuilt from scratch
+    with the 'rebuild_listings' command. The primary key is the id of the post.
+    """
+    post = models.OneToOneField(DogAdoptionPost, on_delete=models.CASCADE, primary_key=True,
+                                related_name='listing_entry')
+    name = models.CharField(max_length=255)
+    age = models.PositiveIntegerField()
+    gender = models.CharField(max_length=6, choices=DogAdoptionPost.GENDER_CHOICES)
+    breed = models.CharField(max_length=255)
+    size = models.CharField(max_length=2, choices=DogAdoptionPost.SIZE_CHOICES)
+    # DogAdoptionPostQuerySet.SIZE_ORDER, so sorting by size is a plain column sort
+    size_rank = models.PositiveSmallIntegerField()
+    adoption_stage = models.CharField(max_length=20, choices=DogAdoptionPost.ADOPTION_STAGE_CHOICES)
+    # 1 on the archive page, 0 on the index page. Computed by the database from the stage, so the writes in
+    # listings.py only set adoption_stage. Not a boolean, because Django filters by one with 'NOT archived',
+    # which can't be looked up in an index
+    archived = models.GeneratedField(expression=Case(When(adoption_stage='completed', then=1), default=0),
+                                     output_field=models.PositiveSmallIntegerField(), db_persist=True)
+    image = models.ImageField(upload_to='dogs/', blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True)
+    # The shelter and its user, null for a post without a shelter
+    shelter_id = models.BigIntegerField(null=True)
+    shelter_name = models.CharField(max_length=255, blank=True)
+    owner_id = models.BigIntegerField(null=True)
+    latitude = models.FloatField(null=True)
+    longitude = models.FloatField(null=True)
+    subscriber_count = models.PositiveIntegerField(default=0)
+
+    objects = ListingEntryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Each listing page reads a single value of 'archived', so an index that continues with the sort key
+            # returns the page in order without sorting it. The two visible stages (adoption_stage IN (...)) could
+            # not: every stage is a separate range of the index and the rows of both had to be sorted (see
+            # QueryPlanTests)
+            models.Index(fields=['archived', 'post'], name='listing_stage_idx'),
+            models.Index(fields=['archived', 'name', 'post'], name='listing_name_idx'),
+            models.Index(fields=['archived', 'age', 'post'], name='listing_age_idx'),
+            models.Index(fields=['archived', 'size_rank', 'post'], name='listing_size_rank_idx'),
+            models.Index(fields=['archived', 'shelter_id', 'size', 'gender', 'breed'], name='listing_facets_idx'),
+            models.Index(fields=['breed'], name='listing_breed_idx'),
+            # Distance lookups narrow the visible rows down with a range condition on the coordinates (see
+            # geo.py). With 'archived' first SQLite prefers it to the other listing indexes
+            models.Index(fields=['archived', 'latitude', 'longitude'], name='listing_location_idx'),
+            # Updates of a shelter are copied to the rows of its posts
+            models.Index(fields=['shelter_id'], name='listing_shelter_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
 
 class Notification(models.Model):
+    KIND_CHOICES = [
+        ('message', 'Message'),
+        ('available', 'Available for adoption'),
+    ]
+
     recipient = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name='notifications')
     message = models.TextField()
-    is_read = models.BooleanField(default=False)
     related_post = models.ForeignKey(DogAdoptionPost, on_delete=models.CASCADE, related_name='notifications', null=True)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default='message')
+    # How many times the same notification about the post was sent, collapsed into this row (see notifications.py)
+    repeat_count = models.PositiveIntegerField(default=1)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # The inbox of a user, newest first (the id is the tie-breaker of the keyset pagination)
+            models.Index(fields=['recipient', '-created', '-id'], name='notification_inbox_idx'),
+        ]
+        constraints = [
+            # A user has at most one notification of each kind about a post. Notifications
+            # without a post aren't collapsed (NULLs are never equal in a unique constraint)
+            models.UniqueConstraint(fields=['recipient', 'related_post', 'kind'], name='notification_unique_per_post'),
+        ]
 
     def __str__(self):
         return f'Notification recipient: {self.recipient.username} content: {self.message}'
+
+    @property
+    def is_read(self):
+        return self.pk <= self.recipient.last_read_notification_id
+
+
+class NotificationJob(models.Model):
+    """A pending fan-out of one notification to all subscribers of a post. The jobs are stored in the database
+    and processed outside of the request by the 'process_notification_jobs' command (see notifications.py)"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('failed', 'Failed'),
+    ]
+
+    post = models.ForeignKey(DogAdoptionPost, on_delete=models.CASCADE, related_name='notification_jobs')
+    message = models.TextField()
+    kind = models.CharField(max_length=20, choices=Notification.KIND_CHOICES, default='message')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    # The subscriptions are processed in the order of their ids. A job that fails
+    # part of the way continues after the last subscription that was notified
+    last_subscription_id = models.BigIntegerField(default=0)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='notificationjob_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f'Notification job for {self.post.name} ({self.status})'
+
+
+class NotificationDigest(models.Model):
+    """The email digest state of a user: which notifications have already been emailed and, when the last
+    digest couldn't be sent, how many times it was tried and when to try again (see digests.py)"""
+    user = models.OneToOneField(get_user_model(), on_delete=models.CASCADE, related_name='notification_digest')
+    # The id of the newest notification included in a sent digest
+    emailed_up_to_id = models.PositiveBigIntegerField(default=0)
+    last_sent_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Notification digest of {self.user.username}'
@@ -0,0 +1,239 @@
+"""
+Fan-out of notifications to the subscribers of a post.
+
+Changing the status of a post only enqueues a NotificationJob, so the request takes the same time however many
+subscribers the post has. The 'process_notification_jobs' command drains the queue and writes the notifications
+in batches with bulk_create.
+
+Read state is a per-user high-water mark (CustomUser.last_read_notification_id): the notifications of a user
+with a bigger id are unread. Both checking and marking them are cheap however many notifications a user has,
+because the index of the 'recipient' foreign key also orders the rows of every recipient by id.
+The number of unread notifications is stored on the user as well (CustomUser.unread_notification_count) and
+adjusted with the same writes that create or read notifications.
+
+The job worker runs in a process of its own, so its wake-ups (see publish) don't reach the notification streams
+of the web server. Every web server process that has open streams therefore runs one watcher (see
+watch_new_notifications), which looks for notifications with an id above the newest one it has seen and wakes
+up the streams of their recipients.
+"""
+import asyncio
+import traceback
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, connections, router, transaction
+from django.db.models import Count, F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import pubsub
+from .models import Notification, NotificationJob, PostSubscription
+
+
+def unread(user):
+    return user.notifications.filter(pk__gt=user.last_read_notification_id)
+
+
+def mark_read(user, up_to=None):
+    """
+    Mark the notifications of 'user' up to the id 'up_to' (by default all of them) as read by moving the
+    watermark forward with one UPDATE of the user's row. The watermark only ever moves to the id of one of the
+    user's own notifications and never backwards, so a late request from an older page can't undo a newer one.
+    """
+    newest = user.notifications.order_by()
+    if up_to is not None:
+        newest = newest.filter(pk__lte=up_to)
+    newest = Subquery(newest.values('recipient').annotate(newest=Max('pk')).values('newest'))
+    # Notifications newer than the new watermark (e.g. ones that arrived after the page was shown) stay unread
+    still_unread = Subquery(user.notifications.order_by().filter(pk__gt=newest).values('recipient')
+                            .annotate(count=Count('pk')).values('count'))
+    get_user_model().objects.filter(pk=user.pk, last_read_notification_id__lt=newest).update(
+        last_read_notification_id=newest, unread_notification_count=Coalesce(still_unread, 0))
+    user.refresh_from_db(fields=['last_read_notification_id', 'unread_notification_count'])
+
+
+def reconcile_unread_counts():
+    """Recount the unread notifications of all users in one UPDATE and return the number of corrected users"""
+    unread_count = Coalesce(Subquery(
+        Notification.objects.filter(recipient=OuterRef('pk'), pk__gt=OuterRef('last_read_notification_id'))
+        .order_by().values('recipient').annotate(count=Count('pk')).values('count')
+    ), 0)
+    return get_user_model().objects.exclude(unread_notification_count=unread_count).update(
+        unread_notification_count=unread_count)
+
+
+def purge_read(older_than, batch_size=None, pause=0):
+    """
+    Delete the read notifications created before 'older_than', 'batch_size' rows at a time. Every batch is a
+    short transaction of its own (and the loop can 'pause' seconds between them), so SQLite's write lock is
+    never held for long and the other writers can go on. Return the number of deleted notifications.
+    """
+    batch_size = batch_size or settings.NOTIFICATION_PURGE_BATCH_SIZE
+    expired = (Notification.objects.filter(created__lt=older_than, pk__lte=F('recipient__last_read_notification_id'))
+               .order_by('pk').values_list('pk', flat=True))
+    deleted = 0
+    while True:
+        batch = list(expired[:batch_size])
+        if not batch:
+            return deleted
+        deleted += Notification.objects.filter(pk__in=batch).delete()[0]
+        if pause:
+            time.sleep(pause)
+
+
+def publish(user_ids):
+    for user_id in user_ids:
+        pubsub.broker.publish(pubsub.notification_channel(user_id))
+
+
+# The watcher task of every event loop with open notification streams
+_watchers = {}
+
+
+def watch_new_notifications():
+    """Start the watcher of the running event loop, unless it's running already. Called by every opened stream,
+    the watcher stops by itself once the process has no open streams"""
+    loop = asyncio.get_running_loop()
+    watcher = _watchers.get(loop)
+    if watcher is None or watcher.done():
+        _watchers[loop] = loop.create_task(_watch(loop))
+
+
+def _recipients_of_new(after):
+    """The newest id of the notifications after the id 'after' for each of their recipients, or only the newest
+    id of all when 'after' is None. A range scan of the primary key, however many streams are open"""
+    try:
+        if after is None:
+            return Notification.objects.aggregate(newest=Max('pk'))['newest'] or 0
+        return list(Notification.objects.filter(pk__gt=after).order_by().values('recipient_id')
+                    .annotate(newest=Max('pk')).values_list('recipient_id', 'newest'))
+    finally:
+        # The pool's threads are outside the request cycle, which would close the connection
+        close_old_connections()
+
+
+async def _watch(loop):
+    # Not thread-sensitive, for the same reason as the streams' own reads (see views.NotificationEventStream)
+    fetch = sync_to_async(_recipients_of_new, thread_sensitive=False)
+    try:
+        last_id = await fetch(None)
+        while pubsub.broker.subscriber_count() > 0:
+            await asyncio.sleep(settings.SSE_WAKEUP_INTERVAL)
+            for recipient_id, newest in await fetch(last_id):
+                pubsub.broker.publish(pubsub.notification_channel(recipient_id))
+                last_id = max(last_id, newest)
+    finally:
+        if _watchers.get(loop) is asyncio.current_task():
+            del _watchers[loop]
+
+
+def upsert(user_ids, post_id, kind, message):
+    """
+    Give the users 'user_ids' a notification of 'kind' about the post, collapsing it into the unread notification
+    of the same kind about the same post when the user already has one (the new row counts it in 'repeat_count').
+    Must run in a transaction. Return the ids of the users that got a new unread notification.
+
+    A repeat replaces the row it collapses with a new one, so it always gets a new id (with the new message and
+    time): the read watermark, the notification streams and the digests all go by the id, and would take a repeat
+    that kept the id of the collapsed row for one they have already seen.
+    """
+    # A read notification can't become unread again (it's below the watermark), so it's replaced without counting it
+    Notification.objects.filter(recipient_id__in=user_ids, related_post_id=post_id, kind=kind,
+                                pk__lte=F('recipient__last_read_notification_id')).delete()
+
+    connection = connections[router.db_for_write(Notification)]
+    qn = connection.ops.quote_name
+    table = qn(Notification._meta.db_table)
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {table} WHERE recipient_id IN ({placeholders}) AND related_post_id = %s AND kind = %s '
+            f'RETURNING recipient_id, repeat_count',
+            [*user_ids, post_id, kind],
+        )
+        repeats = dict(cursor.fetchall())
+
+        # Another worker can't have inserted the notification since (the DELETE holds the write lock with SQLite),
+        # but where it can the unique constraint on (recipient, related_post, kind) collapses it in place.
+        # A row that comes back with repeat_count = 1 is a new unread notification
+        created = Notification._meta.get_field('created').get_db_prep_value(timezone.now(), connection)
+        values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(user_ids))
+        params = []
+        for user_id in user_ids:
+            params += [user_id, post_id, kind, message, created, repeats.get(user_id, 0) + 1]
+        cursor.execute(
+            f'INSERT INTO {table} (recipient_id, related_post_id, kind, message, created, repeat_count) '
+            f'VALUES {values} '
+            f'ON CONFLICT (recipient_id, related_post_id, kind) DO UPDATE SET '
+            f'repeat_count = {table}.repeat_count + excluded.repeat_count, message = excluded.message, '
+            f'created = excluded.created '
+            f'RETURNING recipient_id, repeat_count',
+            params,
+        )
+        return [recipient_id for recipient_id, repeat_count in cursor.fetchall() if repeat_count == 1]
+
+
+def enqueue(post, message, kind='message'):
+    return NotificationJob.objects.create(post=post, message=message, kind=kind)
+
+
+def claim_next_job(exclude=()):
+    """Take the oldest pending job (or one whose worker seems to have died). The job is claimed with a
+    conditional UPDATE, so when several workers run at the same time every job is processed by only one of them"""
+    stale = timezone.now() - timedelta(seconds=settings.NOTIFICATION_JOB_TIMEOUT)
+    jobs = NotificationJob.objects.exclude(pk__in=exclude).order_by('pk')
+    while True:
+        job = (jobs.filter(status='pending').first()
+               or jobs.filter(status='running', claimed_at__lt=stale).first())
+        if job is None:
+            return None
+        claimed = NotificationJob.objects.filter(pk=job.pk, status=job.status, claimed_at=job.claimed_at).update(
+            status='running', claimed_at=timezone.now(), attempts=job.attempts + 1)
+        if claimed:
+            job.refresh_from_db()
+            return job
+        # Another worker was faster, try the next job
+
+
+def process_job(job, batch_size=None):
+    """Create the notifications of 'job' for all subscribers of its post, 'batch_size' at a time"""
+    batch_size = batch_size or settings.NOTIFICATION_BATCH_SIZE
+    while True:
+        subscriptions = list(PostSubscription.objects.filter(post_id=job.post_id, pk__gt=job.last_subscription_id)
+                             .order_by('pk').values_list('pk', 'user_id')[:batch_size])
+        if not subscriptions:
+            break
+        # Every batch is committed together with the progress of the job, so a batch is never written twice
+        with transaction.atomic():
+            user_ids = [user_id for _, user_id in subscriptions]
+            new_user_ids = upsert(user_ids, job.post_id, job.kind, job.message)
+            get_user_model().objects.filter(pk__in=new_user_ids).update(
+                unread_notification_count=F('unread_notification_count') + 1)
+            # Wake up the open notification streams of the recipients once the batch is committed
+            transaction.on_commit(lambda user_ids=user_ids: publish(user_ids))
+            job.last_subscription_id = subscriptions[-1][0]
+            NotificationJob.objects.filter(pk=job.pk).update(last_subscription_id=job.last_subscription_id)
+    job.delete()
+
+
+def process_pending_jobs(limit=None, batch_size=None):
+    """Process jobs until the queue is empty (or 'limit' jobs are done). Return the number of processed jobs"""
+    processed = 0
+    failed = []
+    while limit is None or processed < limit:
+        job = claim_next_job(exclude=failed)
+        if job is None:
+            break
+        try:
+            process_job(job, batch_size)
+        except Exception:
+            # The job is retried by the next run, unless it has failed too many times
+            failed.append(job.pk)
+            status = 'failed' if job.attempts >= settings.NOTIFICATION_JOB_MAX_ATTEMPTS else 'pending'
+            NotificationJob.objects.filter(pk=job.pk).update(status=status, claimed_at=None,
+                                                             last_error=traceback.format_exc())
+        processed += 1
+    return processed
@@ -0,0 +1,127 @@
+import base64
+import binascii
+import datetime
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder cuts datetimes down to milliseconds, which would make the cursor of a page
+    that ends with a timestamp skip the rows whose timestamps only differ in the microseconds"""
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encode_cursor(values):
+    """Turn the sort key of the last row on a page into an opaque URL-safe token"""
+    raw = json.dumps(values, cls=CursorEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor(cursor)
+    return values
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, has_previous, next_page_url, first_page_url):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.has_previous = has_previous
+        self.next_page_url = next_page_url
+        self.first_page_url = first_page_url
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Cursor (keyset) pagination: instead of OFFSET, every page continues after the sort key of the last row
+    of the previous page ('WHERE (key, pk) > (last_key, last_pk)'), so deep pages cost the same as the first one.
+
+    'ordering' is a list of field or annotation names (a leading '-' means descending) and must end with a unique
+    field (normally 'pk'), otherwise rows with equal keys could be skipped or repeated.
+    """
+
+    def __init__(self, queryset, ordering, per_page=None):
+        self.queryset = queryset
+        self.ordering = list(ordering)
+        self.per_page = per_page or settings.LISTING_PAGE_SIZE
+
+    def _fields(self):
+        return [(field.lstrip('-'), field.startswith('-')) for field in self.ordering]
+
+    def _after(self, values):
+        """Build the condition '(f1, f2, ..., fn) > (v1, v2, ..., vn)' respecting the direction of each field"""
+        condition = Q()
+        equal_so_far = Q()
+        for (name, descending), value in zip(self._fields(), values):
+            lookup = 'lt' if descending else 'gt'
+            condition |= equal_so_far & Q(**{f'{name}__{lookup}': value})
+            equal_so_far &= Q(**{name: value})
+        return condition
+
+    def page(self, cursor=None):
+        queryset = self.queryset.order_by(*self.ordering)
+        if cursor:
+            values = decode_cursor(cursor, len(self.ordering))
+            try:
+                queryset = queryset.filter(self._after(values))
+            except (ValueError, TypeError, ValidationError):
+                # Values of the wrong type for the fields, e.g. a string or null for the pk
+                raise InvalidCursor(cursor)
+
+        # One extra row is fetched to find out whether there is a next page
+        rows = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            next_cursor = encode_cursor([getattr(rows[-1], name) for name, _ in self._fields()])
+        return rows, next_cursor
+
+
+def paginate(request, queryset, ordering, per_page=None):
+    """Return the page requested with the 'cursor' GET parameter. The links to the
+    next and the first page keep all other GET parameters (filters and sorting)"""
+    paginator = KeysetPaginator(queryset, ordering, per_page)
+    cursor = request.GET.get('cursor')
+    try:
+        rows, next_cursor = paginator.page(cursor)
+    except InvalidCursor:
+        # A tampered or outdated cursor shows the first page instead of an error
+        cursor = None
+        rows, next_cursor = paginator.page()
+
+    query = request.GET.copy()
+    query.pop('cursor', None)
+    first_page_url = '?' + query.urlencode()
+    next_page_url = None
+    if next_cursor:
+        query['cursor'] = next_cursor
+        next_page_url = '?' + query.urlencode()
+
+    return KeysetPage(rows, next_cursor, bool(cursor), next_page_url, first_page_url)
@@ -0,0 +1,78 @@
+"""
+In-process publish/subscribe used to wake up the open notification streams (see views.notification_stream).
+
+A subscriber is an asyncio coroutine waiting on an event of its own event loop, so an idle connection costs one
+small object instead of a thread. Publishing is thread-safe: the notification writer can run in a worker thread
+of the same process, and the event is set through the subscriber's loop with call_soon_threadsafe. Only a wake-up
+is sent, the streams then read the new rows from the database themselves. Writers in other processes can't reach
+these subscribers, their notifications are found by the watcher of the process (see
+notifications.watch_new_notifications), which publishes them here.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+
+class Subscription:
+    def __init__(self, channel):
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout):
+        """Wait until something is published on the channel or 'timeout' seconds pass. Return whether it was
+        woken up. Messages published while the subscriber wasn't waiting are not lost, they wake the next wait"""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+
+class Broker:
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        """Must be called from the event loop that will wait on the subscription"""
+        subscription = Subscription(channel)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channel):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.notify()
+            except RuntimeError:
+                # The loop of the subscriber has been closed
+                self.unsubscribe(subscription)
+
+    def subscriber_count(self, channel=None):
+        """The number of subscribers of 'channel', or of all channels"""
+        with self._lock:
+            if channel is None:
+                return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+            return len(self._subscriptions.get(channel, ()))
+
+
+broker = Broker()
+
+
+def notification_channel(user_id):
+    return f'notifications:{user_id}'
@@ -0,0 +1,88 @@
+"""
+Reading from database replicas.
+
+The aliases in DATABASE_REPLICAS are read-only copies of 'default' (the primary). Only the views decorated with
+read_from_replica read from them, everything else (all writes, and the reads of the other views, which may be
+about to write) uses the primary. A replica may lag behind the primary, so after a user's own write the user's
+requests read from the primary for REPLICA_PIN_SECONDS: ReadYourWritesMiddleware stores the time in the
+session after every POST, PUT, PATCH and DELETE.
+"""
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+
+PIN_SESSION_KEY = 'read_primary_until'
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get() and settings.DATABASE_REPLICAS:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replicas get the schema from the primary
+        return db == 'default'
+
+
+def is_pinned_to_primary(request):
+    session = getattr(request, 'session', None)
+    return session is not None and session.get(PIN_SESSION_KEY, 0) > time.time()
+
+
+def read_from_replica(view):
+    """Let the view read from a replica, unless the user has written something in the last REPLICA_PIN_SECONDS.
+    A TemplateResponse is rendered inside the view, so the queries made by the template use the replica too"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if is_pinned_to_primary(request):
+            return view(request, *args, **kwargs)
+        token = _replica_reads.set(True)
+        try:
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+            return response
+        finally:
+            _replica_reads.reset(token)
+    return wrapper
+
+
+@contextmanager
+def primary_reads():
+    """Read from the primary inside the block, also in a view decorated with read_from_replica"""
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+class ReadYourWritesMiddleware:
+    """Must come after SessionMiddleware (the session is saved after this middleware has changed it)
+    and AuthenticationMiddleware"""
+    UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        if (settings.DATABASE_REPLICAS and request.method in self.UNSAFE_METHODS
+                and user is not None and user.is_authenticated):
+            request.session[PIN_SESSION_KEY] = time.time() + settings.REPLICA_PIN_SECONDS
+        return response
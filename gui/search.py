@@ -0,0 +1,78 @@
+"""
+Full-text search over the name, breed and description of dog adoption posts.
+
+On SQLite builds with FTS5 the posts are mirrored into a shadow FTS5 table (created by migration 0020 and kept
+in sync by the handlers in signals.py) and results are ranked with BM25. On any other backend, or when FTS5 isn't
+compiled in, the search falls back to plain 'icontains' lookups.
+"""
+import re
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import F, FloatField, Q, Value
+
+from .models import DogAdoptionPost
+
+FTS_TABLE = 'gui_dogadoptionpost_fts'
+
+# Whether the FTS table exists, cached per database alias
+_fts_available = {}
+
+
+def fts5_available(using=DEFAULT_DB_ALIAS):
+    if using not in _fts_available:
+        connection = connections[using]
+        _fts_available[using] = (connection.vendor == 'sqlite'
+                                 and FTS_TABLE in connection.introspection.table_names())
+    return _fts_available[using]
+
+
+def build_match_query(text):
+    """Convert user input into an FTS5 query. Every word is quoted (so characters like '-' or '*' can't break
+    the query syntax) and the last word is matched as a prefix, so results show up while the user is typing"""
+    terms = re.findall(r'\w+', text.lower())
+    if not terms:
+        return ''
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def index_post(post, using=DEFAULT_DB_ALIAS):
+    if not fts5_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [post.pk])
+        cursor.execute(f'INSERT INTO {FTS_TABLE} (rowid, name, breed, description) VALUES (%s, %s, %s, %s)',
+                       [post.pk, post.name, post.breed, post.description])
+
+
+def remove_post(post_pk, using=DEFAULT_DB_ALIAS):
+    if not fts5_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [post_pk])
+
+
+def search(queryset, text):
+    """
+    Narrow 'queryset' down to the posts matching 'text' and annotate each of them with 'search_rank'
+    (smaller is more relevant), so the results can be ordered (and paginated) by relevance in the database.
+    The matches aren't cut down to the best ones first: the stage and the filters of the page are conditions
+    of the same query, so every matching post that passes them can be paged through.
+    """
+    if fts5_available(queryset.db):
+        match = build_match_query(text)
+        if not match:
+            return queryset.none().annotate(search_rank=Value(0.0, output_field=FloatField()))
+        # The rows can be posts or listing entries (which are keyed by the post)
+        document = 'search_document' if queryset.model is DogAdoptionPost else 'post__search_document'
+        return (queryset.filter(**{f'{document}__document__match': match})
+                .annotate(search_rank=F(f'{document}__rank')))
+
+    # The matching posts are found by id, so 'queryset' can also be over the listing entries (which are keyed
+    # by the id of the post and don't have the description)
+    text = text.strip()
+    matching = DogAdoptionPost.objects.filter(
+        Q(name__icontains=text) | Q(breed__icontains=text) | Q(description__icontains=text)
+    )
+    return queryset.filter(pk__in=matching.values('pk')).annotate(search_rank=Value(0.0, output_field=FloatField()))
@@ -1,9 +1,14 @@
-from django.db.models.signals import post_save
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
 from django.urls import reverse
 
-from .models import CustomUser, Shelter, DogAdoptionPost, Notification
-from django.db.models.signals import pre_save
+from . import caching, db, images, listings, maps, notifications, search
+from .forms import FILTER_CHOICES_NAMESPACE
+from .maps.clustering import SHELTER_POINTS_NAMESPACE
+from .models import CustomUser, Shelter, DogAdoptionPost, PostSubscription, adoption_stage_changed
 
 
 # 'post_save' is a signal Django sends after a model's 'save' method is called
@@ -17,23 +22,125 @@ def create_shelter_for_new_shelter_user(sender, instance, created, **kwargs):
         Shelter.objects.create(user=instance)
 
 
-@receiver(pre_save, sender=DogAdoptionPost)  # The function will be called right before a DogAdoptionPost is saved
-def notify_subscribers_on_status_change(sender, instance, **kwargs):
-    """Notify subscribers when a DogAdoptionPost's status is changed to 'active'"""
-    # If instance has a primary key it exists in the database (it was already saved in the database)
-    if instance.pk:
-        try:
-            previous = DogAdoptionPost.objects.get(pk=instance.pk)
-
-            if previous.adoption_stage == 'in_process' and instance.adoption_stage == 'active':
-                # Get all subscriptions for the post (pairs of user-post,
-                # along with a boolean value to check for activation)
-                all_post_subscriptions = instance.subscribers.all()
-
-                for subscription in all_post_subscriptions:
-                    Notification.objects.create(
-                        recipient=subscription.user,
-                        message=f'{instance.name} is available for adoption.'
-                    )
-        except DogAdoptionPost.DoesNotExist:
-            pass
+@receiver(adoption_stage_changed, sender=DogAdoptionPost)
+def notify_subscribers_on_status_change(sender, post, old_stage, new_stage, **kwargs):
+    """Notify subscribers when a DogAdoptionPost's status is changed from 'in_process' to 'active'"""
+    # The signal is only sent when the stage has really changed in the database (see
+    # DogAdoptionPost.transition_stage), so the post doesn't have to be read again here
+    if old_stage == 'in_process' and new_stage == 'active':
+        # Only a job is queued here, the notifications themselves are written by
+        # the 'process_notification_jobs' command, outside of the current request
+        notifications.enqueue(post, f'{post.name} is available for adoption.', kind='available')
+
+
+@receiver(post_save, sender=DogAdoptionPost)
+def update_search_index(sender, instance, using, **kwargs):
+    """Keep the full-text search index in sync with the post"""
+    search.index_post(instance, using=using)
+
+
+@receiver(post_delete, sender=DogAdoptionPost)
+def remove_from_search_index(sender, instance, using, **kwargs):
+    search.remove_post(instance.pk, using=using)
+
+
+@receiver(post_save, sender=DogAdoptionPost)
+def update_listing_entry(sender, instance, using, **kwargs):
+    """Keep the listing read model in sync with the post (the entry of a deleted post is deleted by CASCADE)"""
+    listings.refresh_post(instance, using=using)
+
+
+@receiver(post_save, sender=DogAdoptionPost)
+def refresh_image_variants(sender, instance, created, raw, update_fields, using, **kwargs):
+    """
+    Build the variants of a new photo and delete the ones of the photo it replaced. The photo is compared with the
+    one the post was loaded with, so it doesn't matter how the post was saved (the post forms, the admin, which
+    saves the form with commit=False, or the ORM). The variants are built after the commit: resizing doesn't hold
+    the write lock, and a photo that can't be decoded doesn't undo the edit (the post is left without variants,
+    'build_image_variants' can retry)
+    """
+    if raw or (update_fields is not None and 'image' not in update_fields):
+        return
+    image_name = instance.image.name or None
+    if created:
+        if image_name:
+            transaction.on_commit(lambda: images.refresh_variants(instance, {}), using=using, robust=True)
+    elif hasattr(instance, '_loaded_image_name') and instance._loaded_image_name != image_name:
+        old_variants, old_image_name = dict(instance.image_variants or {}), instance._loaded_image_name
+        transaction.on_commit(lambda: images.refresh_variants(instance, old_variants, old_image_name),
+                              using=using, robust=True)
+    instance._loaded_image_name = image_name
+
+
+@receiver(adoption_stage_changed, sender=DogAdoptionPost)
+def update_listing_stage(sender, post, new_stage, **kwargs):
+    listings.set_stage(post.pk, new_stage)
+
+
+@receiver(post_save, sender=Shelter)
+def update_shelter_listing_entries(sender, instance, using, **kwargs):
+    listings.refresh_shelter(instance, using=using)
+
+
+# subscriptions.subscribe() and unsubscribe() change the count themselves, these handlers cover the
+# subscriptions created and deleted through the ORM (the admin, and the cascades when a user is deleted)
+@receiver(post_save, sender=PostSubscription)
+def count_new_subscriber(sender, instance, created, using, **kwargs):
+    if created:
+        listings.add_subscribers(instance.post_id, 1, using=using)
+
+
+@receiver(post_delete, sender=PostSubscription)
+def count_removed_subscriber(sender, instance, using, **kwargs):
+    listings.add_subscribers(instance.post_id, -1, using=using)
+
+
+@receiver(post_save, sender=DogAdoptionPost)
+@receiver(post_delete, sender=DogAdoptionPost)
+@receiver(post_save, sender=Shelter)
+@receiver(post_delete, sender=Shelter)
+@receiver(adoption_stage_changed, sender=DogAdoptionPost)
+def invalidate_cached_listings(sender, using=None, **kwargs):
+    """Make SortFilterForm rebuild its breed and shelter options and the shelter map rebuild its tiles"""
+    for namespace in (FILTER_CHOICES_NAMESPACE, SHELTER_POINTS_NAMESPACE):
+        caching.bump_version(namespace)
+        # Bump the version once more after the commit, in case another request has cached
+        # the data before the transaction with the change was committed
+        transaction.on_commit(lambda namespace=namespace: caching.bump_version(namespace), using=using)
+
+
+@receiver(pre_save, sender=Shelter)
+def remember_stored_shelter(sender, instance, raw, using, **kwargs):
+    """Read the stored name and coordinates, which the key of the cached map was built from"""
+    if not raw and not instance._state.adding:
+        instance._stored_shelter = (Shelter.objects.using(using).filter(pk=instance.pk)
+                                    .only('name', 'latitude', 'longitude').first())
+
+
+@receiver(post_save, sender=Shelter)
+def remove_outdated_shelter_map(sender, instance, using, **kwargs):
+    """The map of the previous name or coordinates will never be shown again. It's removed after the commit,
+    because until then other requests still see the stored values and may cache the map again"""
+    stored = instance.__dict__.pop('_stored_shelter', None)
+    if stored is not None and maps.shelter_map_key(stored) != maps.shelter_map_key(instance):
+        transaction.on_commit(lambda: maps.forget_shelter_map(stored), using=using)
+
+
+@receiver(post_delete, sender=Shelter)
+def remove_shelter_map(sender, instance, **kwargs):
+    """The map of a deleted shelter will never be shown again, so it's removed from the cache right away"""
+    maps.forget_shelter_map(instance)
+
+
+@receiver(post_delete, sender=DogAdoptionPost)
+def delete_image_variants(sender, instance, **kwargs):
+    """Delete the photo of the post and its variants, unless another post has the same photo"""
+    if instance.image or instance.image_variants:
+        images.release(instance.image.storage, instance.image.name, instance.image_variants or {})
+
+
+@receiver(connection_created)
+def configure_sqlite_connection(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite' and settings.DB_PROFILE == 'production':
+        with connection.cursor() as cursor:
+            db.apply_pragmas(cursor)
@@ -0,0 +1,12 @@
+"""
+The SQLite backend of DB_PROFILE=production (see Watchdog/settings.py and gui/db.py). Transactions start with
+BEGIN IMMEDIATE instead of BEGIN, so a transaction takes the write lock when it starts, and two transactions that
+read and then write wait for each other (busy_timeout) instead of one failing with "database is locked".
+Django's own 'transaction_mode' option does the same, but only from Django 5.1 on.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
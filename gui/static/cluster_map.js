@@ -0,0 +1,54 @@
+// Draw the city-wide shelter map. The markers are loaded per map tile from 'tileUrl' (containing {z}, {x} and {y}),
+// already clustered on the server (see gui/maps/clustering.py)
+function renderClusterMap(elementId, tileUrl) {
+    const map = L.map(elementId).setView([42.6977, 23.3219], 12);
+    L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {
+        maxZoom: 19,
+        attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
+    }).addTo(map);
+
+    function createMarker(data) {
+        if (data.count) {
+            // A cluster: zoom in to split it
+            const icon = L.divIcon({
+                className: 'cluster-marker',
+                html: '<span>' + data.count + ' shelters<br>' + data.dogs + ' dogs</span>',
+                iconSize: [80, 40]
+            });
+            return L.marker([data.lat, data.lon], {icon: icon}).on('click', function() {
+                map.setView([data.lat, data.lon], map.getZoom() + 2);
+            });
+        }
+        const link = document.createElement('a');
+        link.href = data.url;
+        link.textContent = data.name + ' (' + data.dogs + ' dogs)';
+        return L.marker([data.lat, data.lon]).bindPopup(link);
+    }
+
+    // The markers of every tile are kept in their own layer group, so they are removed with the tile
+    const groups = {};
+    const MarkerTiles = L.GridLayer.extend({
+        createTile: function(coords, done) {
+            const tile = document.createElement('div');
+            const key = coords.z + '/' + coords.x + '/' + coords.y;
+            fetch(L.Util.template(tileUrl, coords))
+                .then(function(response) { return response.json(); })
+                .then(function(data) {
+                    groups[key] = L.layerGroup(data.markers.map(createMarker)).addTo(map);
+                    done(null, tile);
+                })
+                .catch(function(error) { done(error, tile); });
+            return tile;
+        }
+    });
+    const tiles = new MarkerTiles();
+    tiles.on('tileunload', function(event) {
+        const key = event.coords.z + '/' + event.coords.x + '/' + event.coords.y;
+        if (groups[key]) {
+            map.removeLayer(groups[key]);
+            delete groups[key];
+        }
+    });
+    tiles.addTo(map);
+    return map;
+}
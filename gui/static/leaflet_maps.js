@@ -0,0 +1,13 @@
+// Draw a map described by the JSON in the element 'dataId' (see gui/maps/leaflet.py) into the element 'elementId'
+function renderMarkerMap(elementId, dataId) {
+    const data = JSON.parse(document.getElementById(dataId).textContent);
+    const map = L.map(elementId).setView([data.latitude, data.longitude], data.zoom);
+    L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {
+        maxZoom: 19,
+        attribution: '&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
+    }).addTo(map);
+    data.markers.forEach(function(marker) {
+        L.marker([marker.latitude, marker.longitude]).bindTooltip(marker.tooltip).addTo(map);
+    });
+    return map;
+}
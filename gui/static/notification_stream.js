@@ -0,0 +1,68 @@
+// Receive new notifications and update the badge in the header, either over Server-Sent Events
+// (views.notification_stream, when the site is served by ASGI) or by polling views.notification_updates.
+// Every notification is also dispatched as a 'watchdog:notification' event on the document, so a page
+// can show it (the notifications page adds it to the list)
+function notificationBadge() {
+    const link = document.getElementById('notifications-link');
+    let badge = link.querySelector('.badge');
+    if (!badge) {
+        badge = document.createElement('span');
+        badge.className = 'badge';
+        badge.textContent = '0';
+        link.appendChild(badge);
+    }
+    return badge;
+}
+
+// Like the header template, show the badge only while there are unread notifications
+function setUnreadCount(count) {
+    if (count) {
+        notificationBadge().textContent = count;
+    } else {
+        const badge = document.getElementById('notifications-link').querySelector('.badge');
+        if (badge) {
+            badge.remove();
+        }
+    }
+}
+
+function showNotification(notification) {
+    document.dispatchEvent(new CustomEvent('watchdog:notification', {detail: notification}));
+}
+
+function listenForNotifications(streamUrl, lastEventId) {
+    if (!window.EventSource) {
+        return;
+    }
+    const url = lastEventId ? streamUrl + '?last_event_id=' + encodeURIComponent(lastEventId) : streamUrl;
+    const source = new EventSource(url);
+
+    source.addEventListener('notification', function(event) {
+        const badge = notificationBadge();
+        badge.textContent = parseInt(badge.textContent, 10) + 1;
+        showNotification(JSON.parse(event.data));
+    });
+}
+
+function pollForNotifications(updatesUrl, lastId, intervalMs) {
+    function poll() {
+        const url = lastId ? updatesUrl + '?after=' + encodeURIComponent(lastId) : updatesUrl;
+        fetch(url, {credentials: 'same-origin'})
+            .then(function(response) {
+                return response.ok ? response.json() : null;
+            })
+            .then(function(updates) {
+                if (!updates) {
+                    return;
+                }
+                lastId = updates.last_id;
+                setUnreadCount(updates.unread_count);
+                updates.notifications.forEach(showNotification);
+            })
+            .catch(function() {})
+            .then(function() {
+                setTimeout(poll, intervalMs);
+            });
+    }
+    poll();
+}
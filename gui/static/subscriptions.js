@@ -0,0 +1,27 @@
+// Subscribe to and unsubscribe from posts without reloading the listing. The forms still work without
+// JavaScript: the views redirect back to the index unless the request asks for JSON
+document.querySelectorAll('.subscription-form').forEach(function(form) {
+    form.addEventListener('submit', function(event) {
+        event.preventDefault();
+        const button = form.querySelector('button');
+        button.disabled = true;
+        fetch(form.action, {
+            method: 'POST',
+            body: new FormData(form),
+            headers: {'Accept': 'application/json'},
+            credentials: 'same-origin',
+        }).then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        }).then(function(result) {
+            form.action = result.subscribed ? form.dataset.unsubscribeUrl : form.dataset.subscribeUrl;
+            button.textContent = result.subscribed ? 'Unsubscribe' : 'Subscribe';
+            button.disabled = false;
+        }).catch(function() {
+            // Fall back to the normal submission, which shows the page the server responds with
+            form.submit();
+        });
+    });
+});
@@ -0,0 +1,102 @@
+"""
+Content-addressed storage for the uploaded photos.
+
+A file is stored under the SHA-256 hash of its content instead of the name it was uploaded with, e.g.
+'dogs/rex.jpg' -> 'dogs/3f/a2/3fa2...c9.jpg'. Identical uploads end up in the same file, which is written only
+once, and the two levels of subdirectories (65536 of them) keep every directory small. Since the content of a
+name never changes, the files can be cached by browsers forever (see media.py).
+
+The same file can be used by several posts, so it may only be deleted once none of them uses it any more
+(see images.release). Saving a file locks it (see models.StoredFile) until the end of the transaction, in which
+the post using it is saved too.
+
+The resized variants of a photo are not stored by their own hash alone: two different uploads can give variants
+with identical pixels (e.g. the same photo with different metadata, which isn't kept in the variants), and those
+would then be shared by posts that don't share the photo. Instead a variant is named after the photo it was built
+from and its own content hash (see images.variant_name and save_derived), so it belongs to exactly one stored photo
+and is deleted together with it.
+"""
+import hashlib
+import os
+import re
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils.deconstruct import deconstructible
+
+from .models import StoredFile
+
+# 'dogs/3f/a2/3fa2...c9.jpg', and the variants 'thumbs/dogs/3f/a2/3fa2...c9-200-81d0...4e.webp'
+HASHED_NAME_RE = re.compile(r'(?:^|/)[0-9a-f]{2}/[0-9a-f]{2}/(?:[0-9a-f]{64}-\d+-)?(?P<digest>[0-9a-f]{64})\.\w+$')
+
+
+def content_hash(content):
+    sha256 = hashlib.sha256()
+    for chunk in content.chunks():
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def hashed_name_digest(name):
+    """The content hash in a name given by ContentAddressedStorage, or None for any other name"""
+    match = HASHED_NAME_RE.search(name)
+    return match.group('digest') if match else None
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    def hashed_name(self, name, digest):
+        """'dogs/rex.JPG' -> 'dogs/ab/cd/abcd...ef.jpg'. Only the top directory of the name is kept"""
+        directory = name.split('/', 1)[0] if '/' in name else ''
+        extension = os.path.splitext(name)[1].lower()
+        return '/'.join(part for part in [directory, digest[:2], digest[2:4], digest + extension] if part)
+
+    def _save(self, name, content):
+        name = self.hashed_name(name, content_hash(content))
+        # The file is locked before it's looked for, so a concurrent release of the same file either waits
+        # until the post using it is committed, or has deleted the file already and it's written again
+        with transaction.atomic():
+            StoredFile.lock(name)
+            return self.save_derived(name, content)
+
+    def save_derived(self, name, content):
+        """Store a file derived from a stored one (a variant of a photo) under 'name' as it is. The name must
+        already be unique for the content, so an existing file with the name is kept"""
+        if self.exists(name):
+            return name
+        try:
+            self.write_new(name, content)
+        except FileExistsError:
+            # Written by a concurrent request in the meantime. FileSystemStorage._save isn't used for the write
+            # because it would store the content under another, random name instead
+            pass
+        return name
+
+    def write_new(self, name, content):
+        """
+        Write 'content' to a new file 'name', raise FileExistsError if it exists. The content is written to a
+        temporary file next to it, which is then linked to the name: a request that finds the name (see
+        save_derived) may serve it at once, so the file must never be seen half-written
+        """
+        path = self.path(name)
+        if self.directory_permissions_mode is not None:
+            old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+            try:
+                os.makedirs(os.path.dirname(path), self.directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in content.chunks():
+                    file.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary_path, self.file_permissions_mode)
+            # Unlike a rename, link() doesn't replace a file written by a concurrent request in the meantime
+            os.link(temporary_path, path)
+        finally:
+            os.remove(temporary_path)
@@ -0,0 +1,53 @@
+"""
+Following posts. Subscribing and unsubscribing are one statement each and can be repeated safely: a second
+subscribe hits the unique (user, post) constraint and does nothing, a second unsubscribe deletes nothing.
+Only when a subscription was actually added or removed, a second statement updates the subscriber count of the
+post's listing entry (see listings.py), in the same transaction.
+"""
+from django.db import connections, router, transaction
+
+from . import listings
+from .models import DogAdoptionPost, PostSubscription, Shelter
+
+
+def subscribe(user, post_id):
+    """
+    Subscribe the user to the post unless the user is the shelter that published it. Return whether a
+    subscription was created (False when it already existed, or the post doesn't exist or is the user's own).
+    """
+    connection = connections[router.db_for_write(PostSubscription)]
+    qn = connection.ops.quote_name
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        # The WHERE clause is required, without it SQLite would read ON CONFLICT as the ON of a join
+        cursor.execute(
+            f'INSERT INTO {qn(PostSubscription._meta.db_table)} (user_id, post_id, is_active) '
+            f'SELECT %s, post.id, %s FROM {qn(DogAdoptionPost._meta.db_table)} post '
+            f'LEFT JOIN {qn(Shelter._meta.db_table)} shelter ON shelter.id = post.shelter_id '
+            f'WHERE post.id = %s AND (shelter.user_id IS NULL OR shelter.user_id <> %s) '
+            f'ON CONFLICT (user_id, post_id) DO NOTHING',
+            [user.pk, True, post_id, user.pk],
+        )
+        created = cursor.rowcount == 1
+        if created:
+            listings.add_subscribers(post_id, 1, using=connection.alias)
+    return created
+
+
+def unsubscribe(user, post_id):
+    """Remove the subscription of the user to the post. Return whether there was one"""
+    connection = connections[router.db_for_write(PostSubscription)]
+    # A raw DELETE: deleting through the ORM would send post_delete, which changes the subscriber count as well
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(PostSubscription._meta.db_table)} '
+            f'WHERE user_id = %s AND post_id = %s',
+            [user.pk, post_id],
+        )
+        deleted = cursor.rowcount
+        if deleted:
+            listings.add_subscribers(post_id, -deleted, using=connection.alias)
+    return deleted > 0
+
+
+def is_subscribed(user, post_id):
+    return PostSubscription.objects.filter(user=user, post_id=post_id).exists()
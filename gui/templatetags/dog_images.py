@@ -0,0 +1,16 @@
+from django import template
+
+from .. import images
+
+register = template.Library()
+
+
+@register.inclusion_tag('dog_image.html')
+def dog_image(dog, lazy=True):
+    """Render the photo of a post with its resized variants, so the browser downloads the smallest
+    one that fits the card. 'lazy' defers loading photos that are outside of the screen"""
+    context = {'dog': dog, 'lazy': lazy}
+    if dog.image:
+        context['webp_srcset'] = images.srcset(dog, 'webp')
+        context['jpeg_srcset'] = images.srcset(dog, 'jpeg')
+    return context
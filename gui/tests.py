@@ -1,10 +1,48 @@
-from django.test import TestCase
+import asyncio
+import json
+import math
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+from urllib.parse import quote
+
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, IntegrityError, OperationalError, transaction
+from django.db.utils import load_backend
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image, PngImagePlugin
 
 # reverse() is used to generate URLs based on the name of a URL pattern from urls.py
 from django.urls import reverse
 
-from .forms import UserRegistrationForm
-from .models import CustomUser, RegistrationCode, DogAdoptionPost, Shelter, Comment, PostSubscription, Notification
+from . import db, digests, geo, listings, maps, notifications, pubsub, routers, search
+from .facets import facet_counts
+from .maps import clustering
+from .forms import UserRegistrationForm, SortFilterForm, breed_choices, shelter_choices
+from .pagination import encode_cursor
+from .storage import ContentAddressedStorage, hashed_name_digest
+from .views import NotificationEventStream
+from .models import CustomUser, RegistrationCode, DogAdoptionPost, Shelter, Comment, PostSubscription, Notification, \
+    NotificationJob, AdoptionStageConflict, NotificationDigest, ListingEntry, StoredFile
+from django.contrib.admin.models import LogEntry
 from django.contrib.auth import get_user_model
 
 
@@ -528,6 +566,1328 @@ class FilterAndSortTest(TestCase):
                         and dogs[3].name == "Kucho" and dogs[4].name == "ЦЕЗАР")
 
 
+class ListingQueryTests(TestCase):
+    def setUp(self):
+        self.shelter_user = get_user_model().objects.create_user(username='shelter', password='123456',
+                                                                 role='shelter')
+        self.shelter = Shelter.objects.get(user=self.shelter_user)
+        self.user = get_user_model().objects.create_user(username='user', password='123456')
+        self.client.login(username='user', password='123456')
+
+    def create_posts(self, count):
+        for i in range(count):
+            DogAdoptionPost.objects.create(name=f"dog{i}", age=i, gender="male", breed="poroda", size="M",
+                                           shelter=self.shelter, adoption_stage='in_process')
+
+    def count_index_queries(self, params=None):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse('index'), params or {})
+        return len(context.captured_queries)
+
+    def test_number_of_queries_does_not_depend_on_number_of_posts(self):
+        self.create_posts(2)
+        queries_for_few_posts = self.count_index_queries()
+        self.create_posts(10)
+        self.assertEqual(self.count_index_queries(), queries_for_few_posts)
+
+    def test_number_of_queries_when_sorting_by_size(self):
+        self.create_posts(2)
+        queries_for_few_posts = self.count_index_queries({'sort_by': 'size'})
+        self.create_posts(10)
+        self.assertEqual(self.count_index_queries({'sort_by': 'size'}), queries_for_few_posts)
+
+    def test_user_is_subscribed_annotation(self):
+        self.create_posts(2)
+        followed, not_followed = DogAdoptionPost.objects.order_by('pk')
+        PostSubscription.objects.create(user=self.user, post=followed)
+        dogs = {dog.pk: dog for dog in ListingEntry.objects.with_subscription_flag(self.user)}
+        self.assertTrue(dogs[followed.pk].user_is_subscribed)
+        self.assertFalse(dogs[not_followed.pk].user_is_subscribed)
+
+
+class ListingEntryTests(TestCase):
+    def setUp(self):
+        self.shelter_user = get_user_model().objects.create_user(username='shelter', password='123456',
+                                                                 role='shelter')
+        self.shelter = Shelter.objects.get(user=self.shelter_user)
+        self.shelter.name = 'Happy Paws'
+        self.shelter.latitude, self.shelter.longitude = 42.7, 23.3
+        self.shelter.save()
+        self.post = DogAdoptionPost.objects.create(name='Rex', age=3, gender='male', breed='poroda', size='L',
+                                                   shelter=self.shelter, adoption_stage='in_process')
+        self.user = get_user_model().objects.create_user(username='user', password='123456')
+        self.client.login(username='user', password='123456')
+
+    def entry(self):
+        return ListingEntry.objects.get(post=self.post)
+
+    def test_entry_created_with_post(self):
+        entry = self.entry()
+        self.assertEqual((entry.name, entry.size, entry.size_rank, entry.adoption_stage),
+                         ('Rex', 'L', 4, 'in_process'))
+        self.assertEqual((entry.shelter_id, entry.shelter_name, entry.owner_id),
+                         (self.shelter.pk, 'Happy Paws', self.shelter_user.pk))
+        self.assertEqual((entry.latitude, entry.longitude), (42.7, 23.3))
+
+    def test_entry_follows_post_changes(self):
+        self.post.name = 'Max'
+        self.post.adoption_stage = 'completed'
+        self.post.save()
+        self.assertEqual((self.entry().name, self.entry().adoption_stage), ('Max', 'completed'))
+        response = self.client.get(reverse('archive_page'))
+        self.assertEqual([dog.pk for dog in response.context['archived_dogs']], [self.post.pk])
+
+    def test_entry_follows_stage_transition(self):
+        self.post.transition_stage('active')
+        self.assertEqual(self.entry().adoption_stage, 'active')
+
+    def test_entries_follow_shelter_changes(self):
+        self.shelter.name = 'Sad Paws'
+        self.shelter.save()
+        self.assertEqual(self.entry().shelter_name, 'Sad Paws')
+
+    def test_entry_deleted_with_post(self):
+        self.post.delete()
+        self.assertFalse(ListingEntry.objects.exists())
+
+    def test_subscriber_count(self):
+        for _ in range(2):
+            self.client.post(reverse('subscribe', args=[self.post.pk]))
+        self.assertEqual(self.entry().subscriber_count, 1)
+        other_user = get_user_model().objects.create_user(username='other', password='123456')
+        PostSubscription.objects.create(user=other_user, post=self.post)
+        self.assertEqual(self.entry().subscriber_count, 2)
+        for _ in range(2):
+            self.client.post(reverse('unsubscribe', args=[self.post.pk]))
+        self.assertEqual(self.entry().subscriber_count, 1)
+        other_user.delete()
+        self.assertEqual(self.entry().subscriber_count, 0)
+
+    def test_rebuild_command(self):
+        PostSubscription.objects.create(user=self.user, post=self.post)
+        DogAdoptionPost.objects.update(name='Max')
+        ListingEntry.objects.filter(post=self.post).update(subscriber_count=5)
+        call_command('rebuild_listings', stdout=StringIO())
+        self.assertEqual((self.entry().name, self.entry().subscriber_count), ('Max', 1))
+
+    def test_index_reads_only_listing_entries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('index'))
+        self.assertEqual([dog.pk for dog in response.context['dogs']], [self.post.pk])
+        page_queries = [query['sql'] for query in context.captured_queries if 'gui_listingentry' in query['sql']]
+        self.assertTrue(page_queries)
+        self.assertTrue(all('JOIN' not in sql for sql in page_queries))
+
+    def test_index_card(self):
+        PostSubscription.objects.create(user=self.user, post=self.post)
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, 'Shelter: Happy Paws')
+        self.assertContains(response, 'Followed by 1 user')
+        self.assertContains(response, reverse('unsubscribe', args=[self.post.pk]))
+
+
+class QueryPlanTests(TestCase):
+    """
+    Run EXPLAIN QUERY PLAN on every statement of the listing, archive, notification and subscription views and
+    fail if one of them reads a whole table. The lists of all shelters and breeds (for the filter form) read a
+    whole index on purpose, which is allowed as long as the index covers the query.
+    """
+    def setUp(self):
+        self.shelter_user = get_user_model().objects.create_user(username='shelter', password='123456',
+                                                                 role='shelter')
+        self.shelter = Shelter.objects.get(user=self.shelter_user)
+        self.user = get_user_model().objects.create_user(username='user', password='123456')
+        self.post = DogAdoptionPost.objects.create(name="Rex", age=3, gender="male", breed="poroda", size="M",
+                                                   shelter=self.shelter)
+        DogAdoptionPost.objects.create(name="Old", age=9, gender="female", breed="poroda", size="L",
+                                       shelter=self.shelter, adoption_stage='completed')
+        # A second post on each page, so that there is a next page when one post is shown per page
+        DogAdoptionPost.objects.create(name="Bella", age=1, gender="female", breed="poroda", size="S",
+                                       shelter=self.shelter, adoption_stage='in_process')
+        DogAdoptionPost.objects.create(name="Ace", age=12, gender="male", breed="poroda", size="XL",
+                                       shelter=self.shelter, adoption_stage='completed')
+        PostSubscription.objects.create(user=self.user, post=self.post)
+        notifications.upsert([self.user.pk], self.post.pk, 'message', 'Hello')
+        self.client.login(username='user', password='123456')
+        cache.clear()
+
+    def capture_statements(self, method, url, params=None):
+        statements = []
+
+        def capture(execute, sql, sql_params, many, context):
+            statements.append((sql, sql_params))
+            return execute(sql, sql_params, many, context)
+
+        with connection.execute_wrapper(capture):
+            response = getattr(self.client, method)(url, params or {})
+        self.assertLess(response.status_code, 400)
+        return [(sql, sql_params) for sql, sql_params in statements
+                if 'gui_' in sql and sql.lstrip().split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE')]
+
+    def full_scans(self, statements):
+        scans = []
+        with connection.cursor() as cursor:
+            for sql, params in statements:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    if (detail.startswith('SCAN gui_') and 'COVERING INDEX' not in detail
+                            and 'VIRTUAL TABLE' not in detail):
+                        scans.append(f'{detail}: {sql}')
+        return scans
+
+    def assertNoFullScans(self, method, url, params=None):
+        statements = self.capture_statements(method, url, params)
+        self.assertTrue(statements)
+        self.assertEqual(self.full_scans(statements), [])
+
+    def test_index(self):
+        self.assertNoFullScans('get', reverse('index'))
+
+    def test_index_with_filters(self):
+        self.assertNoFullScans('get', reverse('index'), {'size': 'M', 'gender': 'male'})
+        self.assertNoFullScans('get', reverse('index'), {'breed': 'poroda'})
+        self.assertNoFullScans('get', reverse('index'), {'shelter': self.shelter.pk})
+
+    def test_index_sorted(self):
+        self.assertNoFullScans('get', reverse('index'), {'sort_by': 'age'})
+        self.assertNoFullScans('get', reverse('index'), {'sort_by': 'size'})
+
+    def test_index_search(self):
+        self.assertNoFullScans('get', reverse('index'), {'q': 'Rex'})
+
+    def listing_plans(self, statements):
+        """The query plans of the statements that read a page of listing entries"""
+        plans = []
+        with connection.cursor() as cursor:
+            for sql, sql_params in statements:
+                if 'gui_listingentry' in sql and 'ORDER BY' in sql:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + sql, sql_params)
+                    plans.extend(row[-1] for row in cursor.fetchall())
+        return plans
+
+    def assertReadInOrder(self, url, params, index_name):
+        """The page is read from 'index_name' in the order it is shown, without sorting the rows"""
+        for page_params in (params, {**params, 'cursor': self.cursor_after_first_row(url, params)}):
+            plans = self.listing_plans(self.capture_statements('get', url, page_params))
+            self.assertTrue([plan for plan in plans if index_name in plan], plans)
+            self.assertFalse([plan for plan in plans if 'TEMP B-TREE FOR ORDER BY' in plan], plans)
+
+    def cursor_after_first_row(self, url, params):
+        with self.settings(LISTING_PAGE_SIZE=1):
+            response = self.client.get(url, params)
+        return response.context['page'].next_cursor
+
+    def test_index_sorted_by_distance(self):
+        params = {'sort_by': 'distance', 'latitude': 42.69, 'longitude': 23.32}
+        statements = self.capture_statements('get', reverse('index'), params)
+        self.assertEqual(self.full_scans(statements), [])
+        plans = self.listing_plans(statements)
+        # The bounding box of the default radius narrows the entries down before the distances are computed
+        self.assertTrue([plan for plan in plans if 'listing_location_idx' in plan], plans)
+
+    def test_index_read_in_sort_order(self):
+        self.assertReadInOrder(reverse('index'), {}, 'listing_stage_idx')
+        self.assertReadInOrder(reverse('index'), {'sort_by': 'name'}, 'listing_name_idx')
+        self.assertReadInOrder(reverse('index'), {'sort_by': 'age'}, 'listing_age_idx')
+        self.assertReadInOrder(reverse('index'), {'sort_by': 'size'}, 'listing_size_rank_idx')
+
+    def test_archive(self):
+        self.assertNoFullScans('get', reverse('archive_page'))
+
+    def test_archive_read_in_sort_order(self):
+        self.assertReadInOrder(reverse('archive_page'), {}, 'listing_stage_idx')
+
+    def test_notifications(self):
+        self.assertNoFullScans('get', reverse('notifications'))
+
+    def test_subscriptions(self):
+        self.assertNoFullScans('post', reverse('unsubscribe', args=[self.post.pk]))
+        self.assertNoFullScans('post', reverse('subscribe', args=[self.post.pk]))
+
+    def test_detects_full_scan(self):
+        statements = [('SELECT * FROM gui_dogadoptionpost WHERE description = %s', ['x'])]
+        self.assertEqual(len(self.full_scans(statements)), 1)
+
+
+class SQLiteConnectionTests(TestCase):
+    def pragmas_of_new_connection(self, directory, names):
+        """Open a new Django connection to a database file in 'directory' (the test database is in memory, which has
+        no journal file), so that the connection_created receivers run, and return the values of the pragmas"""
+        wrapper = connections['default'].__class__({**connection.settings_dict,
+                                                    'NAME': os.path.join(directory, 'test.sqlite3')})
+        try:
+            with wrapper.cursor() as cursor:
+                values = {}
+                for name in names:
+                    cursor.execute(f'PRAGMA {name}')
+                    values[name] = cursor.fetchone()[0]
+                return values
+        finally:
+            wrapper.close()
+
+    @override_settings(DB_PROFILE='production')
+    def test_pragmas_applied_to_new_connections_in_production(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pragmas = self.pragmas_of_new_connection(directory, ['journal_mode', 'synchronous', 'busy_timeout',
+                                                                 'cache_size'])
+        # synchronous 1 = NORMAL
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1,
+                                   'busy_timeout': settings.SQLITE_PRAGMAS['busy_timeout'],
+                                   'cache_size': settings.SQLITE_PRAGMAS['cache_size']})
+
+    @override_settings(DB_PROFILE='development')
+    def test_database_file_not_switched_to_wal_by_default(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pragmas = self.pragmas_of_new_connection(directory, ['journal_mode'])
+            self.assertEqual(os.listdir(directory), ['test.sqlite3'])
+        self.assertEqual(pragmas, {'journal_mode': 'delete'})
+
+    def test_production_backend_takes_the_write_lock_when_a_transaction_starts(self):
+        production_wrapper = load_backend('gui.sqlite_backend').DatabaseWrapper
+        with tempfile.TemporaryDirectory() as directory:
+            settings_dict = {**connection.settings_dict, 'NAME': os.path.join(directory, 'test.sqlite3')}
+            writer = production_wrapper(settings_dict)
+            other = connections['default'].__class__({**settings_dict, 'OPTIONS': {'timeout': 0}})
+            try:
+                with writer.cursor() as cursor:
+                    cursor.execute('CREATE TABLE lock_test (id INTEGER)')
+                writer._start_transaction_under_autocommit()
+                # Nothing has been written yet, but the lock is taken
+                with self.assertRaisesMessage(OperationalError, 'database is locked'):
+                    with other.cursor() as cursor:
+                        cursor.execute('INSERT INTO lock_test VALUES (1)')
+            finally:
+                writer.close()
+                other.close()
+
+    def test_invalid_pragma_rejected(self):
+        with self.assertRaises(ValueError):
+            db.pragma_statements({'journal_mode': 'wal; DROP TABLE gui_shelter'})
+        with self.assertRaises(ValueError):
+            db.pragma_statements({'cache size': 10})
+
+
+class SyncReplicaCommandTests(SimpleTestCase):
+    def test_copies_the_primary_under_the_production_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            replica = os.path.join(directory, 'replica.sqlite3')
+            result = subprocess.run([sys.executable, 'manage.py', 'sync_replica'], capture_output=True, text=True,
+                                    cwd=settings.BASE_DIR, env={**os.environ, 'DB_PROFILE': 'production',
+                                                                'DB_REPLICA_NAME': replica})
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertIn("Copied the primary database to 'replica'.", result.stdout)
+            copy = sqlite3.connect(replica)
+            try:
+                tables = {name for name, in copy.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            finally:
+                copy.close()
+        self.assertIn('gui_dogadoptionpost', tables)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        self.shelter_user = get_user_model().objects.create_user(username='shelter', password='123456',
+                                                                 role='shelter')
+        self.shelter = Shelter.objects.get(user=self.shelter_user)
+        self.post = DogAdoptionPost.objects.create(name="Rex", age=3, gender="male", breed="poroda", size="M",
+                                                   shelter=self.shelter)
+        self.user = get_user_model().objects.create_user(username='user', password='123456')
+        self.client.login(username='user', password='123456')
+
+    def routed_reads(self, method, url):
+        """Make the request and return the set of databases the router chose for the reads. The queries still
+        run on 'default', the test database has no real replica"""
+        chosen = set()
+        db_for_read = routers.PrimaryReplicaRouter.db_for_read
+
+        def record(router, model, **hints):
+            chosen.add(db_for_read(router, model, **hints))
+            return 'default'
+
+        with mock.patch.object(routers.PrimaryReplicaRouter, 'db_for_read', record):
+            getattr(self.client, method)(url)
+        return chosen
+
+    def test_router(self):
+        router = routers.PrimaryReplicaRouter()
+        self.assertEqual(router.db_for_read(DogAdoptionPost), 'default')
+        view = routers.read_from_replica(lambda request: HttpResponse(router.db_for_read(DogAdoptionPost)))
+        self.assertEqual(view(RequestFactory().get('/')).content, b'replica')
+        self.assertEqual(router.db_for_write(DogAdoptionPost), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'gui'))
+
+    def test_listing_and_detail_views_read_from_replica(self):
+        for url in [reverse('index'), reverse('archive_page'), reverse('dog_details', args=[self.post.pk]),
+                    reverse('shelter_details', args=[self.shelter.pk])]:
+            self.assertIn('replica', self.routed_reads('get', url), url)
+
+    def test_other_views_read_from_primary(self):
+        self.assertEqual(self.routed_reads('get', reverse('notifications')), {'default'})
+
+    def test_reads_after_own_write_use_primary(self):
+        self.client.post(reverse('subscribe', args=[self.post.pk]))
+        self.assertEqual(self.routed_reads('get', reverse('index')), {'default'})
+
+    def test_pin_to_primary_expires(self):
+        self.client.post(reverse('subscribe', args=[self.post.pk]))
+        with mock.patch('gui.routers.time.time', return_value=time.time() + settings.REPLICA_PIN_SECONDS + 1):
+            self.assertIn('replica', self.routed_reads('get', reverse('index')))
+
+    def test_cached_choices_are_built_from_primary(self):
+        chosen = set()
+        db_for_read = routers.PrimaryReplicaRouter.db_for_read
+
+        def record(router, model, **hints):
+            chosen.add(db_for_read(router, model, **hints))
+            return 'default'
+
+        cache.clear()
+        view = routers.read_from_replica(lambda request: HttpResponse([breed_choices(), shelter_choices()]))
+        with mock.patch.object(routers.PrimaryReplicaRouter, 'db_for_read', record):
+            view(RequestFactory().get('/'))
+        self.assertEqual(chosen, {'default'})
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        self.client.post(reverse('subscribe', args=[self.post.pk]))
+        self.assertNotIn(routers.PIN_SESSION_KEY, self.client.session)
+        self.assertEqual(self.routed_reads('get', reverse('index')), {'default'})
+
+
+@override_settings(LISTING_PAGE_SIZE=2)
+class PaginationTests(TestCase):
+    def setUp(self):
+        self.shelter_user = get_user_model().objects.create_user(username='shelter', password='123456',
+                                                                 role='shelter')
+        self.shelter = Shelter.objects.get(user=self.shelter_user)
+        # Several posts share the same name, age and size, so the pk is needed to break ties
+        for name, age, size in [('b', 3, 'XL'), ('a', 3, 'S'), ('b', 1, 'XS'), ('c', 2, 'S'), ('a', 5, 'M')]:
+            DogAdoptionPost.objects.create(name=name, age=age, gender='male', breed='poroda', size=size,
+                                           shelter=self.shelter)
+        get_user_model().objects.create_user(username='user', password='123456')
+        self.client.login(username='user', password='123456')
+
+    def collect_pages(self, url, params, context_name='dogs'):
+        """Follow the 'next page' links and return the posts from all pages"""
+        dogs = []
+        response = self.client.get(url, params)
+        while True:
+            dogs.extend(response.context[context_name])
+            if not response.context['page'].has_next:
+                return dogs
+            response = self.client.get(url + response.context['page'].next_page_url)
+
+    def test_all_sort_options(self):
+        expected = {
+            '': list(DogAdoptionPost.objects.order_by('pk')),
+            'name': list(DogAdoptionPost.objects.order_by('name', 'pk')),
+            'age': list(DogAdoptionPost.objects.order_by('age', 'pk')),
+            'size': list(ListingEntry.objects.order_by('size_rank', 'pk')),
+        }
+        for sort_by, expected_dogs in expected.items():
+            dogs = self.collect_pages(reverse('index'), {'sort_by': sort_by})
+            self.assertEqual([dog.pk for dog in dogs], [dog.pk for dog in expected_dogs])
+
+    def test_page_size(self):
+        response = self.client.get(reverse('index'))
+        self.assertEqual(len(response.context['dogs']), 2)
+        self.assertTrue(response.context['page'].has_next)
+        self.assertFalse(response.context['page'].has_previous)
+
+    def test_filters_are_kept_across_pages(self):
+        DogAdoptionPost.objects.create(name='z', age=1, gender='female', breed='poroda', size='M',
+                                       shelter=self.shelter)
+        dogs = self.collect_pages(reverse('index'), {'gender': 'male', 'sort_by': 'size'})
+        self.assertEqual(len(dogs), 5)
+        self.assertNotIn('z', [dog.name for dog in dogs])
+
+    def test_invalid_cursor_shows_first_page(self):
+        first_page = list(DogAdoptionPost.objects.order_by('pk').values_list('pk', flat=True)[:2])
+        for cursor in ['not-a-cursor', encode_cursor(['x']), encode_cursor([None]), encode_cursor([{}])]:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(reverse('index'), {'cursor': cursor})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([dog.pk for dog in response.context['dogs']], first_page)
+
+    def test_invalid_cursor_shows_first_archive_page(self):
+        DogAdoptionPost.objects.update(adoption_stage='completed')
+        listings.rebuild()
+        for values in [['x'], [None], [{}]]:
+            with self.subTest(values=values):
+                response = self.client.get(reverse('archive_page'), {'cursor': encode_cursor(values)})
+                self.assertEqual(response.status_code, 200)
+                self.assertFalse(response.context['page'].has_previous)
+
+    def test_invalid_cursor_date_shows_first_page(self):
+        response = self.client.get(reverse('notifications'), {'cursor': encode_cursor(['not-a-date', 1])})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['page'].has_previous)
+
+    def test_archive_pagination(self):
+        DogAdoptionPost.objects.update(adoption_stage='completed')
+        # update() doesn't send the signals that keep the listing entries up to date
+        listings.rebuild()
+        dogs = self.collect_pages(reverse('archive_page'), {}, context_name='archived_dogs')
+        self.assertEqual(len(dogs), 5)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.shelter_user = get_user_model().objects.create_user(username='shelter', password='123456',
+                                                                 role='shelter')
+        self.shelter = Shelter.objects.get(user=self.shelter_user)
+        self.rex = DogAdoptionPost.objects.create(name='Rex', age=3, gender='male', breed='labrador', size='L',
+                                                  description='calm and friendly', shelter=self.shelter)
+        self.bella = DogAdoptionPost.objects.create(name='Bella', age=2, gender='female', breed='poodle', size='S',
+                                                    description='loves a labrador friend', shelter=self.shelter)
+        self.max = DogAdoptionPost.objects.create(name='Max', age=5, gender='male', breed='beagle', size='M',
+                                                  description='energetic', shelter=self.shelter)
+        get_user_model().objects.create_user(username='user', password='123456')
+        self.client.login(username='user', password='123456')
+
+    def matching_ids(self, text):
+        return list(search.search(DogAdoptionPost.objects.all(), text).order_by('search_rank', 'pk')
+                    .values_list('pk', flat=True))
+
+    def test_fts5_index_is_used(self):
+        self.assertTrue(search.fts5_available())
+
+    def test_search_name_breed_and_description(self):
+        self.assertEqual(self.matching_ids('max'), [self.max.pk])
+        self.assertEqual(self.matching_ids('energetic'), [self.max.pk])
+        self.assertCountEqual(self.matching_ids('labrador'), [self.rex.pk, self.bella.pk])
+
+    def test_prefix_search(self):
+        self.assertEqual(self.matching_ids('pood'), [self.bella.pk])
+
+    def test_special_characters_are_ignored(self):
+        # Characters with a meaning in the FTS5 query syntax must not cause errors
+        self.assertEqual(self.matching_ids('"bea-*'), [self.max.pk])
+        self.assertEqual(self.matching_ids('"(*'), [])
+
+    def test_index_is_updated_after_edit_and_delete(self):
+        self.max.description = 'sleepy'
+        self.max.save()
+        self.assertEqual(self.matching_ids('energetic'), [])
+        self.assertEqual(self.matching_ids('sleepy'), [self.max.pk])
+        self.max.delete()
+        self.assertEqual(self.matching_ids('sleepy'), [])
+
+    def test_search_from_index_page(self):
+        response = self.client.get(reverse('index'), {'q': 'labrador'})
+        dogs = list(response.context['dogs'])
+        self.assertCountEqual([dog.name for dog in dogs], ['Rex', 'Bella'])
+
+    def test_search_combined_with_filter(self):
+        response = self.client.get(reverse('index'), {'q': 'labrador', 'gender': 'female'})
+        self.assertEqual([dog.name for dog in response.context['dogs']], ['Bella'])
+
+    @override_settings(LISTING_PAGE_SIZE=4, SEARCH_JSON_LIMIT=3)
+    def test_filtered_out_matches_do_not_hide_visible_ones(self):
+        # Archived posts and posts of other sizes that match better than all the visible ones
+        for i in range(10):
+            DogAdoptionPost.objects.create(name=f'Dog dog {i}', age=1, gender='male', breed='dog', size='M',
+                                           description='dog dog dog', shelter=self.shelter,
+                                           adoption_stage='completed' if i % 2 else 'active')
+        visible = [DogAdoptionPost.objects.create(name=f'Pup {i}', age=1, gender='male', breed='mixed', size='XL',
+                                                  description=f'a dog {"and more words " * i}', shelter=self.shelter)
+                   for i in range(6)]
+
+        names, params = [], {'q': 'dog', 'size': 'XL'}
+        response = self.client.get(reverse('index'), params)
+        while True:
+            names.extend(dog.name for dog in response.context['dogs'])
+            if not response.context['page'].has_next:
+                break
+            response = self.client.get(reverse('index') + response.context['page'].next_page_url)
+        # Best match first: the shorter description ranks higher
+        self.assertEqual(names, [post.name for post in visible])
+
+        results = self.client.get(reverse('search_posts'), {'q': 'dog'}).json()['results']
+        self.assertEqual(len(results), 3)
+        self.assertNotIn('completed', {DogAdoptionPost.objects.get(pk=result['id']).adoption_stage
+                                       for result in results})
+
+    def test_json_endpoint(self):
+        response = self.client.get(reverse('search_posts'), {'q': 'beagle'})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['name'], 'Max')
+        self.assertEqual(results[0]['url'], reverse('dog_details', kwargs={'pk': self.max.pk}))
+
+    def test_json_endpoint_does_not_return_archived_posts(self):
+        self.max.adoption_stage = 'completed'
+        self.max.save()
+        response = self.client.get(reverse('search_posts'), {'q': 'beagle'})
+        self.assertEqual(response.json()['results'], [])
+
+    def test_fallback_without_fts5(self):
+        with mock.patch.object(search, 'fts5_available', return_value=False):
+            dogs = search.search(DogAdoptionPost.objects.all(), 'labrador')
+            self.assertCountEqual([dog.name for dog in dogs], ['Rex', 'Bella'])
+            response = self.client.get(reverse('index'), {'q': 'energetic'})
+            self.assertEqual([dog.name for dog in response.context['dogs']], ['Max'])
+
+
+class FilterChoicesCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.shelter_user = get_user_model().objects.create_user(username='shelter', password='123456',
+                                                                 role='shelter')
+        self.shelter = Shelter.objects.get(user=self.shelter_user)
+        self.post = DogAdoptionPost.objects.create(name='Rex', age=3, gender='male', breed='labrador', size='L',
+                                                   shelter=self.shelter)
+
+    def test_choices_are_cached(self):
+        SortFilterForm()
+        with self.assertNumQueries(0):
+            form = SortFilterForm()
+        self.assertIn(('labrador', 'labrador'), form.fields['breed'].choices)
+        self.assertIn((self.shelter.pk, self.shelter.name), form.fields['shelter'].choices)
+
+    def test_shelter_change_invalidates_choices(self):
+        SortFilterForm()
+        self.shelter.name = 'new name'
+        self.shelter.save()
+        self.assertIn((self.shelter.pk, 'new name'), SortFilterForm().fields['shelter'].choices)
+
+    def test_shelter_delete_invalidates_choices(self):
+        SortFilterForm()
+        self.shelter.delete()
+        form = SortFilterForm()
+        self.assertEqual(form.fields['shelter'].choices, [('', 'All Shelters')])
+        self.assertEqual(form.fields['breed'].choices, [('', 'All')])
+
+    def test_breed_change_invalidates_choices(self):
+        SortFilterForm()
+        self.post.breed = 'beagle'
+        self.post.save()
+        choices = SortFilterForm().fields['breed'].choices
+        self.assertIn(('beagle', 'beagle'), choices)
+        self.assertNotIn(('labrador', 'labrador'), choices)
+
+    def test_invalid_shelter(self):
+        form = SortFilterForm({'shelter': self.shelter.pk + 100})
+        self.assertFalse(form.is_valid())
+        self.assertIn('shelter', form.errors)
+
+
+class FacetCountTests(TestCase):
+    def setUp(self):
+        self.shelter_user1 = get_user_model().objects.create_user(username='shelter1', password='123456',
+                                                                  role='shelter')
+        self.shelter1 = Shelter.objects.get(user=self.shelter_user1)
+        self.shelter_user2 = get_user_model().objects.create_user(username='shelter2', password='123456',
+                                                                  role='shelter')
+        self.shelter2 = Shelter.objects.get(user=self.shelter_user2)
+        for name, gender, size, breed, shelter in [
+            ('a', 'male', 'L', 'labrador', self.shelter1),
+            ('b', 'female', 'L', 'labrador', self.shelter1),
+            ('c', 'female', 'S', 'poodle', self.shelter2),
+            ('d', 'female', 'L', 'poodle', self.shelter2),
+        ]:
+            DogAdoptionPost.objects.create(name=name, age=1, gender=gender, breed=breed, size=size, shelter=shelter)
+        DogAdoptionPost.objects.create(name='e', age=1, gender='male', breed='beagle', size='S',
+                                       shelter=self.shelter1, adoption_stage='completed')
+        get_user_model().objects.create_user(username='user', password='123456')
+        self.client.login(username='user', password='123456')
+
+    def test_counts_without_filters(self):
+        counts = facet_counts(DogAdoptionPost.objects.visible(), {})
+        self.assertEqual(counts['size'], {'L': 3, 'S': 1})
+        self.assertEqual(counts['gender'], {'male': 1, 'female': 3})
+        self.assertEqual(counts['breed'], {'labrador': 2, 'poodle': 2})
+        self.assertEqual(counts['shelter'], {self.shelter1.pk: 2, self.shelter2.pk: 2})
+
+    def test_counts_reflect_other_filters(self):
+        counts = facet_counts(DogAdoptionPost.objects.visible(), {'size': 'L', 'gender': 'female'})
+        # A facet ignores its own filter, but not the filters of the other facets
+        self.assertEqual(counts['size'], {'L': 2, 'S': 1})
+        self.assertEqual(counts['gender'], {'male': 1, 'female': 2})
+        self.assertEqual(counts['breed'], {'labrador': 1, 'poodle': 1})
+        self.assertEqual(counts['shelter'], {self.shelter1.pk: 1, self.shelter2.pk: 1})
+
+    def test_counts_use_one_query(self):
+        with self.assertNumQueries(1):
+            facet_counts(DogAdoptionPost.objects.visible(), {'size': 'L', 'breed': 'poodle'})
+
+    def test_counts_with_search(self):
+        counts = facet_counts(search.search(DogAdoptionPost.objects.visible(), 'poodle'), {})
+        self.assertEqual(counts['size'], {'L': 1, 'S': 1})
+
+    def test_sidebar_on_index_page(self):
+        response = self.client.get(reverse('index'), {'gender': 'female'})
+        facets = {facet['name']: facet for facet in response.context['facets']}
+        sizes = {option['label']: option['count'] for option in facets['size']['options']}
+        self.assertEqual(sizes, {'Large': 2, 'Small': 1})
+        genders = {option['label']: option for option in facets['gender']['options']}
+        self.assertTrue(genders['Female']['selected'])
+        self.assertEqual(genders['Male']['count'], 1)
+        self.assertContains(response, 'Large (2)')
+
+
+class GeoTests(TestCase):
+    # Central Sofia
+    LATITUDE, LONGITUDE = 42.6977, 23.3219
+
+    def create_shelter(self, username, latitude, longitude):
+        user = get_user_model().objects.create_user(username=username, password='123456', role='shelter')
+        shelter = Shelter.objects.get(user=user)
+        shelter.name, shelter.latitude, shelter.longitude = username, latitude, longitude
+        shelter.save()
+        return shelter
+
+    def setUp(self):
+        self.center = self.create_shelter('center', 42.6960, 23.3200)
+        self.lyulin = self.create_shelter('lyulin', 42.7160, 23.2500)
+        self.pernik = self.create_shelter('pernik', 42.6050, 23.0380)
+        self.plovdiv = self.create_shelter('plovdiv', 42.1354, 24.7453)
+        for shelter in [self.plovdiv, self.pernik, self.center, self.lyulin]:
+            DogAdoptionPost.objects.create(name=f'dog from {shelter.name}', age=1, gender='male', breed='poroda',
+                                           size='M', shelter=shelter)
+        get_user_model().objects.create_user(username='user', password='123456')
+        self.client.login(username='user', password='123456')
+
+    def test_haversine(self):
+        self.assertEqual(geo.haversine(self.LATITUDE, self.LONGITUDE, self.LATITUDE, self.LONGITUDE), 0)
+        # Sofia - Plovdiv is about 132 km in a straight line
+        self.assertAlmostEqual(geo.haversine(self.LATITUDE, self.LONGITUDE, 42.1354, 24.7453), 132, delta=2)
+
+    def test_distance_in_database_matches_haversine(self):
+        for shelter in geo.shelters_within(self.LATITUDE, self.LONGITUDE, 500):
+            expected = geo.haversine(self.LATITUDE, self.LONGITUDE, shelter.latitude, shelter.longitude)
+            self.assertAlmostEqual(shelter.distance_km, expected, places=6)
+
+    def test_bounding_box_contains_circle(self):
+        min_lat, max_lat, min_lon, max_lon = geo.bounding_box(self.LATITUDE, self.LONGITUDE, 20)
+        for bearing in range(0, 360, 15):
+            # Points 20 km away from the center in different directions
+            lat = self.LATITUDE + math.degrees(20 / geo.EARTH_RADIUS_KM) * math.cos(math.radians(bearing))
+            lon = self.LONGITUDE + (math.degrees(20 / geo.EARTH_RADIUS_KM) * math.sin(math.radians(bearing))
+                                    / math.cos(math.radians(self.LATITUDE)))
+            self.assertTrue(min_lat <= lat <= max_lat and min_lon <= lon <= max_lon)
+
+    def test_bounding_box_near_pole(self):
+        self.assertEqual(geo.bounding_box(89.99, 0, 20)[2:], (None, None))
+
+    def test_shelters_within(self):
+        shelters = list(geo.shelters_within(self.LATITUDE, self.LONGITUDE, 20))
+        self.assertEqual(shelters, [self.center, self.lyulin])
+
+    def test_nearest_shelters(self):
+        self.assertEqual(geo.nearest_shelters(self.LATITUDE, self.LONGITUDE, 3),
+                         [self.center, self.lyulin, self.pernik])
+        self.assertEqual(len(geo.nearest_shelters(self.LATITUDE, self.LONGITUDE, 10)), 4)
+
+    def test_nearest_listing_entries(self):
+        dogs = geo.nearest(ListingEntry.objects.visible(), self.LATITUDE, self.LONGITUDE, 2)
+        self.assertEqual([dog.shelter_id for dog in dogs], [self.center.pk, self.lyulin.pk])
+
+    @override_settings(LISTING_PAGE_SIZE=1)
+    def test_sort_by_distance_on_index_page(self):
+        params = {'sort_by': 'distance', 'latitude': self.LATITUDE, 'longitude': self.LONGITUDE, 'radius_km': 200}
+        names = []
+        response = self.client.get(reverse('index'), params)
+        while True:
+            names.extend(dog.name for dog in response.context['dogs'])
+            if not response.context['page'].has_next:
+                break
+            response = self.client.get(reverse('index') + response.context['page'].next_page_url)
+        self.assertEqual(names, ['dog from center', 'dog from lyulin', 'dog from pernik', 'dog from plovdiv'])
+
+    def test_radius_filter_on_index_page(self):
+        response = self.client.get(reverse('index'), {'latitude': self.LATITUDE, 'longitude': self.LONGITUDE,
+                                                      'radius_km': 20})
+        self.assertCountEqual([dog.name for dog in response.context['dogs']], ['dog from center', 'dog from lyulin'])
+
+    def test_sort_by_distance_uses_default_radius(self):
+        response = self.client.get(reverse('index'), {'sort_by': 'distance', 'latitude': self.LATITUDE,
+                                                      'longitude': self.LONGITUDE})
+        self.assertEqual(response.context['form'].cleaned_data['radius_km'], settings.DEFAULT_SEARCH_RADIUS_KM)
+        self.assertEqual([dog.name for dog in response.context['dogs']], ['dog from center', 'dog from lyulin'])
+
+    def test_sort_by_distance_requires_location(self):
+        form = SortFilterForm({'sort_by': 'distance', 'radius_km': 10})
+        self.assertTrue(form.is_valid())
+        self.assertEqual((form.cleaned_data['sort_by'], form.cleaned_data['radius_km']), ('', None))
+        self.assertEqual(form.location_notice, "Share your location to sort and search by distance.")
+
+    def test_other_filters_are_kept_without_location(self):
+        response = self.client.get(reverse('index'), {'sort_by': 'distance', 'shelter': self.lyulin.pk})
+        self.assertContains(response, "Share your location to sort and search by distance.")
+        self.assertEqual([dog.name for dog in response.context['dogs']], ['dog from lyulin'])
+
+    def test_nearby_shelters_endpoint(self):
+        response = self.client.get(reverse('nearby_shelters'), {'lat': self.LATITUDE, 'lon': self.LONGITUDE,
+                                                                'k': 2})
+        self.assertEqual([shelter['name'] for shelter in response.json()['results']], ['center', 'lyulin'])
+        response = self.client.get(reverse('nearby_shelters'), {'lat': self.LATITUDE, 'lon': self.LONGITUDE,
+                                                                'radius_km': 50})
+        self.assertEqual([shelter['name'] for shelter in response.json()['results']], ['center', 'lyulin', 'pernik'])
+        response = self.client.get(reverse('nearby_shelters'), {'lat': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ShelterMapTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username='shelter', password='123456', role='shelter')
+        self.shelter = Shelter.objects.get(user=self.user)
+        self.shelter.name, self.shelter.latitude, self.shelter.longitude = 'priut', 42.69, 23.32
+        self.shelter.save()
+        self.url = reverse('shelter_details', kwargs={'pk': self.shelter.pk})
+
+    def test_map_is_rendered_once(self):
+        with mock.patch('gui.maps.render_shelter_map', wraps=maps.render_shelter_map) as render_map:
+            first = self.client.get(self.url)
+            second = self.client.get(self.url)
+        self.assertEqual(render_map.call_count, 1)
+        self.assertEqual(first.context['map_html'], second.context['map_html'])
+        self.assertIn('leaflet', second.context['map_html'])
+
+    def test_map_is_rendered_again_after_shelter_change(self):
+        with mock.patch('gui.maps.render_shelter_map', wraps=maps.render_shelter_map) as render_map:
+            self.client.get(self.url)
+            self.shelter.latitude = 42.7
+            self.shelter.save()
+            self.client.get(self.url)
+            self.shelter.name = 'nov priut'
+            self.shelter.save()
+            self.client.get(self.url)
+        self.assertEqual(render_map.call_count, 3)
+
+    def test_previous_map_removed_from_cache_after_shelter_change(self):
+        self.client.get(self.url)
+        key = maps.shelter_map_key(self.shelter)
+        shelter = Shelter.objects.get(pk=self.shelter.pk)
+        shelter.name = 'nov priut'
+        with self.captureOnCommitCallbacks(execute=True):
+            shelter.save()
+        self.assertIsNone(cache.get(key))
+        self.client.get(self.url)
+        self.assertIsNotNone(cache.get(maps.shelter_map_key(shelter)))
+
+    def test_map_kept_when_other_fields_change(self):
+        self.client.get(self.url)
+        key = maps.shelter_map_key(self.shelter)
+        self.shelter.phone = '0888123456'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shelter.save()
+        self.assertIsNotNone(cache.get(key))
+
+    def test_shelter_is_fetched_once(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(1):
+            self.client.get(self.url)
+
+    def test_map_removed_from_cache_after_shelter_delete(self):
+        self.client.get(self.url)
+        key = maps.shelter_map_key(self.shelter)
+        self.assertIsNotNone(cache.get(key))
+        self.shelter.delete()
+        self.assertIsNone(cache.get(key))
+
+
+class MapRendererTests(TestCase):
+    def test_folium_is_not_imported_at_startup(self):
+        code = ("import sys, django; django.setup(); import Watchdog.urls, gui.views; "
+                "print('folium' in sys.modules)")
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=settings.BASE_DIR, env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'Watchdog.settings'})
+        self.assertEqual(result.stdout.strip(), 'False', result.stderr)
+
+    def test_leaflet_renderer(self):
+        renderer = maps.get_renderer('gui.maps.leaflet.LeafletRenderer')
+        html = renderer.render(42.69, 23.32, 15, [maps.Marker(42.69, 23.32, '<b>priut</b>')])
+        self.assertIn('renderMarkerMap(', html)
+        self.assertIn('"latitude": 42.69', html)
+        # The tooltip is data, it must not end up in the page as markup
+        self.assertNotIn('<b>priut</b>', html)
+
+    @override_settings(MAP_RENDERER='gui.maps.leaflet.LeafletRenderer')
+    def test_shelter_page_with_leaflet_renderer(self):
+        cache.clear()
+        user = get_user_model().objects.create_user(username='shelter', password='123456', role='shelter')
+        response = self.client.get(reverse('shelter_details', kwargs={'pk': user.shelter.pk}))
+        self.assertContains(response, 'renderMarkerMap(')
+
+
+class ClusteredMapTests(TestCase):
+    def create_shelter(self, username, latitude, longitude):
+        user = get_user_model().objects.create_user(username=username, password='123456', role='shelter')
+        shelter = Shelter.objects.get(user=user)
+        shelter.name, shelter.latitude, shelter.longitude = username, latitude, longitude
+        shelter.save()
+        return shelter
+
+    def setUp(self):
+        cache.clear()
+        # Two shelters in Sofia, a few hundred metres apart, and one in Plovdiv
+        self.sofia1 = self.create_shelter('sofia1', 42.6960, 23.3200)
+        self.sofia2 = self.create_shelter('sofia2', 42.6990, 23.3240)
+        self.plovdiv = self.create_shelter('plovdiv', 42.1354, 24.7453)
+        for stage in ['active', 'in_process', 'completed']:
+            DogAdoptionPost.objects.create(name='dog', age=1, gender='male', breed='poroda', size='M',
+                                           shelter=self.sofia1, adoption_stage=stage)
+        DogAdoptionPost.objects.create(name='dog', age=1, gender='male', breed='poroda', size='M',
+                                       shelter=self.plovdiv)
+        get_user_model().objects.create_user(username='user', password='123456')
+        self.client.login(username='user', password='123456')
+
+    def tile_of(self, shelter, zoom):
+        x, y = clustering.tile_position(shelter.latitude, shelter.longitude, zoom)
+        return zoom, int(x), int(y)
+
+    def get_tile(self, zoom, x, y):
+        return self.client.get(reverse('shelter_map_tile', kwargs={'z': zoom, 'x': x, 'y': y}))
+
+    def test_tile_position(self):
+        self.assertEqual(clustering.tile_position(0, 0, 1), (1.0, 1.0))
+        self.assertEqual(self.tile_of(self.sofia1, 0), (0, 0, 0))
+
+    def test_close_shelters_are_clustered_at_low_zoom(self):
+        markers = self.get_tile(*self.tile_of(self.sofia1, 8)).json()['markers']
+        self.assertEqual(markers, [{'lat': mock.ANY, 'lon': mock.ANY, 'count': 2, 'dogs': 2}])
+
+    def test_close_shelters_are_separate_at_high_zoom(self):
+        markers = self.get_tile(*self.tile_of(self.sofia1, 16)).json()['markers']
+        self.assertEqual([marker['name'] for marker in markers], ['sofia1'])
+        self.assertEqual(markers[0]['dogs'], 2)
+        self.assertEqual(markers[0]['url'], reverse('shelter_details', kwargs={'pk': self.sofia1.pk}))
+
+    def test_whole_world_tile(self):
+        markers = self.get_tile(0, 0, 0).json()['markers']
+        self.assertEqual(sum(marker.get('count', 1) for marker in markers), 3)
+        self.assertEqual(sum(marker['dogs'] for marker in markers), 3)
+
+    def test_tiles_are_cached(self):
+        tile = self.tile_of(self.sofia1, 10)
+        with self.assertNumQueries(1):
+            clustering.tile(*tile)
+        with self.assertNumQueries(0):
+            clustering.tile(*tile)
+            # Other tiles are built from the cached shelter points
+            clustering.tile(*self.tile_of(self.plovdiv, 10))
+
+    def test_tiles_are_rebuilt_after_a_post_is_added(self):
+        tile = self.tile_of(self.plovdiv, 12)
+        self.assertEqual(clustering.tile(*tile)['markers'][0]['dogs'], 1)
+        DogAdoptionPost.objects.create(name='dog', age=1, gender='male', breed='poroda', size='M',
+                                       shelter=self.plovdiv)
+        self.assertEqual(clustering.tile(*tile)['markers'][0]['dogs'], 2)
+
+    def test_invalid_tile(self):
+        self.assertEqual(self.get_tile(2, 4, 0).status_code, 404)
+        self.assertEqual(self.get_tile(25, 0, 0).status_code, 404)
+
+    def test_map_page(self):
+        response = self.client.get(reverse('shelter_map'))
+        self.assertEqual(response.context['tile_url'], '/map/tiles/{z}/{x}/{y}.json')
+
+
+def make_image(color='red', size=(640, 480), image_format='PNG'):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.user = get_user_model().objects.create_user(username='shelter', password='123456', role='shelter')
+        self.client.login(username='shelter', password='123456')
+
+    def post_data(self, **extra):
+        data = {'name': 'Rex', 'age': 2, 'gender': 'male', 'breed': 'poroda', 'description': '', 'size': 'M',
+                'adoption_stage': 'active'}
+        data.update(extra)
+        return data
+
+    def create_post(self):
+        image = SimpleUploadedFile('rex.png', make_image(), content_type='image/png')
+        # The variants are built once the post is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('create_post'), self.post_data(image=image))
+        return DogAdoptionPost.objects.get()
+
+    def variant_paths(self, post):
+        return [os.path.join(self.media_root, name)
+                for names in post.image_variants.values() for name in names.values()]
+
+    def test_variants_are_built_on_create(self):
+        post = self.create_post()
+        self.assertEqual(set(post.image_variants), {'webp', 'jpeg'})
+        for variant_format, names in post.image_variants.items():
+            self.assertEqual(set(names), {'200', '400'})
+            for width, name in names.items():
+                with Image.open(os.path.join(self.media_root, name)) as variant:
+                    self.assertEqual(variant.size, (int(width), int(width)))
+                    self.assertEqual(variant.format, variant_format.upper())
+
+    def test_listing_uses_srcset_and_lazy_loading(self):
+        post = self.create_post()
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, f'/media/{post.image_variants["webp"]["400"]} 400w')
+        self.assertContains(response, 'loading="lazy"')
+
+    def test_variants_are_replaced_when_image_changes(self):
+        post = self.create_post()
+        old_paths = self.variant_paths(post)
+        image = SimpleUploadedFile('max.jpg', make_image('blue', image_format='JPEG'), content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit_post', kwargs={'pk': post.pk}), self.post_data(image=image))
+        post.refresh_from_db()
+        self.assertTrue(all(not os.path.exists(path) for path in old_paths))
+        self.assertTrue(all(os.path.exists(path) for path in self.variant_paths(post)))
+        self.assertNotIn(post.image_variants['jpeg']['200'], [os.path.relpath(path, self.media_root)
+                                                               for path in old_paths])
+
+    def test_variants_are_replaced_when_image_changes_in_admin(self):
+        post = self.create_post()
+        old_paths = self.variant_paths(post)
+        admin_user = get_user_model().objects.create_superuser(username='admin', password='123456')
+        self.client.force_login(admin_user)
+        image = SimpleUploadedFile('max.png', make_image('blue'), content_type='image/png')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('admin:gui_dogadoptionpost_change', args=[post.pk]),
+                                        self.post_data(shelter=post.shelter_id, shown_adoption_stage='active',
+                                                       image=image))
+        self.assertEqual(response.status_code, 302)
+        post.refresh_from_db()
+        self.assertTrue(all(not os.path.exists(path) for path in old_paths))
+        self.assertTrue(all(os.path.exists(path) for path in self.variant_paths(post)))
+        self.assertEqual(ListingEntry.objects.get(pk=post.pk).image_variants, post.image_variants)
+        self.assertNotIn(post.image_variants['jpeg']['200'], [os.path.relpath(path, self.media_root)
+                                                               for path in old_paths])
+
+    def test_variants_are_built_after_the_commit(self):
+        image = SimpleUploadedFile('rex.png', make_image(), content_type='image/png')
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('create_post'), self.post_data(image=image))
+        post = DogAdoptionPost.objects.get()
+        self.assertEqual(post.image_variants, {})
+        for callback in callbacks:
+            callback()
+        post.refresh_from_db()
+        self.assertEqual(len(self.variant_paths(post)), 4)
+        self.assertEqual(ListingEntry.objects.get(pk=post.pk).image_variants, post.image_variants)
+
+    def test_broken_photo_does_not_undo_the_edit(self):
+        post = self.create_post()
+        image = SimpleUploadedFile('broken.png', make_image('blue'), content_type='image/png')
+        with mock.patch('gui.images.build_variants', side_effect=OSError('broken')), \
+                self.assertLogs('django', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('edit_post', kwargs={'pk': post.pk}),
+                                 self.post_data(name='Novo ime', image=image))
+        post.refresh_from_db()
+        self.assertEqual(post.name, 'Novo ime')
+
+    def test_variants_are_kept_when_image_does_not_change(self):
+        post = self.create_post()
+        variants = post.image_variants
+        self.client.post(reverse('edit_post', kwargs={'pk': post.pk}), self.post_data(name='Novo ime'))
+        post.refresh_from_db()
+        self.assertEqual(post.image_variants, variants)
+        self.assertTrue(all(os.path.exists(path) for path in self.variant_paths(post)))
+
+    def test_variants_are_removed_with_post(self):
+        post = self.create_post()
+        paths = self.variant_paths(post)
+        with self.captureOnCommitCallbacks(execute=True):
+            post.delete()
+        self.assertTrue(all(not os.path.exists(path) for path in paths))
+
+    def test_build_command(self):
+        post = self.create_post()
+        DogAdoptionPost.objects.filter(pk=post.pk).update(image_variants={})
+        call_command('build_image_variants', stdout=StringIO())
+        post.refresh_from_db()
+        self.assertTrue(all(os.path.exists(path) for path in self.variant_paths(post)))
+        self.assertEqual(len(self.variant_paths(post)), 4)
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        override = override_settings(MEDIA_ROOT=self.media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.user = get_user_model().objects.create_user(username='shelter', password='123456', role='shelter')
+        self.client.login(username='shelter', password='123456')
+
+    def create_post(self, name, image_name='rex.png', color='red'):
+        image = SimpleUploadedFile(image_name, make_image(color), content_type='image/png')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('create_post'), {'name': name, 'age': 2, 'gender': 'male', 'breed': 'poroda',
+                                                      'description': '', 'size': 'M', 'adoption_stage': 'active',
+                                                      'image': image})
+        return DogAdoptionPost.objects.get(name=name)
+
+    def stored_files(self):
+        return sorted(os.path.relpath(os.path.join(directory, name), self.media_root)
+                      for directory, _, names in os.walk(self.media_root) for name in names)
+
+    def test_file_is_stored_by_content_hash(self):
+        post = self.create_post('Rex', image_name='Rex Photo.PNG')
+        digest = hashed_name_digest(post.image.name)
+        self.assertIsNotNone(digest)
+        self.assertEqual(post.image.name, f'dogs/{digest[:2]}/{digest[2:4]}/{digest}.png')
+
+    def test_identical_uploads_are_stored_once(self):
+        first = self.create_post('Rex')
+        files = self.stored_files()
+        second = self.create_post('Max', image_name='other-name.png')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(second.image_variants, first.image_variants)
+        self.assertEqual(self.stored_files(), files)
+
+    def test_file_written_concurrently_is_not_stored_again(self):
+        # Another request stores the same content between the check for the name and the write
+        storage = ContentAddressedStorage()
+        name = storage.save('dogs/rex.png', ContentFile(b'photo'))
+        storage.save_derived('thumbs/' + name, ContentFile(b'thumb'))
+        exists = ContentAddressedStorage.exists
+        checked = set()
+
+        def exists_once_missed(storage, checked_name):
+            # The stored files look missing at the first check
+            if checked_name in [name, 'thumbs/' + name] and checked_name not in checked:
+                checked.add(checked_name)
+                return False
+            return exists(storage, checked_name)
+
+        with mock.patch.object(ContentAddressedStorage, 'exists', exists_once_missed):
+            self.assertEqual(storage.save('dogs/max.png', ContentFile(b'photo')), name)
+            self.assertEqual(storage.save_derived('thumbs/' + name, ContentFile(b'thumb')), 'thumbs/' + name)
+        self.assertEqual(checked, {name, 'thumbs/' + name})
+        self.assertEqual(self.stored_files(), sorted([name, 'thumbs/' + name]))
+
+    def test_shared_file_is_deleted_with_its_last_post(self):
+        first = self.create_post('Rex')
+        second = self.create_post('Max')
+        files = self.stored_files()
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(self.stored_files(), files)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.stored_files(), [])
+
+    def test_lock_row_is_deleted_with_the_file(self):
+        first = self.create_post('Rex')
+        second = self.create_post('Max')
+        self.assertEqual(list(StoredFile.objects.values_list('name', flat=True)), [first.image.name])
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(StoredFile.objects.exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(StoredFile.objects.exists())
+
+    def test_file_is_not_visible_under_its_name_while_written(self):
+        storage = ContentAddressedStorage()
+        name = 'thumbs/dogs/rex-200.webp'
+        seen_while_writing = []
+
+        class Content(ContentFile):
+            def chunks(self, chunk_size=None):
+                yield b'half'
+                seen_while_writing.append(storage.exists(name))
+                yield b' of it'
+
+        self.assertEqual(storage.save_derived(name, Content(b'')), name)
+        self.assertEqual(seen_while_writing, [False])
+        with storage.open(name) as file:
+            self.assertEqual(file.read(), b'half of it')
+        self.assertEqual(self.stored_files(), [name])
+
+    def test_files_are_kept_when_the_delete_is_rolled_back(self):
+        post = self.create_post('Rex')
+        post_pk = post.pk
+        files = self.stored_files()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    post.delete()
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertTrue(DogAdoptionPost.objects.filter(pk=post_pk).exists())
+        self.assertEqual(self.stored_files(), files)
+
+    def test_photo_saved_with_another_post_before_the_release_is_kept(self):
+        # The second post reuses the stored photo before the deletion of the first one is committed
+        first = self.create_post('Rex')
+        files = self.stored_files()
+        with self.captureOnCommitCallbacks() as callbacks:
+            first.delete()
+        self.assertEqual(self.stored_files(), files)
+        second = self.create_post('Max')
+        self.assertEqual(second.image.name, first.image.name)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.stored_files(), files)
+
+    def test_variants_are_not_shared_between_different_photos(self):
+        # The same pixels with different metadata: different photos, but identical variants
+        first = self.create_post('Rex')
+        metadata = PngImagePlugin.PngInfo()
+        metadata.add_text('Comment', 'taken at the shelter')
+        buffer = BytesIO()
+        Image.new('RGB', (640, 480), 'red').save(buffer, 'PNG', pnginfo=metadata)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('create_post'), {'name': 'Max', 'age': 2, 'gender': 'male', 'breed': 'poroda',
+                                                      'description': '', 'size': 'M', 'adoption_stage': 'active',
+                                                      'image': SimpleUploadedFile('max.png', buffer.getvalue())})
+        second = DogAdoptionPost.objects.get(name='Max')
+        self.assertNotEqual(first.image.name, second.image.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        paths = [os.path.join(self.media_root, name)
+                 for names in second.image_variants.values() for name in names.values()]
+        self.assertEqual(len(paths), 4)
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+    def test_variants_are_served_as_immutable(self):
+        post = self.create_post('Rex')
+        name = post.image_variants['webp']['200']
+        self.assertIsNotNone(hashed_name_digest(name))
+        response = self.client.get(f'/media/{name}')
+        self.assertIn('immutable', response['Cache-Control'])
+        response.close()
+
+    def test_replacing_a_shared_photo_keeps_it_for_the_other_post(self):
+        first = self.create_post('Rex')
+        second = self.create_post('Max')
+        image = SimpleUploadedFile('blue.png', make_image('blue'), content_type='image/png')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit_post', kwargs={'pk': second.pk}), {
+                'name': 'Max', 'age': 2, 'gender': 'male', 'breed': 'poroda', 'description': '', 'size': 'M',
+                'adoption_stage': 'active', 'image': image})
+        second.refresh_from_db()
+        self.assertNotEqual(second.image.name, first.image.name)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, first.image.name)))
+        for names in first.image_variants.values():
+            for name in names.values():
+                self.assertTrue(os.path.exists(os.path.join(self.media_root, name)))
+
+    def test_media_is_served_as_immutable_with_strong_etag(self):
+        post = self.create_post('Rex')
+        response = self.client.get(post.image.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['ETag'], f'"{hashed_name_digest(post.image.name)}"')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(b''.join(response.streaming_content), post.image.read())
+
+        response = self.client.get(post.image.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_range_request(self):
+        post = self.create_post('Rex')
+        content = post.image.read()
+        response = self.client.get(post.image.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(content)}')
+        self.assertEqual(b''.join(response.streaming_content), content[10:20])
+
+        response = self.client.get(post.image.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), content[-5:])
+
+        response = self.client.get(post.image.url, HTTP_RANGE=f'bytes={len(content)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(content)}')
+
+    def test_range_is_ignored_for_another_version(self):
+        post = self.create_post('Rex')
+        response = self.client.get(post.image.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"something-else"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        post = self.create_post('Rex')
+        response = self.client.get(post.image.url)
+        response = self.client.get(post.image.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(MEDIA_ACCEL='nginx')
+    def test_x_accel_redirect(self):
+        post = self.create_post('Rex')
+        response = self.client.get(post.image.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{post.image.name}')
+        self.assertEqual(response.content, b'')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    @override_settings(MEDIA_ACCEL='sendfile')
+    def test_x_sendfile(self):
+        post = self.create_post('Rex')
+        response = self.client.get(post.image.url)
+        self.assertEqual(response['X-Sendfile'], os.path.join(self.media_root, post.image.name))
+
+    def create_legacy_file(self, name):
+        """A file with the original name of the upload, as stored before the content-addressed storage"""
+        os.makedirs(os.path.join(self.media_root, 'dogs'), exist_ok=True)
+        with open(os.path.join(self.media_root, 'dogs', name), 'wb') as file:
+            file.write(make_image('red'))
+        return f'/media/dogs/{quote(name)}'
+
+    @override_settings(MEDIA_ACCEL='nginx')
+    def test_x_accel_redirect_of_legacy_names_is_percent_encoded(self):
+        for name, encoded in [('тест-пропорции.png', '%D1%82%D0%B5%D1%81%D1%82-%D0%BF%D1%80%D0%BE%D0%BF%D0%BE%D1%80'
+                                                    '%D1%86%D0%B8%D0%B8.png'),
+                              ('my dog 100%.png', 'my%20dog%20100%25.png')]:
+            with self.subTest(name=name):
+                response = self.client.get(self.create_legacy_file(name))
+                self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/dogs/{encoded}')
+
+    @override_settings(MEDIA_ACCEL='sendfile')
+    def test_non_ascii_legacy_name_is_sent_by_django_with_sendfile(self):
+        response = self.client.get(self.create_legacy_file('тест-пропорции.png'))
+        self.assertFalse(response.has_header('X-Sendfile'))
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(b''.join(response.streaming_content), make_image('red'))
+        self.assertNotIn('immutable', response['Cache-Control'])
+
+    def test_only_public_directories_are_served(self):
+        with open(os.path.join(self.media_root, 'secret.txt'), 'w') as file:
+            file.write('secret')
+        self.assertEqual(self.client.get('/media/secret.txt').status_code, 404)
+
+    def test_private_files_are_not_reached_through_a_public_directory(self):
+        os.makedirs(os.path.join(self.media_root, 'private'))
+        os.makedirs(os.path.join(self.media_root, 'dogs'))
+        with open(os.path.join(self.media_root, 'private', 'secret.txt'), 'w') as file:
+            file.write('secret')
+        for url in ['/media/private/secret.txt', '/media/dogs/../private/secret.txt',
+                    '/media/dogs/%2e%2e/private/secret.txt', '/media/dogs/./../private/secret.txt']:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+    @override_settings(MEDIA_ACCEL='nginx')
+    def test_x_accel_redirect_uses_the_normalised_path(self):
+        post = self.create_post('Rex')
+        directory, name = post.image.name.rsplit('/', 1)
+        response = self.client.get(f'/media/{directory}/./../{directory.rsplit("/", 1)[1]}//{name}')
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{post.image.name}')
+
+    def test_missing_media_is_not_found(self):
+        self.assertEqual(self.client.get(f'/media/dogs/00/00/{"0" * 64}.png').status_code, 404)
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, 404)
+
+
 class AdoptionStatusTests(TestCase):
 
     def setUp(self):
@@ -704,6 +2064,14 @@ class SubscriptionTests(TestCase):
         self.assertRedirects(response, reverse('index'))
         self.assertFalse(PostSubscription.objects.filter(user=self.user, post=self.dog_post).exists())
 
+    def test_subscription_is_not_changed_by_get(self):
+        self.client.login(username='user', password='123456')
+        self.assertEqual(self.client.get(reverse('subscribe', args=[self.dog_post.id])).status_code, 405)
+        self.assertFalse(PostSubscription.objects.filter(user=self.user, post=self.dog_post).exists())
+        PostSubscription.objects.create(user=self.user, post=self.dog_post)
+        self.assertEqual(self.client.get(reverse('unsubscribe', args=[self.dog_post.id])).status_code, 405)
+        self.assertTrue(PostSubscription.objects.filter(user=self.user, post=self.dog_post).exists())
+
     def test_post_creator_cannot_subscribe(self):
         self.client.login(username='shelter_user', password='123456')
         response = self.client.post(reverse('subscribe', args=[self.dog_post.id]))
@@ -778,6 +2146,58 @@ class SubscriptionTests(TestCase):
         self.assertTrue(PostSubscription.objects.filter(user=self.user, post=self.dog_post).exists())
         self.assertFalse(PostSubscription.objects.filter(user=new_user, post=self.dog_post).exists())
 
+    def test_subscribe_to_second_post(self):
+        other_post = DogAdoptionPost.objects.create(name='sharo', age=2, gender='male', breed='chihlala',
+                                                    shelter=self.shelter, size='S', adoption_stage='in_process')
+        PostSubscription.objects.create(user=self.user, post=other_post)
+        self.client.login(username='user', password='123456')
+        self.client.post(reverse('subscribe', args=[self.dog_post.id]))
+        self.assertEqual(set(self.user.subscriptions.values_list('post_id', flat=True)),
+                         {self.dog_post.pk, other_post.pk})
+
+    def test_subscribe_is_idempotent(self):
+        self.client.login(username='user', password='123456')
+        for _ in range(2):
+            response = self.client.post(reverse('subscribe', args=[self.dog_post.id]),
+                                        HTTP_ACCEPT='application/json')
+            self.assertEqual(response.json(), {'post': self.dog_post.pk, 'subscribed': True})
+        self.assertEqual(PostSubscription.objects.filter(user=self.user, post=self.dog_post).count(), 1)
+
+    def test_unsubscribe_is_idempotent(self):
+        PostSubscription.objects.create(user=self.user, post=self.dog_post)
+        self.client.login(username='user', password='123456')
+        for _ in range(2):
+            response = self.client.post(reverse('unsubscribe', args=[self.dog_post.id]),
+                                        HTTP_ACCEPT='application/json')
+            self.assertEqual(response.json(), {'post': self.dog_post.pk, 'subscribed': False})
+        self.assertFalse(PostSubscription.objects.filter(user=self.user, post=self.dog_post).exists())
+
+    def test_subscribe_and_unsubscribe_are_one_statement(self):
+        self.client.login(username='user', password='123456')
+        for url in ['subscribe', 'unsubscribe']:
+            with CaptureQueriesContext(connection) as context:
+                self.client.post(reverse(url, args=[self.dog_post.id]), HTTP_ACCEPT='application/json')
+            # The other queries load the session and the user, and update the subscriber count of the listing
+            statements = [query['sql'] for query in context.captured_queries
+                          if 'gui_postsubscription' in query['sql'] and 'gui_listingentry' not in query['sql']]
+            self.assertEqual(len(statements), 1, statements)
+
+    def test_post_creator_cannot_subscribe_json(self):
+        self.client.login(username='shelter_user', password='123456')
+        response = self.client.post(reverse('subscribe', args=[self.dog_post.id]), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(PostSubscription.objects.filter(user=self.shelter_user).exists())
+
+    def test_subscribe_to_missing_post(self):
+        self.client.login(username='user', password='123456')
+        response = self.client.post(reverse('subscribe', args=[self.dog_post.id + 100]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_duplicate_subscription_rejected(self):
+        PostSubscription.objects.create(user=self.user, post=self.dog_post)
+        with self.assertRaises(IntegrityError):
+            PostSubscription.objects.create(user=self.user, post=self.dog_post)
+
     def test_subscription_deleted_with_post(self):
         """Test if a subscription is automatically deleted after a post is deleted"""
         post_id = self.dog_post.id
@@ -790,7 +2210,7 @@ class NotificationTests(TestCase):
 
     def setUp(self):
         self.user = get_user_model().objects.create_user(username='user', password='123456')
-        self.notification = Notification.objects.create(recipient=self.user, message='test test', is_read=False)
+        self.notification = Notification.objects.create(recipient=self.user, message='test test')
 
         self.shelter_user = get_user_model().objects.create_user(username='shelter_user', password='123456',
                                                                  role='shelter')
@@ -809,15 +2229,22 @@ class NotificationTests(TestCase):
         """Test if notifications are marked as 'read' after the user exists the 'notifications' page"""
         self.client.login(username='user', password='123456')
         self.client.get(reverse('notifications'))
-        self.client.get(reverse('mark_notifications_read'))
+        self.client.post(reverse('mark_notifications_read'))
         self.notification.refresh_from_db()
         self.assertTrue(self.notification.is_read)
 
+    def test_notifications_are_not_marked_read_by_get(self):
+        self.client.login(username='user', password='123456')
+        self.assertEqual(self.client.get(reverse('mark_notifications_read')).status_code, 405)
+        self.notification.refresh_from_db()
+        self.assertFalse(self.notification.is_read)
+
     def test_receive_notification(self):
         """Test if the user receives a notification once the status of a post changes to 'active'"""
         PostSubscription.objects.create(user=self.user, post=self.dog_post)
         self.dog_post.adoption_stage = 'active'
         self.dog_post.save()
+        notifications.process_pending_jobs()
         self.client.login(username='user', password='123456')
         response = self.client.get(reverse('notifications'))
         self.assertContains(response, f"{self.dog_post.name} is available for adoption.")
@@ -833,17 +2260,55 @@ class NotificationTests(TestCase):
         """Test if after receiving a new message the old ones remain read and the new one is unread"""
         self.client.login(username='user', password='123456')
         self.client.get(reverse('notifications'))
-        self.client.get(reverse('mark_notifications_read')) # Simulate opening and closing the page
+        self.client.post(reverse('mark_notifications_read')) # Simulate opening and closing the page
         self.notification.refresh_from_db()
         self.assertTrue(self.notification.is_read)
 
-        new_notification = Notification.objects.create(recipient=self.user, message='nowo', is_read=False)
+        new_notification = Notification.objects.create(recipient=self.user, message='nowo')
 
         self.client.get(reverse('notifications'))
         new_notification.refresh_from_db()
         self.assertFalse(new_notification.is_read)
         self.assertTrue(self.notification.is_read)
 
+    def test_mark_read_is_one_write(self):
+        for i in range(30):
+            Notification.objects.create(recipient=self.user, message=f'message {i}')
+        with CaptureQueriesContext(connection) as context:
+            notifications.mark_read(self.user)
+        writes = [query for query in context.captured_queries if not query['sql'].startswith('SELECT')]
+        self.assertEqual(len(writes), 1)
+        self.assertFalse(notifications.unread(self.user).exists())
+
+    def test_mark_read_up_to_the_shown_notifications(self):
+        """Notifications that arrived after the page was rendered stay unread"""
+        self.client.login(username='user', password='123456')
+        response = self.client.get(reverse('notifications'))
+        newer = Notification.objects.create(recipient=self.user, message='newer')
+        self.client.post(reverse('mark_notifications_read'), {'up_to': response.context['newest_id']})
+        self.user.refresh_from_db()
+        self.assertEqual(list(notifications.unread(self.user)), [newer])
+
+    def test_watermark_does_not_move_backwards(self):
+        newer = Notification.objects.create(recipient=self.user, message='newer')
+        notifications.mark_read(self.user)
+        notifications.mark_read(self.user, up_to=self.notification.pk)
+        self.assertEqual(self.user.last_read_notification_id, newer.pk)
+
+    def test_watermark_ignores_notifications_of_other_users(self):
+        other = Notification.objects.create(recipient=self.shelter_user, message='not yours')
+        notifications.mark_read(self.user, up_to=other.pk + 100)
+        self.assertEqual(self.user.last_read_notification_id, self.notification.pk)
+
+    def test_unread_notifications_are_highlighted(self):
+        self.client.login(username='user', password='123456')
+        response = self.client.get(reverse('notifications'))
+        self.assertContains(response, 'class="notification unread"')
+        self.assertContains(response, reverse('mark_notifications_read'))
+        notifications.mark_read(self.user)
+        response = self.client.get(reverse('notifications'))
+        self.assertNotContains(response, 'class="notification unread"')
+
     def test_multiple_subscribers_notification(self):
         """Test if multiple subscribers subscribed to the same post get a notification when status changes"""
         user2 = get_user_model().objects.create_user(username='user2', password='123456')
@@ -854,6 +2319,7 @@ class NotificationTests(TestCase):
 
         self.dog_post.adoption_stage = 'active'
         self.dog_post.save()
+        notifications.process_pending_jobs()
 
         self.assertEqual(Notification.objects.filter(message__contains=self.dog_post.name).count(), 3)
 
@@ -862,3 +2328,711 @@ class NotificationTests(TestCase):
         post_id = self.dog_post.id
         self.dog_post.delete()
         self.assertFalse(Notification.objects.filter(related_post_id=post_id).exists(), )
+
+
+class NotificationJobTests(TestCase):
+    def setUp(self):
+        self.shelter_user = get_user_model().objects.create_user(username='shelter_user', password='123456',
+                                                                 role='shelter')
+        self.shelter = Shelter.objects.get(user=self.shelter_user)
+        self.dog_post = DogAdoptionPost.objects.create(name='kucho', age=1, gender='male', breed='chihlala',
+                                                       shelter=self.shelter, size='XL', adoption_stage='in_process')
+        self.users = [get_user_model().objects.create(username=f'user{i}') for i in range(7)]
+        for user in self.users:
+            PostSubscription.objects.create(user=user, post=self.dog_post)
+
+    def make_active(self):
+        self.dog_post.adoption_stage = 'active'
+        self.dog_post.save()
+
+    def test_status_change_only_enqueues_a_job(self):
+        self.make_active()
+        self.assertEqual(Notification.objects.count(), 0)
+        job = NotificationJob.objects.get()
+        self.assertEqual(job.post, self.dog_post)
+        self.assertEqual(job.message, 'kucho is available for adoption.')
+
+    def test_save_cost_does_not_depend_on_number_of_subscribers(self):
+        with CaptureQueriesContext(connection) as few_subscribers:
+            self.make_active()
+        self.dog_post.adoption_stage = 'in_process'
+        self.dog_post.save()
+        for i in range(20):
+            PostSubscription.objects.create(user=get_user_model().objects.create(username=f'other{i}'),
+                                            post=self.dog_post)
+        with CaptureQueriesContext(connection) as many_subscribers:
+            self.make_active()
+        self.assertEqual(len(few_subscribers), len(many_subscribers))
+
+    def test_notifications_are_written_in_batches(self):
+        self.make_active()
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(notifications.process_pending_jobs(batch_size=3), 1)
+        inserts = [query for query in context.captured_queries
+                   if query['sql'].startswith('INSERT INTO "gui_notification"')]
+        # 7 subscribers in batches of 3
+        self.assertEqual(len(inserts), 3)
+        self.assertCountEqual(Notification.objects.values_list('recipient', flat=True),
+                              [user.pk for user in self.users])
+        self.assertFalse(NotificationJob.objects.exists())
+
+    def test_failed_job_continues_where_it_stopped(self):
+        self.make_active()
+        original_upsert = notifications.upsert
+        calls = []
+
+        def failing_upsert(user_ids, *args, **kwargs):
+            calls.append(user_ids)
+            if len(calls) == 2:
+                raise RuntimeError('database is locked')
+            return original_upsert(user_ids, *args, **kwargs)
+
+        with mock.patch.object(notifications, 'upsert', side_effect=failing_upsert):
+            notifications.process_pending_jobs(batch_size=3)
+        job = NotificationJob.objects.get()
+        self.assertEqual(job.status, 'pending')
+        self.assertIn('database is locked', job.last_error)
+        self.assertEqual(Notification.objects.count(), 3)
+
+        notifications.process_pending_jobs(batch_size=3)
+        self.assertEqual(Notification.objects.count(), 7)
+        self.assertEqual(Notification.objects.values('recipient').distinct().count(), 7)
+
+    @override_settings(NOTIFICATION_JOB_MAX_ATTEMPTS=2)
+    def test_job_is_marked_failed_after_too_many_attempts(self):
+        self.make_active()
+        with mock.patch.object(notifications, 'process_job', side_effect=RuntimeError):
+            notifications.process_pending_jobs()
+            notifications.process_pending_jobs()
+        self.assertEqual(NotificationJob.objects.get().status, 'failed')
+        self.assertEqual(notifications.process_pending_jobs(), 0)
+
+    def test_claimed_job_is_not_taken_by_another_worker(self):
+        self.make_active()
+        self.assertIsNotNone(notifications.claim_next_job())
+        self.assertIsNone(notifications.claim_next_job())
+
+    def test_command(self):
+        self.make_active()
+        out = StringIO()
+        call_command('process_notification_jobs', stdout=out)
+        self.assertIn('Processed 1 notification job(s).', out.getvalue())
+        self.assertEqual(Notification.objects.count(), 7)
+
+
+class AdoptionStageTransitionTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='shelter', password='123456', role='shelter')
+        self.shelter = Shelter.objects.get(user=self.user)
+        self.post = DogAdoptionPost.objects.create(name='kucho', age=1, gender='male', breed='chihlala',
+                                                   shelter=self.shelter, size='XL', adoption_stage='in_process')
+        PostSubscription.objects.create(user=get_user_model().objects.create(username='subscriber'), post=self.post)
+
+    def test_save_does_not_read_the_post_again(self):
+        post = DogAdoptionPost.objects.get(pk=self.post.pk)
+        post.adoption_stage = 'active'
+        with CaptureQueriesContext(connection) as context:
+            post.save()
+        self.assertFalse([query for query in context.captured_queries
+                          if query['sql'].startswith('SELECT') and 'gui_dogadoptionpost' in query['sql']])
+        self.assertEqual(NotificationJob.objects.count(), 1)
+
+    def test_save_without_stage_change_sends_no_signal(self):
+        post = DogAdoptionPost.objects.get(pk=self.post.pk)
+        post.name = 'kuchence'
+        with mock.patch('gui.models.adoption_stage_changed.send') as send:
+            post.save()
+        send.assert_not_called()
+        self.assertFalse(NotificationJob.objects.exists())
+
+    def test_stage_left_out_of_update_fields_is_saved_later(self):
+        post = DogAdoptionPost.objects.get(pk=self.post.pk)
+        post.adoption_stage = 'active'
+        post.name = 'kuchence'
+        post.save(update_fields=['name'])
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.name, self.post.adoption_stage), ('kuchence', 'in_process'))
+        self.assertFalse(NotificationJob.objects.exists())
+
+        post.save()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.adoption_stage, 'active')
+        self.assertEqual(NotificationJob.objects.count(), 1)
+
+    def test_save_after_refresh_compares_with_the_reloaded_stage(self):
+        post = DogAdoptionPost.objects.get(pk=self.post.pk)
+        DogAdoptionPost.objects.get(pk=self.post.pk).transition_stage('active')
+        post.refresh_from_db()
+        post.name = 'kuchence'
+        post.save()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.name, self.post.adoption_stage), ('kuchence', 'active'))
+
+        DogAdoptionPost.objects.get(pk=self.post.pk).transition_stage('in_process')
+        post.refresh_from_db(fields=['adoption_stage'])
+        post.adoption_stage = 'completed'
+        post.save()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.adoption_stage, 'completed')
+
+    def test_transition_stage(self):
+        self.post.transition_stage('active', expected='in_process')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.adoption_stage, 'active')
+        self.assertEqual(NotificationJob.objects.count(), 1)
+
+    def test_concurrent_change_is_rejected(self):
+        first = DogAdoptionPost.objects.get(pk=self.post.pk)
+        second = DogAdoptionPost.objects.get(pk=self.post.pk)
+        first.adoption_stage = 'active'
+        first.save()
+
+        second.adoption_stage = 'completed'
+        second.name = 'lost update'
+        with self.assertRaises(AdoptionStageConflict):
+            second.save()
+        self.post.refresh_from_db()
+        # Neither the stage nor the other fields of the outdated edit were written
+        self.assertEqual(self.post.adoption_stage, 'active')
+        self.assertEqual(self.post.name, 'kucho')
+        # Only the transition that really happened queued notifications
+        self.assertEqual(NotificationJob.objects.count(), 1)
+
+    def test_outdated_instance_does_not_write_back_stage(self):
+        first = DogAdoptionPost.objects.get(pk=self.post.pk)
+        second = DogAdoptionPost.objects.get(pk=self.post.pk)
+        first.adoption_stage = 'active'
+        first.save()
+
+        # 'second' still holds 'in_process', but it only edits the description
+        second.description = 'loves children'
+        second.save()
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.adoption_stage, self.post.description), ('active', 'loves children'))
+        self.assertEqual(ListingEntry.objects.get(post=self.post).adoption_stage, 'active')
+        self.assertEqual(NotificationJob.objects.count(), 1)
+
+    def test_only_one_of_two_equal_transitions_notifies(self):
+        first = DogAdoptionPost.objects.get(pk=self.post.pk)
+        second = DogAdoptionPost.objects.get(pk=self.post.pk)
+        first.transition_stage('active')
+        with self.assertRaises(AdoptionStageConflict):
+            second.transition_stage('active')
+        self.assertEqual(NotificationJob.objects.count(), 1)
+
+    def test_edit_view_reports_conflict(self):
+        self.client.login(username='shelter', password='123456')
+        with mock.patch.object(DogAdoptionPost, 'transition_stage', side_effect=AdoptionStageConflict):
+            response = self.client.post(reverse('edit_post', args=[self.post.pk]), {
+                'name': 'renamed', 'age': 1, 'gender': 'male', 'breed': 'chihlala', 'description': '',
+                'size': 'XL', 'adoption_stage': 'active',
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'was changed in the meantime')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.name, 'kucho')
+        self.assertEqual(self.post.adoption_stage, 'in_process')
+
+    def edit_post(self, shown_stage, **changes):
+        data = {'name': 'kucho', 'age': 1, 'gender': 'male', 'breed': 'chihlala', 'description': '', 'size': 'XL',
+                'adoption_stage': shown_stage, 'shown_adoption_stage': shown_stage}
+        data.update(changes)
+        return self.client.post(reverse('edit_post', args=[self.post.pk]), data)
+
+    def test_edit_form_carries_the_shown_stage(self):
+        self.client.login(username='shelter', password='123456')
+        response = self.client.get(reverse('edit_post', args=[self.post.pk]))
+        self.assertContains(response, '<input type="hidden" name="shown_adoption_stage" value="in_process" '
+                                      'id="id_shown_adoption_stage">', html=True)
+
+    def test_edit_does_not_undo_a_change_made_while_the_form_was_open(self):
+        self.client.login(username='shelter', password='123456')
+        # The form was shown with 'in_process', then an administrator made the dog available
+        DogAdoptionPost.objects.get(pk=self.post.pk).transition_stage('active')
+        response = self.edit_post('in_process', description='loves cats')
+        self.assertEqual(response.status_code, 302)
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.description, self.post.adoption_stage), ('loves cats', 'active'))
+        self.assertEqual(ListingEntry.objects.get(pk=self.post.pk).adoption_stage, 'active')
+
+    def test_edit_of_the_stage_shown_before_a_concurrent_change_is_rejected(self):
+        self.client.login(username='shelter', password='123456')
+        DogAdoptionPost.objects.get(pk=self.post.pk).transition_stage('active')
+        response = self.edit_post('in_process', adoption_stage='completed', description='adopted')
+        self.assertContains(response, 'was changed in the meantime')
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.description, self.post.adoption_stage), ('', 'active'))
+
+    def test_admin_conflict_is_not_logged(self):
+        admin_user = get_user_model().objects.create_superuser(username='admin', password='123456')
+        self.client.force_login(admin_user)
+        url = reverse('admin:gui_dogadoptionpost_change', args=[self.post.pk])
+        form = self.client.get(url).context['adminform'].form
+        self.assertEqual(form['shown_adoption_stage'].value(), 'in_process')
+        DogAdoptionPost.objects.get(pk=self.post.pk).transition_stage('active')
+        response = self.client.post(url, {
+            'name': 'kucho', 'age': 1, 'gender': 'male', 'breed': 'chihlala', 'description': '', 'size': 'XL',
+            'shelter': self.shelter.pk, 'adoption_stage': 'completed', 'shown_adoption_stage': 'in_process',
+        })
+        self.assertRedirects(response, url, fetch_redirect_response=False)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.adoption_stage, 'active')
+        self.assertFalse(LogEntry.objects.exists())
+
+
+class UnreadNotificationCountTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='user', password='123456')
+        self.shelter_user = get_user_model().objects.create_user(username='shelter_user', password='123456',
+                                                                 role='shelter')
+        self.dog_post = DogAdoptionPost.objects.create(name='kucho', age=1, gender='male', breed='chihlala',
+                                                       shelter=Shelter.objects.get(user=self.shelter_user),
+                                                       size='XL', adoption_stage='in_process')
+        PostSubscription.objects.create(user=self.user, post=self.dog_post)
+
+    def notify(self):
+        self.dog_post.adoption_stage = 'active'
+        self.dog_post.save()
+        notifications.process_pending_jobs()
+        self.dog_post.adoption_stage = 'in_process'
+        self.dog_post.save()
+
+    def test_counter_follows_new_and_read_notifications(self):
+        self.notify()
+        Notification.objects.create(recipient=self.user, message='other')
+        get_user_model().objects.filter(pk=self.user.pk).update(unread_notification_count=2)
+        self.notify()
+        self.user.refresh_from_db()
+        # The second notification about the post was collapsed into the first one
+        self.assertEqual(self.user.unread_notification_count, 2)
+        notifications.mark_read(self.user)
+        self.assertEqual(self.user.unread_notification_count, 0)
+        self.notify()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.unread_notification_count, 1)
+
+    def test_partial_mark_read_keeps_newer_notifications_counted(self):
+        first = Notification.objects.create(recipient=self.user, message='first')
+        self.notify()
+        notifications.mark_read(self.user, up_to=first.pk)
+        self.assertEqual(self.user.unread_notification_count, 1)
+
+    def test_badge_does_not_count_notifications(self):
+        self.notify()
+        self.client.login(username='user', password='123456')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('archive_page'))
+        self.assertEqual(response.context['unread_notification_count'], 1)
+        self.assertContains(response, '<span class="badge">1</span>', html=True)
+        self.assertFalse([query for query in context.captured_queries if 'gui_notification"' in query['sql']])
+
+    def test_reconcile_command(self):
+        self.notify()
+        # Notifications written around the counter, e.g. from the admin
+        Notification.objects.create(recipient=self.user, message='extra')
+        get_user_model().objects.filter(pk=self.shelter_user.pk).update(unread_notification_count=5)
+        out = StringIO()
+        call_command('reconcile_unread_counts', stdout=out)
+        self.assertIn('Corrected the unread notification count of 2 user(s).', out.getvalue())
+        self.user.refresh_from_db()
+        self.shelter_user.refresh_from_db()
+        self.assertEqual(self.user.unread_notification_count, 2)
+        self.assertEqual(self.shelter_user.unread_notification_count, 0)
+
+
+class NotificationInboxTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='user', password='123456')
+        self.other = get_user_model().objects.create_user(username='other', password='123456')
+        now = timezone.now()
+        self.old = [Notification.objects.create(recipient=self.user, message=f'old {i}',
+                                                created=now - timedelta(days=100)) for i in range(5)]
+        self.recent = Notification.objects.create(recipient=self.user, message='recent', created=now)
+        self.others_old = Notification.objects.create(recipient=self.other, message='unread and old',
+                                                      created=now - timedelta(days=100))
+
+    @override_settings(NOTIFICATIONS_PAGE_SIZE=4)
+    def test_inbox_is_paginated_newest_first(self):
+        self.client.login(username='user', password='123456')
+        response = self.client.get(reverse('notifications'))
+        self.assertEqual([n.message for n in response.context['notifications']],
+                         ['recent', 'old 4', 'old 3', 'old 2'])
+        response = self.client.get(reverse('notifications') + response.context['page'].next_page_url)
+        self.assertEqual([n.message for n in response.context['notifications']], ['old 1', 'old 0'])
+
+    def test_purge_deletes_only_old_read_notifications(self):
+        notifications.mark_read(self.user)
+        out = StringIO()
+        call_command('purge_notifications', '--days', '30', '--batch-size', '2', stdout=out)
+        self.assertIn('Deleted 5 read notification(s)', out.getvalue())
+        # The recent notification and the unread one of the other user are kept
+        self.assertQuerySetEqual(Notification.objects.order_by('pk'), [self.recent, self.others_old])
+
+    def test_purge_works_in_batches(self):
+        notifications.mark_read(self.user)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(notifications.purge_read(timezone.now() - timedelta(days=30), batch_size=2), 5)
+        deletes = [query for query in context.captured_queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+
+    def test_unread_notifications_are_kept(self):
+        notifications.mark_read(self.user, up_to=self.old[1].pk)
+        notifications.purge_read(timezone.now() - timedelta(days=30))
+        self.assertEqual(Notification.objects.filter(recipient=self.user).count(), 4)
+
+
+@override_settings(SSE_POLL_INTERVAL=0.05, SSE_MAX_DURATION=0.3)
+# The streams read in the loop's thread pool, with their own connections, so the rows must be committed
+@override_settings(NOTIFICATION_TRANSPORT='sse')
+class NotificationStreamTests(TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='user', password='123456')
+        self.first = Notification.objects.create(recipient=self.user, message='first')
+        self.second = Notification.objects.create(recipient=self.user, message='second')
+        Notification.objects.create(recipient=get_user_model().objects.create(username='other'), message='other')
+
+    async def read_stream(self, **extra):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('notification_stream'), **extra)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+    def events(self, stream):
+        return [json.loads(line[len('data: '):]) for line in stream.splitlines() if line.startswith('data: ')]
+
+    async def test_stream_starts_after_the_newest_notification(self):
+        stream = await self.read_stream()
+        self.assertTrue(stream.startswith('retry: '))
+        self.assertEqual(self.events(stream), [])
+        self.assertIn(': heartbeat', stream)
+
+    async def test_stream_continues_after_last_event_id(self):
+        stream = await self.read_stream(headers={'Last-Event-ID': str(self.first.pk)})
+        self.assertEqual([event['message'] for event in self.events(stream)], ['second'])
+        self.assertIn(f'id: {self.second.pk}\nevent: notification\n', stream)
+
+    async def test_stream_polls_for_notifications_from_other_processes(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('notification_stream'))
+        stream = response.streaming_content
+        await anext(stream)
+        # Written without publishing, as the job worker of another process would
+        await Notification.objects.acreate(recipient=self.user, message='polled')
+        chunk = await asyncio.wait_for(anext(stream), timeout=1)
+        self.assertIn(b'polled', chunk)
+        await stream.aclose()
+
+    @override_settings(SSE_POLL_INTERVAL=60, SSE_MAX_DURATION=60)
+    async def test_published_notification_wakes_the_stream(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('notification_stream'))
+        stream = response.streaming_content
+        await anext(stream)
+        channel = pubsub.notification_channel(self.user.pk)
+        self.assertEqual(pubsub.broker.subscriber_count(channel), 1)
+
+        await Notification.objects.acreate(recipient=self.user, message='pushed')
+        notifications.publish([self.user.pk])
+        # Without the wake-up the stream would only look again after a minute
+        chunk = await asyncio.wait_for(anext(stream), timeout=1)
+        self.assertIn(b'pushed', chunk)
+        # What Django does when the client disconnects
+        await stream.aclose()
+        response.close()
+        self.assertEqual(pubsub.broker.subscriber_count(channel), 0)
+
+    @override_settings(SSE_POLL_INTERVAL=60, SSE_MAX_DURATION=60, SSE_WAKEUP_INTERVAL=0.05)
+    async def test_notifications_of_the_job_worker_of_another_process_wake_the_stream(self):
+        shelter_user = await get_user_model().objects.acreate(username='shelter', role='shelter')
+        post = await DogAdoptionPost.objects.acreate(name='kucho', age=1, gender='male', breed='chihlala', size='XL',
+                                                     shelter=await Shelter.objects.aget(user=shelter_user))
+        await PostSubscription.objects.acreate(user=self.user, post=post)
+        await sync_to_async(notifications.enqueue)(post, 'kucho is available for adoption.')
+
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('notification_stream'))
+        stream = response.streaming_content
+        await anext(stream)
+        # Let the stream find nothing and wait
+        next_chunk = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0.2)
+        self.assertFalse(next_chunk.done())
+        # The wake-ups of a worker in another process never reach the streams of this one
+        with mock.patch.object(notifications, 'publish'):
+            await sync_to_async(notifications.process_pending_jobs)()
+        # Without the watcher the stream would only look again after a minute
+        chunk = await asyncio.wait_for(next_chunk, timeout=1)
+        self.assertIn(b'kucho is available', chunk)
+        await stream.aclose()
+        response.close()
+
+    async def test_anonymous_user_is_rejected(self):
+        response = await self.async_client.get(reverse('notification_stream'))
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(SSE_POLL_INTERVAL=0.01)
+    def test_idle_streams_do_not_hold_a_thread_each(self):
+        streams = 50
+
+        async def open_stream(opened, release):
+            # Like ASGIHandler, which handles every request in its own ThreadSensitiveContext
+            async with ThreadSensitiveContext():
+                events = aiter(NotificationEventStream(self.user.pk, 0))
+                await anext(events)
+                # The notifications, then a heartbeat after a poll that found nothing
+                while not (await anext(events)).startswith(': heartbeat'):
+                    pass
+                opened.release()
+                await release.wait()
+                await events.aclose()
+
+        async def open_streams():
+            opened, release = asyncio.Semaphore(0), asyncio.Event()
+            tasks = [asyncio.create_task(open_stream(opened, release)) for _ in range(streams)]
+            for _ in range(streams):
+                await opened.acquire()
+            threads_open = threading.active_count()
+            release.set()
+            await asyncio.gather(*tasks)
+            return threads_open
+
+        threads_before = threading.active_count()
+        # A new event loop without a synchronous caller, as under an ASGI server (an async test would
+        # run the thread-sensitive calls in the test's own thread)
+        threads_open = asyncio.run(open_streams())
+        # At most the threads of the loop's shared pool
+        self.assertLess(threads_open - threads_before, streams // 2)
+
+    @override_settings(NOTIFICATION_TRANSPORT='poll')
+    async def test_stream_is_not_opened_when_polling(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('notification_stream'))
+        self.assertEqual(response.status_code, 204)
+
+    def test_stream_is_not_opened_under_wsgi(self):
+        # The test client goes through the WSGI handler, which would hold the worker for the whole stream
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('notification_stream'))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(response.streaming)
+
+    def test_header_opens_the_stream(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('archive_page'))
+        self.assertContains(response, 'listenForNotifications(')
+        self.assertNotContains(response, 'pollForNotifications(')
+
+    @override_settings(NOTIFICATION_TRANSPORT='poll')
+    def test_header_polls_without_the_stream(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('archive_page'))
+        self.assertContains(response, 'pollForNotifications(')
+        self.assertNotContains(response, 'listenForNotifications(')
+
+    def test_updates_start_after_the_newest_notification(self):
+        get_user_model().objects.filter(pk=self.user.pk).update(unread_notification_count=2)
+        self.client.force_login(self.user)
+        updates = self.client.get(reverse('notification_updates')).json()
+        self.assertEqual(updates, {'unread_count': 2, 'last_id': self.second.pk, 'notifications': []})
+
+    def test_updates_continue_after_id(self):
+        self.client.force_login(self.user)
+        updates = self.client.get(reverse('notification_updates'), {'after': self.first.pk}).json()
+        self.assertEqual([notification['message'] for notification in updates['notifications']], ['second'])
+        self.assertEqual(updates['last_id'], self.second.pk)
+        updates = self.client.get(reverse('notification_updates'), {'after': self.second.pk}).json()
+        self.assertEqual((updates['notifications'], updates['last_id']), ([], self.second.pk))
+
+    def test_updates_reject_invalid_id(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('notification_updates'), {'after': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_job_worker_publishes_after_commit(self):
+        shelter_user = get_user_model().objects.create_user(username='shelter', password='123456', role='shelter')
+        post = DogAdoptionPost.objects.create(name='kucho', age=1, gender='male', breed='chihlala', size='XL',
+                                              shelter=Shelter.objects.get(user=shelter_user),
+                                              adoption_stage='in_process')
+        PostSubscription.objects.create(user=self.user, post=post)
+        post.adoption_stage = 'active'
+        post.save()
+        with mock.patch.object(pubsub.broker, 'publish') as publish:
+            notifications.process_pending_jobs()
+        publish.assert_called_once_with(pubsub.notification_channel(self.user.pk))
+
+
+class NotificationDigestTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.users = [get_user_model().objects.create(username=f'user{i}', email=f'user{i}@example.com')
+                      for i in range(5)]
+        for user in self.users:
+            for i in range(3):
+                self.notify(user, f'{user.username} message {i}', hours_ago=2)
+
+    def notify(self, user, message, hours_ago=0):
+        return Notification.objects.create(recipient=user, message=message,
+                                           created=self.now - timedelta(hours=hours_ago))
+
+    def test_one_digest_per_user(self):
+        self.assertEqual(digests.send_digests(now=self.now), 5)
+        self.assertEqual(len(mail.outbox), 5)
+        message = mail.outbox[0]
+        self.assertEqual(message.to, ['user0@example.com'])
+        self.assertEqual(message.subject, 'You have 3 new notifications on Watchdog')
+        self.assertIn('user0 message 2', message.body)
+        # Everything has been emailed, so there is nothing to send the next time
+        self.assertEqual(digests.send_digests(now=self.now), 0)
+
+    def test_batch_reuses_one_connection(self):
+        with mock.patch.object(digests, 'get_connection', wraps=digests.get_connection) as get_connection:
+            digests.send_digests(batch_size=2, now=self.now)
+        self.assertEqual(get_connection.call_count, 3)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_read_and_recent_notifications_are_not_sent(self):
+        notifications.mark_read(self.users[0])
+        self.notify(get_user_model().objects.create(username='new', email='new@example.com'), 'too recent')
+        digests.send_digests(now=self.now)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         [f'user{i}@example.com' for i in range(1, 5)])
+
+    def test_recent_notification_waits_for_the_window(self):
+        digests.send_digests(now=self.now)
+        self.notify(self.users[0], 'later')
+        self.assertEqual(digests.send_digests(now=self.now), 0)
+        later = self.now + timedelta(seconds=settings.NOTIFICATION_DIGEST_WINDOW)
+        self.assertEqual(digests.send_digests(now=later), 1)
+        self.assertEqual(mail.outbox[-1].subject, 'You have 1 new notification on Watchdog')
+
+    def test_failed_digest_is_retried_with_backoff(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')):
+            self.assertEqual(digests.send_digests(now=self.now), 0)
+        digest = NotificationDigest.objects.get(user=self.users[0])
+        self.assertEqual(digest.attempts, 1)
+        self.assertEqual(digest.next_attempt_at, self.now + timedelta(seconds=settings.NOTIFICATION_DIGEST_RETRY_DELAY))
+        self.assertIn('down', digest.last_error)
+
+        # Not retried before the backoff is over
+        self.assertEqual(digests.send_digests(now=self.now), 0)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')):
+            digests.send_digests(now=digest.next_attempt_at)
+        digest.refresh_from_db()
+        self.assertEqual(digest.attempts, 2)
+        self.assertEqual(digests.retry_delay(2), 2 * settings.NOTIFICATION_DIGEST_RETRY_DELAY)
+
+        self.assertEqual(digests.send_digests(now=digest.next_attempt_at), 5)
+        digest.refresh_from_db()
+        self.assertEqual((digest.attempts, digest.next_attempt_at, digest.last_error), (0, None, ''))
+
+    @override_settings(NOTIFICATION_DIGEST_MAX_ITEMS=2)
+    def test_only_the_newest_notifications_are_loaded(self):
+        newest = self.notify(self.users[0], 'user0 message 3', hours_ago=1)
+        loaded = list(digests.pending_notifications(digests.due_users(self.now)[:2]))
+        self.assertEqual([(n.recipient_id, n.message, n.pending_count) for n in loaded], [
+            (self.users[0].pk, 'user0 message 3', 4), (self.users[0].pk, 'user0 message 2', 4),
+            (self.users[1].pk, 'user1 message 2', 3), (self.users[1].pk, 'user1 message 1', 3),
+        ])
+
+        digests.send_digests(now=self.now)
+        message = mail.outbox[0]
+        self.assertEqual(message.subject, 'You have 4 new notifications on Watchdog')
+        self.assertIn('user0 message 3', message.body)
+        self.assertNotIn('user0 message 1', message.body)
+        self.assertIn('and 2 more', message.body)
+        self.assertEqual(NotificationDigest.objects.get(user=self.users[0]).emailed_up_to_id, newest.pk)
+
+    def test_users_without_email_are_skipped(self):
+        get_user_model().objects.filter(pk=self.users[0].pk).update(email='')
+        self.assertEqual(digests.send_digests(now=self.now), 4)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('send_notification_digests', stdout=out)
+        self.assertIn('Sent 5 notification digest(s).', out.getvalue())
+
+
+class NotificationCoalescingTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='user', password='123456')
+        shelter_user = get_user_model().objects.create_user(username='shelter', password='123456', role='shelter')
+        self.dog_post = DogAdoptionPost.objects.create(name='kucho', age=1, gender='male', breed='chihlala',
+                                                       shelter=Shelter.objects.get(user=shelter_user), size='XL',
+                                                       adoption_stage='in_process')
+        PostSubscription.objects.create(user=self.user, post=self.dog_post)
+
+    def bounce(self):
+        self.dog_post.adoption_stage = 'active'
+        self.dog_post.save()
+        notifications.process_pending_jobs()
+        self.dog_post.adoption_stage = 'in_process'
+        self.dog_post.save()
+
+    def test_repeats_are_collapsed_into_one_unread_row(self):
+        first_time = timezone.now()
+        self.bounce()
+        self.bounce()
+        self.bounce()
+        notification = Notification.objects.get()
+        self.assertEqual(notification.related_post, self.dog_post)
+        self.assertEqual(notification.kind, 'available')
+        self.assertEqual(notification.repeat_count, 3)
+        self.assertGreater(notification.created, first_time)
+        self.assertFalse(notification.is_read)
+
+    def test_read_notification_is_replaced_by_a_new_one(self):
+        self.bounce()
+        read = Notification.objects.get()
+        notifications.mark_read(self.user)
+        self.bounce()
+        notification = Notification.objects.get()
+        self.assertGreater(notification.pk, read.pk)
+        self.assertEqual(notification.repeat_count, 1)
+        self.assertFalse(notification.is_read)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.unread_notification_count, 1)
+
+    def test_repeat_gets_a_new_id(self):
+        self.bounce()
+        first = Notification.objects.get()
+        self.bounce()
+        repeat = Notification.objects.get()
+        self.assertGreater(repeat.pk, first.pk)
+        self.assertEqual(repeat.repeat_count, 2)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.unread_notification_count, 1)
+
+    def test_repeat_is_not_marked_read_with_an_older_id(self):
+        # The inbox was shown (and its newest id taken) before the repeat arrived
+        self.bounce()
+        shown_id = Notification.objects.get().pk
+        self.bounce()
+        notifications.mark_read(self.user, up_to=shown_id)
+        self.assertFalse(Notification.objects.select_related('recipient').get().is_read)
+
+    def test_repeat_is_delivered_as_a_new_notification(self):
+        self.bounce()
+        self.client.login(username='user', password='123456')
+        last_id = self.client.get(reverse('notification_updates')).json()['last_id']
+        self.bounce()
+        updates = self.client.get(reverse('notification_updates'), {'after': last_id}).json()
+        self.assertEqual([notification['message'] for notification in updates['notifications']],
+                         ['kucho is available for adoption.'])
+
+    def test_inbox_shows_the_repeat_count(self):
+        self.bounce()
+        self.bounce()
+        self.client.login(username='user', password='123456')
+        response = self.client.get(reverse('notifications'))
+        self.assertContains(response, '(&times;2)')
+
+    def test_duplicates_are_rejected_by_the_database(self):
+        Notification.objects.create(recipient=self.user, related_post=self.dog_post, kind='available', message='a')
+        with self.assertRaises(IntegrityError):
+            Notification.objects.create(recipient=self.user, related_post=self.dog_post, kind='available',
+                                        message='b')
+
+    def test_notifications_without_a_post_are_not_collapsed(self):
+        Notification.objects.create(recipient=self.user, message='a')
+        Notification.objects.create(recipient=self.user, message='a')
+        self.assertEqual(Notification.objects.count(), 2)
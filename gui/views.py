@@ -1,50 +1,136 @@
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import AuthenticationForm
-from django.http import HttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
 from django.urls import reverse, reverse_lazy
 from django.views import View
 from django.views.generic import DetailView, UpdateView
 
 from .forms import UserRegistrationForm, DogAdoptionPostForm, ShelterForm, SortFilterForm, CommentForm
 from django.shortcuts import render, redirect, get_object_or_404
-from .models import RegistrationCode, Shelter, DogAdoptionPost, Comment, PostSubscription, Notification
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_POST
+from .models import RegistrationCode, Shelter, DogAdoptionPost, Comment, Notification
+from .models import AdoptionStageConflict, ListingEntry
+from .facets import build_facets
+from .pagination import paginate
+from .routers import read_from_replica
+from . import geo, notifications, pubsub, search, subscriptions
+from .maps import clustering, shelter_map_html
 
-import folium
 from django.contrib import messages
 
 
 @login_required(login_url='/register-login')
+@read_from_replica
 def index(request):
-    shelters = Shelter.objects.all()
-    dogs = DogAdoptionPost.objects.filter(adoption_stage__in=['active', 'in_process'])
-
-    for dog in dogs:
-        dog.user_is_subscribed = PostSubscription.objects.filter(user=request.user, post=dog).exists()
+    # The cards are read from the listing read model, one row per post (see listings.py)
+    dogs = ListingEntry.objects.visible().with_subscription_flag(request.user)
+    ordering = ['pk']
+    facets = []
 
     form = SortFilterForm(request.GET)
 
     if form.is_valid():
+        if form.cleaned_data['q']:
+            dogs = search.search(dogs, form.cleaned_data['q'])
+            # Without an explicit sort option the most relevant results come first
+            ordering = ['search_rank', 'pk']
+        latitude, longitude = form.cleaned_data['latitude'], form.cleaned_data['longitude']
+        if latitude is not None and longitude is not None:
+            # The form falls back to DEFAULT_SEARCH_RADIUS_KM
+            dogs = geo.listings_within(dogs, latitude, longitude, form.cleaned_data['radius_km'])
+        # The counts in the sidebar are computed before the facet filters are applied,
+        # because every facet shows its counts as if its own filter wasn't chosen
+        facets = build_facets(request, dogs, form.cleaned_data)
         if form.cleaned_data['shelter']:
-            dogs = dogs.filter(shelter=form.cleaned_data['shelter'])
+            dogs = dogs.filter(shelter_id=form.cleaned_data['shelter'])
         if form.cleaned_data['size']:
             dogs = dogs.filter(size=form.cleaned_data['size'])
         if form.cleaned_data['breed']:
-            dogs = dogs.filter(breed__icontains=form.cleaned_data['breed'])
+            # The breed is picked from a list of existing breeds, so an exact (indexable) match is enough
+            dogs = dogs.filter(breed=form.cleaned_data['breed'])
         if form.cleaned_data['gender']:
             dogs = dogs.filter(gender=form.cleaned_data['gender'])
         if form.cleaned_data['sort_by']:
-            # If the sort criteria is size, then use a
-            # custom sorting function that assigns each size a number
+            # Sizes are ordered by rank (XS..XL) rather than alphabetically.
+            # The pk is used as a tie-breaker so the order is stable
             if form.cleaned_data['sort_by'] == 'size':
-                # Convert QuerySet to a list
-                dogs = list(dogs)
-                size_order = {'XS': 1, 'S': 2, 'M': 3, 'L': 4, 'XL': 5}
-                dogs.sort(key=lambda x: size_order.get(x.size, 0))
+                ordering = ['size_rank', 'pk']
+            elif form.cleaned_data['sort_by'] == 'distance':
+                ordering = ['distance_km', 'pk']
             else:
-                dogs = dogs.order_by(form.cleaned_data['sort_by'])
+                ordering = [form.cleaned_data['sort_by'], 'pk']
+
+    page = paginate(request, dogs, ordering)
+    return render(request, 'index.html', {'dogs': page.object_list, 'page': page, 'form': form, 'facets': facets})
+
+
+@login_required(login_url='/register-login')
+def search_posts(request):
+    """Return the posts that match the 'q' GET parameter as JSON, most relevant first"""
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'results': []})
+
+    dogs = search.search(DogAdoptionPost.objects.visible().select_related('shelter'), query)
+    dogs = dogs.order_by('search_rank', 'pk')[:settings.SEARCH_JSON_LIMIT]
+    return JsonResponse({'results': [{
+        'id': dog.pk,
+        'name': dog.name,
+        'breed': dog.breed,
+        'size': dog.size,
+        'shelter': dog.shelter.name if dog.shelter else None,
+        'url': reverse('dog_details', kwargs={'pk': dog.pk}),
+    } for dog in dogs]})
+
+
+@login_required(login_url='/register-login')
+def nearby_shelters(request):
+    """Return the shelters within 'radius_km' of ('lat', 'lon'), or the 'k' nearest ones, closest first"""
+    try:
+        latitude, longitude = float(request.GET['lat']), float(request.GET['lon'])
+        radius_km = float(request.GET['radius_km']) if 'radius_km' in request.GET else None
+        k = int(request.GET.get('k', settings.NEARBY_SHELTERS_LIMIT))
+    except (KeyError, ValueError):
+        return JsonResponse({'error': "'lat' and 'lon' are required numbers."}, status=400)
+    k = max(1, min(k, settings.NEARBY_SHELTERS_LIMIT))
+
+    if radius_km is not None:
+        shelters = geo.shelters_within(latitude, longitude, radius_km)[:k]
+    else:
+        shelters = geo.nearest_shelters(latitude, longitude, k)
+    return JsonResponse({'results': [{
+        'id': shelter.pk,
+        'name': shelter.name,
+        'latitude': shelter.latitude,
+        'longitude': shelter.longitude,
+        'distance_km': round(shelter.distance_km, 3),
+        'url': reverse('shelter_details', kwargs={'pk': shelter.pk}),
+    } for shelter in shelters]})
+
 
-    return render(request, 'index.html', {'dogs': dogs, 'shelters': shelters, 'form': form})
+@login_required(login_url='/register-login')
+def shelter_map(request):
+    # The browser fills in the tile coordinates (Leaflet's URL template syntax)
+    tile_url = reverse('shelter_map_tile', kwargs={'z': 0, 'x': 0, 'y': 0}).replace('/0/0/0.', '/{z}/{x}/{y}.')
+    return render(request, 'shelter_map.html', {'tile_url': tile_url})
+
+
+@login_required(login_url='/register-login')
+def shelter_map_tile(request, z, x, y):
+    """Return the (clustered) shelter markers inside one map tile"""
+    try:
+        return JsonResponse(clustering.tile(z, x, y))
+    except clustering.InvalidTile:
+        raise Http404("No such tile.")
 
 
 def register_and_login(request):
@@ -98,6 +184,7 @@ def register_and_login(request):
 
 
 # Django's DetailView is used to display a details page for an object from the database
+@method_decorator(read_from_replica, name='dispatch')
 class DogDetailView(DetailView):
     model = DogAdoptionPost
     template_name = 'dog_details.html'
@@ -112,6 +199,7 @@ class DogDetailView(DetailView):
         return context
 
 
+@method_decorator(read_from_replica, name='dispatch')
 class ShelterDetailView(DetailView):
     model = Shelter
     template_name = 'shelter_details.html'
@@ -119,10 +207,8 @@ class ShelterDetailView(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        shelter = self.get_object()
-        m = folium.Map(location=[shelter.latitude, shelter.longitude], zoom_start=15)
-        folium.Marker([shelter.latitude, shelter.longitude], tooltip=shelter.name).add_to(m)
-        context['map_html'] = m._repr_html_()
+        # DetailView has already fetched the shelter, and the map is rendered only the first time it's needed
+        context['map_html'] = shelter_map_html(self.object)
         return context
 
 
@@ -182,6 +268,15 @@ class EditDogPostView(UpdateView):
         # 'user' is a field in the Shelter model
         return qs.filter(shelter__user=self.request.user)
 
+    def form_valid(self, form):
+        try:
+            return super().form_valid(form)
+        except AdoptionStageConflict:
+            # The stage was changed (e.g. by an administrator) after the post was loaded
+            form.add_error('adoption_stage', 'The adoption stage of this post was changed in the meantime. '
+                                             'Please check it and save again.')
+            return self.form_invalid(form)
+
 
 @login_required(login_url='/register-login')
 def delete_post(request, post_id):
@@ -195,9 +290,11 @@ def delete_post(request, post_id):
 
 
 @login_required(login_url='/register-login')
+@read_from_replica
 def archive_page(request):
-    archived_dogs = DogAdoptionPost.objects.filter(adoption_stage='completed')
-    return render(request, 'archive_page.html', {'archived_dogs': archived_dogs})
+    archived_dogs = ListingEntry.objects.archived()
+    page = paginate(request, archived_dogs, ['pk'])
+    return render(request, 'archive_page.html', {'archived_dogs': page.object_list, 'page': page})
 
 
 # 'pk' is used to identify the post the comment is associated with
@@ -235,38 +332,185 @@ def delete_comment(request, post_pk, comment_pk):
     return redirect('dog_details', pk=post_pk)
 
 
-@login_required(login_url='/register-login')
-def subscribe_to_post(request, post_id):
-    post = get_object_or_404(DogAdoptionPost, id=post_id)
-    if request.user == post.shelter.user:
-        return redirect('index')
+def _wants_json(request):
+    """The subscribe buttons send their forms with fetch() and ask for JSON instead of a redirect"""
+    return 'application/json' in request.headers.get('Accept', '')
 
-    try:
-        PostSubscription.objects.get(user=request.user)
-    except PostSubscription.DoesNotExist:
-        PostSubscription.objects.create(user=request.user, post=post)
+
+def _subscription_response(request, post_id, subscribed):
+    if _wants_json(request):
+        return JsonResponse({'post': post_id, 'subscribed': subscribed})
     return redirect('index')
 
 
 @login_required(login_url='/register-login')
-def unsubscribe_from_post(request, post_id):
-    post = get_object_or_404(DogAdoptionPost, id=post_id)
-    if request.user == post.shelter.user:
-        return redirect('index')
+@require_POST
+def subscribe_to_post(request, post_id):
+    if not subscriptions.subscribe(request.user, post_id):
+        # Nothing was inserted: the user is already subscribed, or the post doesn't exist or is the user's own
+        if not subscriptions.is_subscribed(request.user, post_id):
+            if not DogAdoptionPost.objects.filter(pk=post_id).exists():
+                raise Http404('No such post')
+            if _wants_json(request):
+                return JsonResponse({'error': "Shelters can't subscribe to their own posts."}, status=403)
+            return redirect('index')
+    return _subscription_response(request, post_id, True)
 
-    subscription_to_remove = PostSubscription.objects.filter(user=request.user, post=post)
-    subscription_to_remove.delete()
-    return redirect('index')
+
+@login_required(login_url='/register-login')
+@require_POST
+def unsubscribe_from_post(request, post_id):
+    # The shelter that published the post can't be subscribed to it, so there's nothing to check
+    subscriptions.unsubscribe(request.user, post_id)
+    return _subscription_response(request, post_id, False)
 
 
 @login_required(login_url='/register-login')
 def user_notifications(request):
-    notifications = request.user.notifications.all()
-    return render(request, 'notifications.html', {'notifications': notifications})
+    page = paginate(request, request.user.notifications.all(), ['-created', '-pk'],
+                    per_page=settings.NOTIFICATIONS_PAGE_SIZE)
+    newest_id = max((notification.pk for notification in page.object_list), default=0)
+    return render(request, 'notifications.html', {
+        'notifications': page.object_list,
+        'page': page,
+        'last_read_id': request.user.last_read_notification_id,
+        # The page marks as read only what it has shown, not the notifications that arrive while it's open
+        'newest_id': newest_id,
+        # The notification stream (in the header) continues after the newest notification of the first page
+        'stream_after_id': None if page.has_previous else newest_id,
+    })
 
 
 @login_required(login_url='/register-login')
+@require_POST
 def mark_notifications_read(request):
     """Mark all messages as 'read' after the user leaves the notifications page"""
-    request.user.notifications.filter(is_read=False).update(is_read=True)
-    return HttpResponse('OK', status=200)
\ No newline at end of file
+    up_to = request.POST.get('up_to')
+    try:
+        up_to = int(up_to) if up_to else None
+    except ValueError:
+        return HttpResponse('Invalid notification id', status=400)
+    notifications.mark_read(request.user, up_to)
+    return HttpResponse('OK', status=200)
+
+
+def _notification_data(notification):
+    return {'id': notification.pk, 'message': notification.message, 'created': notification.created.isoformat()}
+
+
+def _notification_event(notification):
+    data = json.dumps(_notification_data(notification))
+    return f'id: {notification.pk}\nevent: notification\ndata: {data}\n\n'
+
+
+@login_required(login_url='/register-login')
+def notification_updates(request):
+    """
+    The polling counterpart of notification_stream (NOTIFICATION_TRANSPORT = 'poll'): the unread count and the
+    notifications with an id bigger than 'after', oldest first. Without 'after' only the newest id is returned,
+    which the page sends as 'after' the next time.
+    """
+    after = request.GET.get('after')
+    try:
+        after = int(after) if after else None
+    except ValueError:
+        return HttpResponse('Invalid notification id', status=400)
+    new_notifications = []
+    if after is None:
+        last_id = request.user.notifications.order_by('-pk').values_list('pk', flat=True).first() or 0
+    else:
+        new_notifications = list(request.user.notifications.filter(pk__gt=after)
+                                 .order_by('pk')[:settings.NOTIFICATIONS_PAGE_SIZE])
+        last_id = new_notifications[-1].pk if new_notifications else after
+    return JsonResponse({
+        'unread_count': request.user.unread_notification_count,
+        'last_id': last_id,
+        'notifications': [_notification_data(notification) for notification in new_notifications],
+    })
+
+
+class NotificationEventStream:
+    """
+    Send the notifications of the user with an id bigger than 'last_id' as they are written. The loop sleeps
+    until something is published to the user's channel (by the notification writer of the same process, or the
+    process's watcher of new notifications) or SSE_POLL_INTERVAL seconds pass, then reads the new rows.
+    After SSE_MAX_DURATION seconds the stream ends and the browser reconnects, sending the id of the last event
+    it got in Last-Event-ID.
+    """
+
+    def __init__(self, user_id, last_id):
+        self.user_id = user_id
+        self.last_id = last_id
+        self.subscription = None
+
+    def __aiter__(self):
+        return self._events()
+
+    def close(self):
+        # Called by Django when the response is closed (e.g. the client went away). Django doesn't close
+        # the async generator itself, so the subscription has to be released here
+        if self.subscription is not None:
+            pubsub.broker.unsubscribe(self.subscription)
+            self.subscription = None
+
+    def _new_notifications(self):
+        try:
+            return list(Notification.objects.filter(recipient_id=self.user_id, pk__gt=self.last_id).order_by('pk'))
+        finally:
+            # The pool's threads are outside the request cycle, which would close the connection
+            close_old_connections()
+
+    async def _events(self):
+        self.subscription = pubsub.broker.subscribe(pubsub.notification_channel(self.user_id))
+        notifications.watch_new_notifications()
+        # Not thread-sensitive: under ASGI every request has its own single-thread executor for thread-sensitive
+        # calls, which lives as long as the response, so the polls would keep a thread per open stream.
+        # The loop's shared pool is used instead
+        fetch_new_notifications = sync_to_async(self._new_notifications, thread_sensitive=False)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.SSE_MAX_DURATION
+        try:
+            yield f'retry: {settings.SSE_RETRY_MS}\n\n'
+            while True:
+                for notification in await fetch_new_notifications():
+                    self.last_id = notification.pk
+                    yield _notification_event(notification)
+
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                if not await self.subscription.wait(min(settings.SSE_POLL_INTERVAL, remaining)):
+                    # A comment line, which keeps proxies from closing an idle connection
+                    yield ': heartbeat\n\n'
+        finally:
+            self.close()
+
+
+async def notification_stream(request):
+    """
+    Server-Sent Events stream of the user's new notifications. It's an async view, so under ASGI
+    (e.g. 'uvicorn Watchdog.asgi:application') an open stream doesn't hold a thread while it waits.
+    Under WSGI it would hold a worker for the whole stream, so there (and unless NOTIFICATION_TRANSPORT
+    is 'sse') it answers 204 No Content, which tells the browser not to reconnect.
+    """
+    if settings.NOTIFICATION_TRANSPORT != 'sse' or not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponse('Authentication required', status=401)
+
+    # A reconnecting browser sends the id of the last event it received. On the first connection
+    # the page passes the newest notification it has shown, otherwise only new ones are sent
+    last_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return HttpResponse('Invalid event id', status=400)
+    if last_id is None:
+        last_id = await (user.notifications.order_by('-pk').values_list('pk', flat=True).afirst()) or 0
+
+    response = StreamingHttpResponse(NotificationEventStream(user.pk, last_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Don't let nginx buffer the events
+    response['X-Accel-Buffering'] = 'no'
+    return response